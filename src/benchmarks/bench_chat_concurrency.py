@@ -0,0 +1,110 @@
+"""
+bench_chat_concurrency.py
+
+Measures /chat requests/second for a single worker with the model call
+replaced by a fixed-latency stub, so the number reflects how well the
+worker overlaps in-flight LLM calls with database I/O.
+
+Needs a local Postgres (PG* settings from .env); no Azure OpenAI calls
+are made: the conversation summarizer, which the server history schedules
+once the bench user has enough messages, is stubbed too.
+
+    python3 src/benchmarks/bench_chat_concurrency.py --requests 500 --concurrency 50 --llm-latency 1.0
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+from datetime import date, timedelta
+
+import httpx
+from sqlmodel import delete, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+import fastapi_app.app as app_module
+import fastapi_app.conversation as conversation_module
+from fastapi_app.metric_upserts import METRIC_SPECS
+from fastapi_app.models import ChatMessage, ConversationSummary, HealthSnapshot, MetricRollup, get_async_engine
+
+BENCH_USER_ID = 999_998
+
+
+def make_payload(days: int = 7) -> dict:
+    today = date.today()
+    dates = [(today - timedelta(days=i)).isoformat() for i in range(days)]
+    return {
+        "user_id": BENCH_USER_ID,
+        "messages": [{"role": "user", "content": "I want to walk more."}],
+        "health_data": {
+            "heartRate": {"daily": [{"date": d, "value": 70} for d in dates]},
+            "stepCount": {"daily": [{"date": d, "value": 8000} for d in dates]},
+            "sleep": {"daily": [{"date": d, "value": 7.5} for d in dates]},
+        },
+    }
+
+
+async def main(total: int, concurrency: int, llm_latency: float) -> None:
+    async def stub_agent_response(chat_request: dict):
+        await asyncio.sleep(llm_latency)
+        return "That sounds important to you."
+
+    async def stub_summarize_conversation(previous_summary: str, messages: list[dict]) -> str:
+        await asyncio.sleep(llm_latency)
+        return f"{previous_summary}\nThe user talked about walking more.".strip()
+
+    app_module.get_agent_response = stub_agent_response
+    conversation_module.summarize_conversation = stub_summarize_conversation
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    transport = httpx.ASGITransport(app=app_module.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+
+        async def one_request():
+            nonlocal errors
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.post("/chat", json=make_payload())
+                latencies.append(time.perf_counter() - start)
+                if response.status_code != 200 or "error" in response.json():
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one_request() for _ in range(total)))
+        elapsed = time.perf_counter() - start
+
+    p95 = statistics.quantiles(latencies, n=20)[-1]
+    print(f"requests:     {total} ({errors} errors)")
+    print(f"concurrency:  {concurrency}, stub LLM latency {llm_latency:.2f}s")
+    print(f"throughput:   {total / elapsed:.1f} req/s")
+    print(f"latency:      p50 {statistics.median(latencies) * 1000:.0f} ms  p95 {p95 * 1000:.0f} ms")
+
+    await app_module.chat_writer.stop()
+    # a summary update still running would write its row after the cleanup
+    await asyncio.gather(*conversation_module._summary_tasks)
+    async with AsyncSession(get_async_engine()) as session:
+        snapshot_ids = select(ChatMessage.health_snapshot_id).where(ChatMessage.user_id == BENCH_USER_ID)
+        still_used = select(ChatMessage.health_snapshot_id).where(
+            ChatMessage.user_id != BENCH_USER_ID, ChatMessage.health_snapshot_id.is_not(None)
+        )
+        await session.exec(
+            delete(HealthSnapshot).where(HealthSnapshot.id.in_(snapshot_ids), HealthSnapshot.id.not_in(still_used))
+        )
+        for model in [ChatMessage, ConversationSummary, MetricRollup,
+                      *(spec.model for spec in METRIC_SPECS.values())]:
+            await session.exec(delete(model).where(model.user_id == BENCH_USER_ID))
+        await session.commit()
+    await get_async_engine().dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--llm-latency", type=float, default=1.0)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.requests, args.concurrency, args.llm_latency))
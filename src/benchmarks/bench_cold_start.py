@@ -0,0 +1,101 @@
+"""
+bench_cold_start.py
+
+Measures what the startup warm-up (fastapi_app/warmup.py) buys: starts a
+single gunicorn worker against llm_stub.py, once with STARTUP_WARMUP=0 and
+once with STARTUP_WARMUP=1, and times how long the worker takes to become
+ready and the latency of its first and second /chat.
+
+Needs a local Postgres (PG* settings from .env); no Azure OpenAI calls
+are made.
+
+    python3 src/benchmarks/bench_cold_start.py --rounds 5
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+from loadtest import FIRST_USER_ID, SRC_PATH, chat_payload, cleanup, stop_servers, wait_until_up
+
+# the first load-test user, so cleanup() removes its rows
+BENCH_USER_ID = FIRST_USER_ID
+
+
+def run_worker(warmup: bool, port: int, stub_url: str) -> tuple[float, float, float]:
+    """
+    Returns (seconds until ready, first /chat seconds, second /chat seconds).
+    """
+    env = {
+        **os.environ,
+        "STARTUP_WARMUP": "1" if warmup else "0",
+        "AZURE_OPENAI_BACKENDS": json.dumps([{"name": "stub", "base_url": f"{stub_url}/v1", "deployment": "gpt-4o"}]),
+        "PYTHONPATH": os.pathsep.join(filter(None, [str(SRC_PATH), os.environ.get("PYTHONPATH")])),
+    }
+    base_url = f"http://127.0.0.1:{port}"
+    started = time.perf_counter()
+    worker = subprocess.Popen(
+        [
+            sys.executable, "-m", "gunicorn", "fastapi_app.app:app",
+            "-c", "gunicorn.conf.py",
+            "--bind", f"127.0.0.1:{port}",
+            "--workers", "1",
+        ],
+        cwd=SRC_PATH,
+        env=env,
+    )
+    try:
+        wait_until_up(f"{base_url}/health/ready")
+        ready = time.perf_counter() - started
+
+        rng = random.Random(0)
+        latencies = []
+        with httpx.Client(base_url=base_url, timeout=60) as client:
+            for _ in range(2):
+                request_started = time.perf_counter()
+                response = client.post("/chat", json=chat_payload(BENCH_USER_ID, rng))
+                latencies.append(time.perf_counter() - request_started)
+                if response.status_code != 200 or "error" in response.json():
+                    raise RuntimeError(f"/chat failed: {response.text}")
+    finally:
+        stop_servers([worker])
+    return ready, latencies[0], latencies[1]
+
+
+def main(rounds: int, port: int, stub_port: int) -> None:
+    stub_url = f"http://127.0.0.1:{stub_port}"
+    stub = subprocess.Popen([
+        sys.executable, str(SRC_PATH / "benchmarks" / "llm_stub.py"),
+        "--port", str(stub_port), "--ttft-sigma", "0", "--seed", "0",
+    ])
+    try:
+        wait_until_up(f"{stub_url}/stats")
+        for warmup in (False, True):
+            runs = [run_worker(warmup, port, stub_url) for _ in range(rounds)]
+            ready, first, second = (statistics.median(values) for values in zip(*runs))
+            print(
+                f"STARTUP_WARMUP={int(warmup)}  ready after {ready * 1000:6.0f} ms  "
+                f"first /chat {first * 1000:6.0f} ms  second /chat {second * 1000:6.0f} ms"
+            )
+    finally:
+        stop_servers([stub])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--stub-port", type=int, default=8010)
+    args = parser.parse_args()
+
+    try:
+        main(args.rounds, args.port, args.stub_port)
+    finally:
+        asyncio.run(cleanup(users=1))
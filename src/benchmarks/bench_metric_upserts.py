@@ -0,0 +1,129 @@
+"""
+bench_metric_upserts.py
+
+Compares the old one-statement-per-day metric ingestion with the bulk
+upserts in fastapi_app.metric_upserts against a local Postgres.
+
+Reports statements sent to the database (every round trip, advisory
+locks and rollup maintenance included) and p50/p95 write latency per
+ingested payload. The bulk path is run with and without rollup
+maintenance, since the legacy path never kept rollups. Uses the PG*
+settings from .env, same as the app.
+
+    python3 src/benchmarks/bench_metric_upserts.py --iterations 200 --days 7
+"""
+
+import argparse
+import asyncio
+import random
+import statistics
+import time
+from datetime import date, timedelta
+
+from sqlalchemy import event
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel import SQLModel, delete
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+import fastapi_app.metric_upserts as metric_upserts
+from fastapi_app.metric_upserts import METRIC_SPECS, build_metric_rows, upsert_health_metrics
+from fastapi_app.models import MetricRollup, get_async_engine
+from fastapi_app.partitions import maintain_partitions
+
+BENCH_USER_ID = 999_999
+
+
+def make_health_data(days: int) -> dict:
+    today = date.today()
+    dates = [(today - timedelta(days=i)).isoformat() for i in range(days)]
+    return {
+        "heartRate": {"daily": [{"date": d, "value": random.uniform(55, 90)} for d in dates]},
+        "stepCount": {"daily": [{"date": d, "value": random.randint(1000, 15000)} for d in dates]},
+        "activeEnergy": {"daily": [{"date": d, "value": random.uniform(100, 900)} for d in dates]},
+        "flightsClimbed": {"daily": [{"date": d, "value": random.randint(0, 30)} for d in dates]},
+        "sleep": {"daily": [{"date": d, "value": random.uniform(4, 9)} for d in dates]},
+    }
+
+
+async def legacy_upsert(session: AsyncSession, user_id: int, health_data: dict) -> None:
+    """The previous ingestion path: one statement per daily item."""
+    for key, spec in METRIC_SPECS.items():
+        for row in build_metric_rows(user_id, health_data[key]["daily"], spec):
+            stmt = insert(spec.model).values(**row)
+            stmt = stmt.on_conflict_do_update(
+                constraint=spec.constraint,
+                set_={spec.column: row[spec.column]},
+            )
+            await session.execute(stmt)
+
+
+async def bulk_upsert_without_rollups(session: AsyncSession, user_id: int, health_data: dict) -> None:
+    """The bulk path with the advisory lock and rollup maintenance left out."""
+
+    async def skip(*args) -> None:
+        pass
+
+    lock, apply = metric_upserts.lock_user_metric, metric_upserts.apply_metric_changes
+    metric_upserts.lock_user_metric = metric_upserts.apply_metric_changes = skip
+    try:
+        await upsert_health_metrics(session, user_id, health_data)
+    finally:
+        metric_upserts.lock_user_metric, metric_upserts.apply_metric_changes = lock, apply
+
+
+async def run(label: str, fn, iterations: int, days: int) -> None:
+    statements = 0
+
+    def count_statement(*args, **kwargs):
+        nonlocal statements
+        statements += 1
+
+    # every path starts from empty tables, so none pays for rollups another left behind
+    await cleanup()
+    event.listen(get_async_engine().sync_engine, "before_cursor_execute", count_statement)
+    timings = []
+    try:
+        for _ in range(iterations):
+            health_data = make_health_data(days)
+            start = time.perf_counter()
+            async with AsyncSession(get_async_engine()) as session:
+                await fn(session, BENCH_USER_ID, health_data)
+                await session.commit()
+            timings.append((time.perf_counter() - start) * 1000)
+    finally:
+        event.remove(get_async_engine().sync_engine, "before_cursor_execute", count_statement)
+
+    p95 = statistics.quantiles(timings, n=20)[-1]
+    print(
+        f"{label:>16}: {statements / iterations:6.1f} statements/payload  "
+        f"p50 {statistics.median(timings):7.2f} ms  p95 {p95:7.2f} ms"
+    )
+
+
+async def cleanup() -> None:
+    async with AsyncSession(get_async_engine()) as session:
+        for model in [MetricRollup, *(spec.model for spec in METRIC_SPECS.values())]:
+            await session.exec(delete(model).where(model.user_id == BENCH_USER_ID))
+        await session.commit()
+
+
+async def main(iterations: int, days: int) -> None:
+    async with get_async_engine().begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+        await conn.run_sync(maintain_partitions)
+    try:
+        await run("legacy", legacy_upsert, iterations, days)
+        await run("bulk, no rollups", bulk_upsert_without_rollups, iterations, days)
+        await run("bulk", upsert_health_metrics, iterations, days)
+    finally:
+        await cleanup()
+        await get_async_engine().dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--days", type=int, default=7)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.iterations, args.days))
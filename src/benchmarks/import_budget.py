@@ -0,0 +1,129 @@
+"""
+import_budget.py
+
+Checks that importing the app stays fast and side-effect free, which is
+what every gunicorn worker pays on boot (and again after every
+max_requests recycle).
+
+Imports the module in a fresh interpreter under `python -X importtime`,
+with the database and Azure OpenAI pointed at unreachable addresses so an
+import that connects anywhere fails or blows the budget. Takes the best
+of --runs runs, prints the slowest imports and exits with 1 when the
+cumulative import time exceeds --budget-ms. Runs in CI without a
+database:
+
+    python3 src/benchmarks/import_budget.py --module fastapi_app.app --budget-ms 4000 --output import-times.json
+"""
+
+import argparse
+import json
+import os
+import pathlib
+import re
+import subprocess
+import sys
+
+SRC_PATH = pathlib.Path(__file__).parent.parent
+
+# "import time:       self [us] |  cumulative | imported package"
+IMPORT_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+# nothing should connect at import time; these addresses would fail if anything tried
+OFFLINE_ENV = {
+    "PGHOST": "192.0.2.1",
+    "PGPORT": "5432",
+    "PGUSER": "import_budget",
+    "PGPASSWORD": "import_budget",
+    "PGDATABASE": "import_budget",
+    "AZURE_OPENAI_ENDPOINT": "https://192.0.2.1",
+    "AZURE_OPENAI_API_KEY": "import_budget",
+    "APPLICATIONINSIGHTS_CONNECTION_STRING": "",
+    "STARTUP_WARMUP": "0",
+}
+
+
+def measure(module: str, timeout: float) -> dict[str, tuple[int, int, int]]:
+    """
+    Imports module in a new interpreter. Returns
+    package -> (self us, cumulative us, nesting depth).
+    """
+    env = {
+        **os.environ,
+        **OFFLINE_ENV,
+        "PYTHONPATH": os.pathsep.join(filter(None, [str(SRC_PATH), os.environ.get("PYTHONPATH")])),
+    }
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        env=env,
+        capture_output=True,
+        text=True,
+        timeout=timeout,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr[-4000:]}")
+
+    imports = {}
+    for line in result.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match:
+            imports[match.group(4)] = (int(match.group(1)), int(match.group(2)), len(match.group(3)) // 2)
+    return imports
+
+
+def top_level_cost(imports: dict[str, tuple[int, int, int]], module: str) -> int:
+    # the requested module's own line counts everything it pulled in
+    return imports[module][1]
+
+
+def report(imports: dict[str, tuple[int, int, int]], top: int) -> list[dict]:
+    # top-level packages and the app's own modules, by what they cost including their imports
+    slowest = sorted(
+        (
+            {"package": name, "cumulative_ms": cumulative / 1000, "self_ms": own / 1000}
+            for name, (own, cumulative, _) in imports.items()
+            if "." not in name or name.startswith("fastapi_app")
+        ),
+        key=lambda entry: entry["cumulative_ms"],
+        reverse=True,
+    )
+    return slowest[:top]
+
+
+def main(module: str, budget_ms: float, runs: int, top: int, timeout: float, output: str | None) -> int:
+    best = None
+    for _ in range(runs):
+        imports = measure(module, timeout)
+        if best is None or top_level_cost(imports, module) < top_level_cost(best, module):
+            best = imports
+
+    total_ms = top_level_cost(best, module) / 1000
+    slowest = report(best, top)
+    print(f"import {module}: {total_ms:.0f} ms (budget {budget_ms:.0f} ms, best of {runs})")
+    for entry in slowest:
+        print(f"  {entry['cumulative_ms']:8.1f} ms  {entry['package']}")
+
+    if output:
+        pathlib.Path(output).write_text(json.dumps({
+            "module": module,
+            "total_ms": total_ms,
+            "budget_ms": budget_ms,
+            "slowest": slowest,
+        }, indent=2) + "\n")
+
+    if total_ms > budget_ms:
+        print(f"over budget by {total_ms - budget_ms:.0f} ms")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", default="fastapi_app.app")
+    parser.add_argument("--budget-ms", type=float, default=4000)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    sys.exit(main(args.module, args.budget_ms, args.runs, args.top, args.timeout, args.output))
@@ -0,0 +1,261 @@
+"""
+llm_stub.py
+
+A local stand-in for Azure OpenAI, so the backend's own throughput can be
+measured without live model calls.
+
+Serves the chat completions API both at the OpenAI path
+(/v1/chat/completions) and at the Azure path
+(/openai/deployments/{deployment}/chat/completions), with or without
+streaming. Requests with a json_schema response_format (the guardrail
+agents' structured output) get a JSON object that satisfies the schema,
+with every boolean false, so the guardrails pass. Other requests,
+including the plain-text conversation summaries, get a reply picked from
+a fixed set by hashing the conversation, so the same conversation always
+gets the same reply.
+
+Latency: time to first token is lognormal around --ttft-ms (spread
+--ttft-sigma), then each output token takes --token-ms. With --seed the
+sampled latencies are reproducible. --rate-limit-rate answers that
+fraction of requests with a 429, to exercise the rate limiter.
+
+    python3 src/benchmarks/llm_stub.py --port 8010 --ttft-ms 400 --token-ms 15
+
+and point the backend at it with
+
+    AZURE_OPENAI_BACKENDS='[{"name": "stub", "base_url": "http://127.0.0.1:8010/v1", "deployment": "gpt-4o"}]'
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import random
+import time
+import uuid
+from collections.abc import AsyncIterator
+from typing import Any
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+REPLIES = [
+    "It sounds like being more active matters to you. What would make the first step feel manageable?",
+    "You've noticed a pattern in your week. What do you think is getting in the way?",
+    "That's a real change from last week. How do you feel about it?",
+    "On one hand you want to rest after work, and on the other you want to move more. Tell me more about that.",
+    "What has worked for you before when you wanted to build a new habit?",
+    "You mentioned your sleep. How ready do you feel, on a scale from 1 to 10, to change your evening routine?",
+]
+
+
+class StubSettings:
+    def __init__(self, ttft_ms: float, ttft_sigma: float, token_ms: float, output_tokens: int,
+                 rate_limit_rate: float, seed: int | None):
+        self.ttft_ms = ttft_ms
+        self.ttft_sigma = ttft_sigma
+        self.token_ms = token_ms
+        self.output_tokens = output_tokens
+        self.rate_limit_rate = rate_limit_rate
+        self.rng = random.Random(seed)
+
+    def ttft(self) -> float:
+        return self.ttft_ms / 1000 * math.exp(self.rng.gauss(0, self.ttft_sigma))
+
+
+settings = StubSettings(400, 0.3, 15, 60, 0.0, None)
+stats = {"requests": 0, "streamed": 0, "structured": 0, "rate_limited": 0}
+
+app = FastAPI()
+
+
+def count_tokens(value: Any) -> int:
+    return max(1, len(json.dumps(value, default=str)) // 4)
+
+
+def conversation_hash(messages: list[dict]) -> int:
+    encoded = json.dumps([[m.get("role"), m.get("content")] for m in messages], default=str)
+    return int.from_bytes(hashlib.sha256(encoded.encode()).digest()[:8], "big")
+
+
+def value_for_schema(schema: dict, defs: dict) -> Any:
+    """
+    The simplest value satisfying a JSON schema: false, 0, a fixed string,
+    [], or an object of such values.
+    """
+    if "$ref" in schema:
+        return value_for_schema(defs[schema["$ref"].rsplit("/", 1)[-1]], defs)
+    if "enum" in schema:
+        return schema["enum"][0]
+    if "const" in schema:
+        return schema["const"]
+    for key in ("anyOf", "oneOf", "allOf"):
+        if key in schema:
+            return value_for_schema(schema[key][0], defs)
+
+    kind = schema.get("type")
+    if isinstance(kind, list):
+        kind = next((k for k in kind if k != "null"), "null")
+    if kind == "object":
+        return {name: value_for_schema(prop, defs) for name, prop in schema.get("properties", {}).items()}
+    if kind == "array":
+        return []
+    if kind == "boolean":
+        return False
+    if kind in ("integer", "number"):
+        return 0
+    if kind == "string":
+        return "Stub response."
+    return None
+
+
+def completion_text(body: dict) -> tuple[str, bool]:
+    """
+    The reply for a request, and whether it is structured output.
+    """
+    response_format = body.get("response_format") or {}
+    if response_format.get("type") == "json_schema":
+        schema = response_format["json_schema"].get("schema", {})
+        return json.dumps(value_for_schema(schema, schema.get("$defs", {}))), True
+    if response_format.get("type") == "json_object":
+        return "{}", True
+
+    reply = REPLIES[conversation_hash(body.get("messages", [])) % len(REPLIES)]
+    words = reply.split(" ")
+    # repeat the reply up to the configured length
+    while len(words) < settings.output_tokens:
+        words += reply.split(" ")
+    return " ".join(words[:settings.output_tokens]), False
+
+
+def split_tokens(text: str) -> list[str]:
+    """
+    Word-sized chunks that join back to the text.
+    """
+    words = text.split(" ")
+    return [word if i == 0 else " " + word for i, word in enumerate(words)]
+
+
+def usage(prompt_tokens: int, completion_tokens: int) -> dict:
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "prompt_tokens_details": {"cached_tokens": 0},
+        "completion_tokens_details": {"reasoning_tokens": 0},
+    }
+
+
+def chunk(completion_id: str, model: str, delta: dict, finish_reason: str | None = None) -> str:
+    data = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    return f"data: {json.dumps(data)}\n\n"
+
+
+async def stream_completion(completion_id: str, model: str, text: str, ttft: float, prompt_tokens: int,
+                            include_usage: bool) -> AsyncIterator[str]:
+    tokens = split_tokens(text)
+    await asyncio.sleep(ttft)
+    yield chunk(completion_id, model, {"role": "assistant", "content": ""})
+    for token in tokens:
+        yield chunk(completion_id, model, {"content": token})
+        await asyncio.sleep(settings.token_ms / 1000)
+    yield chunk(completion_id, model, {}, "stop")
+    if include_usage:
+        data = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [],
+            "usage": usage(prompt_tokens, len(tokens)),
+        }
+        yield f"data: {json.dumps(data)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+async def chat_completions(body: dict, model: str):
+    stats["requests"] += 1
+    if settings.rate_limit_rate and settings.rng.random() < settings.rate_limit_rate:
+        stats["rate_limited"] += 1
+        return JSONResponse(
+            {"error": {"code": "429", "message": "Rate limit exceeded (stub)."}},
+            status_code=429,
+            headers={"retry-after-ms": "1000"},
+        )
+
+    text, structured = completion_text(body)
+    stats["structured"] += structured
+    prompt_tokens = count_tokens(body.get("messages", []))
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    ttft = settings.ttft()
+
+    if body.get("stream"):
+        stats["streamed"] += 1
+        include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+        return StreamingResponse(
+            stream_completion(completion_id, model, text, ttft, prompt_tokens, include_usage),
+            media_type="text/event-stream",
+        )
+
+    tokens = split_tokens(text)
+    await asyncio.sleep(ttft + len(tokens) * settings.token_ms / 1000)
+    return {
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": text},
+            "finish_reason": "stop",
+        }],
+        "usage": usage(prompt_tokens, len(tokens)),
+    }
+
+
+@app.post("/v1/chat/completions")
+async def openai_chat_completions(request: Request):
+    body = await request.json()
+    return await chat_completions(body, body.get("model", "stub"))
+
+
+@app.post("/openai/deployments/{deployment}/chat/completions")
+async def azure_chat_completions(deployment: str, request: Request):
+    return await chat_completions(await request.json(), deployment)
+
+
+@app.get("/v1/models")
+@app.get("/openai/models")
+async def list_models():
+    return {"object": "list", "data": [{"id": "stub", "object": "model", "created": 0, "owned_by": "stub"}]}
+
+
+@app.get("/stats")
+async def get_stats():
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8010)
+    parser.add_argument("--ttft-ms", type=float, default=400)
+    parser.add_argument("--ttft-sigma", type=float, default=0.3)
+    parser.add_argument("--token-ms", type=float, default=15)
+    parser.add_argument("--output-tokens", type=int, default=60)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    settings = StubSettings(
+        args.ttft_ms, args.ttft_sigma, args.token_ms, args.output_tokens, args.rate_limit_rate, args.seed
+    )
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
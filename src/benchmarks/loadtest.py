@@ -0,0 +1,330 @@
+"""
+loadtest.py
+
+End-to-end load test of the backend: drives /chat, /location/{user_id}
+and /chat/history/{user_id} with a fixed number of concurrent clients
+and writes throughput and p50/p95/p99 latency per endpoint to a JSON
+file, so runs can be compared between commits.
+
+With --start, it first starts llm_stub.py and the app under gunicorn with
+MyUvicornWorker (src/gunicorn.conf.py), pointed at the stub through
+AZURE_OPENAI_BACKENDS, and stops both afterwards. Without it, it loads an
+already running server at --base-url. Either way the app needs a local
+Postgres (PG* settings from .env) and makes no Azure OpenAI calls when
+pointed at the stub.
+
+    python3 src/benchmarks/loadtest.py --start --workers 4 --duration 60 --concurrency 64 \\
+        --output loadtest.json --compare loadtest-main.json
+
+Requests are picked at random by --mix weights (seeded with --seed) for
+--users load-test users, whose rows are deleted afterwards.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import pathlib
+import random
+import signal
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from datetime import UTC, date, datetime, timedelta
+
+import httpx
+from sqlmodel import delete, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from fastapi_app.metric_upserts import METRIC_SPECS
+from fastapi_app.models import (
+    ChatMessage,
+    ConversationSummary,
+    HealthSnapshot,
+    MetricRollup,
+    UserLocation,
+    get_async_engine,
+)
+
+SRC_PATH = pathlib.Path(__file__).parent.parent
+FIRST_USER_ID = 990_000
+ENDPOINTS = ("chat", "location", "history")
+
+
+def chat_payload(user_id: int, rng: random.Random, days: int = 7) -> dict:
+    today = date.today()
+    dates = [(today - timedelta(days=i)).isoformat() for i in range(days)]
+    return {
+        "user_id": user_id,
+        "messages": [{"role": "user", "content": rng.choice([
+            "I want to walk more.",
+            "I slept badly again this week.",
+            "I don't know if I can keep this up.",
+        ])}],
+        "health_data": {
+            "heartRate": {"daily": [{"date": d, "value": rng.randint(60, 80)} for d in dates]},
+            "stepCount": {"daily": [{"date": d, "value": rng.randint(3000, 12000)} for d in dates]},
+            "sleep": {"daily": [{"date": d, "value": round(rng.uniform(5, 9), 1)} for d in dates]},
+        },
+    }
+
+
+def location_payload(rng: random.Random) -> dict:
+    return {
+        "latitude": 42.4534 + rng.uniform(-0.01, 0.01),
+        "longitude": -76.4735 + rng.uniform(-0.01, 0.01),
+        "accuracy": rng.uniform(5, 30),
+    }
+
+
+async def send(client: httpx.AsyncClient, endpoint: str, user_id: int, rng: random.Random) -> bool:
+    """
+    Sends one request and returns whether it succeeded.
+    """
+    if endpoint == "chat":
+        response = await client.post("/chat", json=chat_payload(user_id, rng))
+        # /chat reports failures in the body
+        return response.status_code == 200 and "error" not in response.json()
+    if endpoint == "location":
+        response = await client.post(f"/location/{user_id}", json=location_payload(rng))
+        return response.status_code == 200
+    response = await client.get(f"/chat/history/{user_id}", params={"limit": 50})
+    return response.status_code == 200
+
+
+def percentile(ordered: list[float], p: int) -> float | None:
+    if not ordered:
+        return None
+    if len(ordered) == 1:
+        return ordered[0]
+    return statistics.quantiles(ordered, n=100, method="inclusive")[p - 1]
+
+
+def summarize(latencies: list[float], errors: int, elapsed: float) -> dict:
+    ordered = sorted(latencies)
+
+    def ms(value: float | None) -> float | None:
+        return round(value * 1000, 1) if value is not None else None
+
+    return {
+        "requests": len(ordered),
+        "errors": errors,
+        "throughput_rps": round(len(ordered) / elapsed, 2),
+        "mean_ms": ms(statistics.mean(ordered) if ordered else None),
+        "p50_ms": ms(percentile(ordered, 50)),
+        "p95_ms": ms(percentile(ordered, 95)),
+        "p99_ms": ms(percentile(ordered, 99)),
+    }
+
+
+async def run_load(base_url: str, mix: dict[str, float], users: int, concurrency: int, duration: float,
+                   warmup: float, seed: int) -> dict:
+    latencies: dict[str, list[float]] = defaultdict(list)
+    errors: dict[str, int] = defaultdict(int)
+    endpoints = list(mix)
+    weights = [mix[e] for e in endpoints]
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=120, limits=limits) as client:
+        started = time.perf_counter()
+        measure_from = started + warmup
+        stop_at = measure_from + duration
+
+        async def client_loop(index: int) -> None:
+            rng = random.Random(seed + index)
+            while time.perf_counter() < stop_at:
+                endpoint = rng.choices(endpoints, weights)[0]
+                user_id = FIRST_USER_ID + rng.randrange(users)
+                start = time.perf_counter()
+                try:
+                    ok = await send(client, endpoint, user_id, rng)
+                except httpx.HTTPError:
+                    ok = False
+                end = time.perf_counter()
+                # only requests that started and finished inside the window count
+                if start < measure_from or end > stop_at:
+                    continue
+                latencies[endpoint].append(end - start)
+                if not ok:
+                    errors[endpoint] += 1
+
+        await asyncio.gather(*(client_loop(i) for i in range(concurrency)))
+
+    results = {endpoint: summarize(latencies[endpoint], errors[endpoint], duration) for endpoint in endpoints}
+    results["total"] = summarize(
+        [latency for endpoint in endpoints for latency in latencies[endpoint]],
+        sum(errors.values()),
+        duration,
+    )
+    return results
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=SRC_PATH, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def wait_until_up(url: str, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=2).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"{url} did not come up within {timeout:.0f}s")
+
+
+def start_servers(args) -> list[subprocess.Popen]:
+    stub_url = f"http://127.0.0.1:{args.stub_port}"
+    stub = subprocess.Popen([
+        sys.executable, str(SRC_PATH / "benchmarks" / "llm_stub.py"),
+        "--port", str(args.stub_port),
+        "--ttft-ms", str(args.stub_ttft_ms),
+        "--token-ms", str(args.stub_token_ms),
+        "--seed", str(args.seed),
+    ])
+
+    env = {
+        **os.environ,
+        "AZURE_OPENAI_BACKENDS": json.dumps([{"name": "stub", "base_url": f"{stub_url}/v1", "deployment": "gpt-4o"}]),
+        "PYTHONPATH": os.pathsep.join(filter(None, [str(SRC_PATH), os.environ.get("PYTHONPATH")])),
+    }
+    port = httpx.URL(args.base_url).port or 8000
+    app = subprocess.Popen(
+        [
+            sys.executable, "-m", "gunicorn", "fastapi_app.app:app",
+            "-c", "gunicorn.conf.py",
+            "--bind", f"127.0.0.1:{port}",
+            "--workers", str(args.workers),
+        ],
+        cwd=SRC_PATH,
+        env=env,
+    )
+    servers = [stub, app]
+    try:
+        wait_until_up(f"{stub_url}/stats")
+        wait_until_up(f"{args.base_url}/health/ready")
+    except Exception:
+        stop_servers(servers)
+        raise
+    return servers
+
+
+def stop_servers(servers: list[subprocess.Popen]) -> None:
+    # SIGTERM lets the workers flush their write buffers
+    for server in reversed(servers):
+        server.send_signal(signal.SIGTERM)
+        try:
+            server.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+
+async def cleanup(users: int) -> None:
+    user_ids = range(FIRST_USER_ID, FIRST_USER_ID + users)
+    async with AsyncSession(get_async_engine()) as session:
+        # snapshots are shared by content, so keep those other users' messages still point to
+        snapshot_ids = select(ChatMessage.health_snapshot_id).where(ChatMessage.user_id.in_(user_ids))
+        still_used = select(ChatMessage.health_snapshot_id).where(
+            ChatMessage.user_id.not_in(user_ids), ChatMessage.health_snapshot_id.is_not(None)
+        )
+        await session.exec(
+            delete(HealthSnapshot).where(HealthSnapshot.id.in_(snapshot_ids), HealthSnapshot.id.not_in(still_used))
+        )
+        for model in [ChatMessage, ConversationSummary, UserLocation, MetricRollup,
+                      *(spec.model for spec in METRIC_SPECS.values())]:
+            await session.exec(delete(model).where(model.user_id.in_(user_ids)))
+        await session.commit()
+    await get_async_engine().dispose()
+
+
+def compare(results: dict, baseline_path: str) -> None:
+    baseline = json.loads(pathlib.Path(baseline_path).read_text())
+    print(f"\nvs {baseline_path} ({baseline['meta'].get('commit')}):")
+    for endpoint, current in results["endpoints"].items():
+        before = baseline["endpoints"].get(endpoint)
+        if not before:
+            continue
+        changes = []
+        for key in ("throughput_rps", "p50_ms", "p95_ms", "p99_ms"):
+            if before.get(key) and current.get(key) is not None:
+                changes.append(f"{key} {(current[key] - before[key]) / before[key]:+.1%}")
+        print(f"  {endpoint:9} " + "  ".join(changes))
+
+
+def parse_mix(value: str) -> dict[str, float]:
+    mix = {}
+    for part in value.split(","):
+        endpoint, _, weight = part.partition("=")
+        if endpoint not in ENDPOINTS:
+            raise argparse.ArgumentTypeError(f"unknown endpoint {endpoint!r}, expected one of {ENDPOINTS}")
+        mix[endpoint] = float(weight or 1)
+    return mix
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--start", action="store_true", help="start the LLM stub and gunicorn")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--stub-port", type=int, default=8010)
+    parser.add_argument("--stub-ttft-ms", type=float, default=400)
+    parser.add_argument("--stub-token-ms", type=float, default=15)
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("chat=1,location=4,history=1"))
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=60)
+    parser.add_argument("--warmup", type=float, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="loadtest.json")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    parser.add_argument("--no-cleanup", action="store_true")
+    args = parser.parse_args()
+
+    servers = start_servers(args) if args.start else []
+    try:
+        endpoints = asyncio.run(
+            run_load(args.base_url, args.mix, args.users, args.concurrency, args.duration, args.warmup, args.seed)
+        )
+    finally:
+        stop_servers(servers)
+
+    results = {
+        "meta": {
+            "commit": git_commit(),
+            "finished_at": datetime.now(UTC).isoformat(),
+            "base_url": args.base_url,
+            "workers": args.workers if args.start else None,
+            "concurrency": args.concurrency,
+            "duration_seconds": args.duration,
+            "mix": args.mix,
+            "users": args.users,
+            "stub": {"ttft_ms": args.stub_ttft_ms, "token_ms": args.stub_token_ms} if args.start else None,
+        },
+        "endpoints": endpoints,
+    }
+    pathlib.Path(args.output).write_text(json.dumps(results, indent=2) + "\n")
+
+    for endpoint, summary in endpoints.items():
+        print(
+            f"{endpoint:9} {summary['throughput_rps']:8.1f} req/s  {summary['errors']:5} errors  "
+            f"p50 {summary['p50_ms']} ms  p95 {summary['p95_ms']} ms  p99 {summary['p99_ms']} ms"
+        )
+    print(f"written to {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+    if not args.no_cleanup:
+        asyncio.run(cleanup(args.users))
+
+
+if __name__ == "__main__":
+    main()
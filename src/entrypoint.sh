@@ -3,5 +3,5 @@ set -e
 python3 -m pip install --upgrade pip
 python3 -m pip install -r src/requirements.txt
 python3 -m pip install -e src
-python3 src/fastapi_app/seed_data.py
-python3 -m gunicorn fastapi_app:app -c src/gunicorn.conf.py
\ No newline at end of file
+python3 src/fastapi_app/migrations.py
+python3 -m gunicorn fastapi_app.app:app -c src/gunicorn.conf.py
\ No newline at end of file
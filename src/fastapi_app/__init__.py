@@ -1 +0,0 @@
-from .app import app  # noqa
@@ -2,13 +2,29 @@
 agent_cache.py
 
 Caches and reuses MI agents to avoid recreating them on every request.
+
+Agents are pooled per configuration (guardrails, sensing agent, sensing
+prompt, combined guardrail), so each variant is built once per worker and
+every request gets the agent it asked for. The pool holds at most
+AGENT_POOL_SIZE variants and evicts the least recently used one beyond
+that.
 """
 
+import os
+import threading
+from collections import OrderedDict
 from typing import Optional, Callable
 from agents import Agent  # import directly from agents, not from custom_agents
 
-# Cached base agent
-base_agent: Optional[Agent] = None
+AGENT_POOL_SIZE = int(os.getenv("AGENT_POOL_SIZE", 16))
+
+# (use_harm_guardrail, use_mi_check_guardrail, use_sensing_agent, sensing_prompt,
+#  use_combined_guardrail) -> agent
+_agent_pool: "OrderedDict[tuple, Agent]" = OrderedDict()
+# agents are built synchronously, so this also keeps coroutines from racing
+_pool_lock = threading.Lock()
+_hits = 0
+_misses = 0
 
 # Function pointer for creating agents (set later)
 _create_agent_fn: Optional[Callable[..., Agent]] = None
@@ -27,34 +43,59 @@ def get_or_create_agent(
     use_harm_guardrail: bool = False,
     use_mi_check_guardrail: bool = False,
     use_sensing_agent: bool = False,
+    sensing_prompt: Optional[str] = None,
+    use_combined_guardrail: bool = False,
     reset_agent: bool = False,
 ) -> Agent:
     """
-    Returns an MI Agent.
+    Returns the MI Agent for this configuration, building it on first use.
 
-    - Reuses the cached base agent if no guardrails or tools are requested.
-    - Creates a new one otherwise.
+    reset_agent rebuilds the agent for this configuration and replaces
+    the pooled one.
     """
-    global base_agent, _create_agent_fn
+    global _hits, _misses
 
     if _create_agent_fn is None:
         raise RuntimeError("create_agent function not registered in agent_cache")
 
-    # Create a fresh agent if any of these flags are True
-    if reset_agent:
-        print("Creating new agent with custom settings")
-        return _create_agent_fn(
-            use_harm_guardrail=use_harm_guardrail,
-            use_mi_check_guardrail=use_mi_check_guardrail,
-            use_sensing_agent=use_sensing_agent,
-        )
+    key = (
+        bool(use_harm_guardrail),
+        bool(use_mi_check_guardrail),
+        bool(use_sensing_agent),
+        sensing_prompt,
+        bool(use_combined_guardrail),
+    )
+
+    with _pool_lock:
+        agent = None if reset_agent else _agent_pool.get(key)
+        if agent is not None:
+            _hits += 1
+            _agent_pool.move_to_end(key)
+            return agent
 
-    # Reuse or lazily create the base agent
-    if base_agent is None:
-        print("Creating and caching base agent")
-        base_agent = _create_agent_fn(
-            use_harm_guardrail=True,
-            use_mi_check_guardrail=True,
-            use_sensing_agent=False,
+        _misses += 1
+        agent = _create_agent_fn(
+            use_harm_guardrail=key[0],
+            use_mi_check_guardrail=key[1],
+            use_sensing_agent=key[2],
+            sensing_prompt=sensing_prompt,
+            use_combined_guardrail=key[4],
         )
-    return base_agent
+        _agent_pool[key] = agent
+        _agent_pool.move_to_end(key)
+        while len(_agent_pool) > AGENT_POOL_SIZE:
+            _agent_pool.popitem(last=False)
+        return agent
+
+
+def agent_pool_stats() -> dict:
+    """
+    Pool size and hit/miss counters for this worker.
+    """
+    with _pool_lock:
+        return {
+            "size": len(_agent_pool),
+            "max_size": AGENT_POOL_SIZE,
+            "hits": _hits,
+            "misses": _misses,
+        }
@@ -1,30 +1,72 @@
-from datetime import datetime
+import json
 import logging
 import os
 import pathlib
+from contextlib import asynccontextmanager
 
-from fastapi_app.custom_agents import  get_agent_response
-from azure.monitor.opentelemetry import configure_azure_monitor
-from fastapi import Depends, FastAPI, HTTPException
+from fastapi_app.agent_cache import agent_pool_stats
+from fastapi_app.custom_agents import  get_agent_response, stream_agent_response
+from fastapi import Depends, FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 import httpx
+from openai import RateLimitError
 from pydantic import BaseModel
-from sqlmodel import Session, select
-from sqlalchemy.dialects.postgresql import insert
-
-from .models import ChatMessage, ChatRequest, ChatResponse, GPSPayload, UserLocation, engine, UserData, HeartRate, StepCount, Sleep, ActiveEnergy, FlightsClimbed, BodyFat
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from .chat_history import fetch_history_page, stream_history
+from .conversation import build_conversation
+from .health_backfill import BackfillError, backfill_health_metrics
+from .guardrail_cache import guardrail_cache_stats
+from .health_snapshots import store_health_snapshot
+from .locations import insert_locations, location_buffer, location_row
+from .message_writer import chat_writer, message_row
+from .metric_upserts import upsert_health_metrics
+from .models import (
+    ChatRequest,
+    GPSPayload,
+    TimestampedGPSPayload,
+    UserLocation,
+    get_async_engine,
+)
+from .prompt_builder import PromptBuilder, format_value, prompt_cache_stats
+from .model_registry import all_backends, model_role_stats
+from .model_router import model_router_stats
+from .rate_limiter import rate_limiter_stats
+from .logging_config import RequestIdMiddleware, configure_logging
+from .telemetry import configure_telemetry, prometheus_metrics, stage
+from .warmup import is_ready, stop_warm_up, warm_up, warmup_status
 
-# Setup logger and Azure Monitor:
 logger = logging.getLogger("app")
-logger.setLevel(logging.INFO)
-if os.getenv("APPLICATIONINSIGHTS_CONNECTION_STRING"):
-    configure_azure_monitor()
+
+
+MAX_HISTORY_PAGE_SIZE = 500
+MAX_LOCATION_BATCH_SIZE = 1000
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # logger and telemetry (Azure Monitor or local Prometheus metrics) per worker, not at import;
+    # logging first, since Azure Monitor adds its handler to the app logger
+    configure_logging()
+    configure_telemetry(app)
+    # before accepting requests, so the first one isn't the cold one
+    await warm_up()
+    await chat_writer.replay_spool()
+    chat_writer.start()
+    location_buffer.start()
+    yield
+    await stop_warm_up()
+    # write out anything still buffered before the worker exits
+    await location_buffer.stop()
+    await chat_writer.stop()
 
 
 # Setup FastAPI app:
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # For testing, we allow everything
 # In production, replace with your actual web frontend URLs
@@ -46,7 +88,9 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID"],
 )
+app.add_middleware(RequestIdMiddleware)
 
 parent_path = pathlib.Path(__file__).parent.parent
 app.mount("/mount", StaticFiles(directory=parent_path / "static"), name="static")
@@ -57,8 +101,8 @@ templates.env.globals["url_for"] = app.url_path_for
 
 
 # Dependency to get the database session
-def get_db_session():
-    with Session(engine) as session:
+async def get_db_session():
+    async with AsyncSession(get_async_engine(), expire_on_commit=False) as session:
         yield session
 
 
@@ -86,230 +130,206 @@ async def login(data: LoginRequest):
         "username":"testuser1"
     }
 
+async def prepare_chat(chat_request: ChatRequest, session: AsyncSession) -> list[dict]:
+    """
+    Stores the incoming user message and health data, and returns the
+    messages for the agent. Unless use_server_history is off, the
+    conversation is rebuilt from stored history instead of the client's
+    messages. Location and health context go last, after the user
+    message, so the rest of the prompt stays cacheable across turns.
+    """
+    chat_request_dict = chat_request.dict()
+    messages = chat_request_dict.get("messages", [])
+    user_id = chat_request.user_id
+    health_data = chat_request_dict.get("health_data")
+
+    # ===== Store incoming user messages and health data =====
+    last_message = messages[-1]
+
+    with stage("metric_upserts"):
+        await upsert_health_metrics(session, user_id, health_data)
+    with stage("health_snapshot"):
+        health_snapshot_id = await store_health_snapshot(session, health_data)
+
+    # fetch the last 5 locations for the user
+    statement = (
+        select(UserLocation.latitude, UserLocation.longitude, UserLocation.created_at)
+        .where(UserLocation.user_id == user_id)
+        .order_by(UserLocation.created_at.desc())
+        .limit(5)
+    )
+    with stage("recent_locations"):
+        recent_locations = (await session.exec(statement)).all()
+
+    prompt = PromptBuilder()
+    if chat_request.use_server_history:
+        # history comes from the database; the client only supplies the new message
+        with stage("history"):
+            await build_conversation(session, user_id, prompt)
+    else:
+        prompt.add_history(messages[:-1])
+    prompt.set_user_message(last_message)
+
+    # commit before calling the model so the connection goes back to the pool
+    with stage("commit"):
+        await session.commit()
+
+    chat_writer.enqueue(
+        message_row(
+            user_id,
+            last_message["role"],
+            last_message["content"],
+            health_snapshot_id=health_snapshot_id,
+            gps_data=chat_request.gps_data,
+        )
+    )
+
+    prompt.add_context(
+        "User's recent location history",
+        [
+            f"{loc.created_at.isoformat()}: Lat {format_value(loc.latitude)}, Lon {format_value(loc.longitude)}"
+            for loc in reversed(recent_locations)  # oldest first
+        ],
+    )
+
+    if health_data:
+        prompt.add_context(
+            "User's latest health metrics",
+            [
+                f"Body Fat: {format_value(health_data.get('bodyFat'))}%",
+                f"Last 7 days of Heart Rate: {format_value(health_data.get('heartRate'))} bpm",
+                f"Last 7 days of Step Count: {format_value(health_data.get('stepCount'))}",
+                f"Last 7 days of Active Energy: {format_value(health_data.get('activeEnergy'))} kcal",
+                f"Last 7 days of Flights Climbed: {format_value(health_data.get('flightsClimbed'))}",
+                f"Last 7 days of Sleep: {format_value(health_data.get('sleep'))}",
+            ],
+        )
+
+    gps_data = chat_request_dict.get("gps_data")
+    logger.debug("Chat request location", extra={"gps_data": gps_data})
+    if gps_data:
+        prompt.add_context(
+            "User's current location",
+            [
+                f"Latitude: {format_value(gps_data.get('latitude'))}",
+                f"Longitude: {format_value(gps_data.get('longitude'))}",
+                f"Accuracy: {format_value(gps_data.get('accuracy'))} meters",
+            ],
+        )
+
+    return prompt.build()
+
+
+def agent_request(chat_request: ChatRequest, messages: list[dict]) -> dict:
+    """
+    The messages plus the agent configuration the client asked for.
+    """
+    return {
+        "user_id": chat_request.user_id,
+        "messages": messages,
+        "use_harm_guardrail": chat_request.use_harm_guardrail,
+        "use_mi_check_guardrail": chat_request.use_mi_check_guardrail,
+        "use_sensing_agent": chat_request.use_sensing_agent,
+        "sensing_prompt": chat_request.sensing_prompt,
+        "use_combined_guardrail": chat_request.use_combined_guardrail,
+        "reset_agent": chat_request.reset_agent,
+    }
+
+
 # this is not authenticated, will need to add auth logic later
 @app.post("/chat")
-async def chat_endpoint(chat_request: ChatRequest):
+async def chat_endpoint(chat_request: ChatRequest, session: AsyncSession = Depends(get_db_session)):
     """
     Endpoint that accepts chat messages and returns the AI's response,
     optionally including health data as a system message.
     """
     try:
-        chat_request_dict = chat_request.dict()
-        messages = chat_request_dict.get("messages", [])
-        user_id = chat_request.user_id
-        health_data = chat_request_dict.get("health_data")
-
-        # ===== Store incoming user messages and health data =====
-        with Session(engine) as session:
-            last_message = messages[-1]
-
-            db_msg = ChatMessage(
-                user_id=user_id,
-                role=last_message["role"],
-                content=last_message["content"],
-                health_data=health_data,
-                gps_data=chat_request.gps_data,
-            )
-
-            # Heart Rate
-            for item in health_data.get("heartRate", {}).get("daily", []):
-                if not isinstance(item, dict):
-                    continue
-                if "value" not in item or "date" not in item:
-                    continue
-
-                stmt = insert(HeartRate).values(
-                    user_id=user_id,
-                    bpm=float(item["value"]),
-                    recorded_at=datetime.strptime(item["date"], "%Y-%m-%d"),
-                )
-
-                stmt = stmt.on_conflict_do_update(
-                    constraint="uq_heart_user_date",
-                    set_={
-                        "bpm": float(item["value"]),
-                    },
-                )
-
-                session.execute(stmt)
-
-            # Step Count
-            for item in health_data.get("stepCount", {}).get("daily", []):
-                if not isinstance(item, dict):
-                    continue
-                if "value" not in item or "date" not in item:
-                    continue
-
-                stmt = insert(StepCount).values(
-                    user_id=user_id,
-                    steps=int(item["value"]),
-                    recorded_at=datetime.strptime(item["date"], "%Y-%m-%d"),
-                ).on_conflict_do_update(
-                    constraint="uq_step_user_date",
-                    set_={"steps": int(item["value"])}
-                )
-
-                session.execute(stmt)
-
-            # Active Energy
-            for item in health_data.get("activeEnergy", {}).get("daily", []):
-                if not isinstance(item, dict):
-                    continue
-                if "value" not in item or "date" not in item:
-                    continue
-
-                stmt = insert(ActiveEnergy).values(
-                    user_id=user_id,
-                    kcal=float(item["value"]),
-                    recorded_at=datetime.strptime(item["date"], "%Y-%m-%d"),
-                ).on_conflict_do_update(
-                    constraint="uq_energy_user_date",
-                    set_={
-                        "kcal": float(item["value"]),
-                    },
-                )
-
-                session.execute(stmt)
-
-            # Flights Climbed
-            for item in health_data.get("flightsClimbed", {}).get("daily", []):
-                if not isinstance(item, dict):
-                    continue
-                if "value" not in item or "date" not in item:
-                    continue
-
-                stmt = insert(FlightsClimbed).values(
-                    user_id=user_id,
-                    flights=int(item["value"]),
-                    recorded_at=datetime.strptime(item["date"], "%Y-%m-%d"),
-                ).on_conflict_do_update(
-                    constraint="uq_flights_user_date",
-                    set_={
-                        "flights": int(item["value"]),
-                    },
-                )
-
-                session.execute(stmt)
-
-            # Sleep
-            for item in health_data.get("sleep", {}).get("daily", []):
-                if not isinstance(item, dict):
-                    continue
-                if "value" not in item or "date" not in item:
-                    continue
-
-                stmt = insert(Sleep).values(
-                    user_id=user_id,
-                    duration_hours=float(item["value"]),
-                    recorded_at=datetime.strptime(item["date"], "%Y-%m-%d"),
-                ).on_conflict_do_update(
-                    constraint="uq_sleep_user_date",
-                    set_={
-                        "duration_hours": float(item["value"]),
-                    },
-                )
-
-                session.execute(stmt)
-
-            # Body Fat (unchanged)
-            if health_data.get("bodyFat") is not None:
-                session.add(
-                    BodyFat(
-                        user_id=user_id,
-                        percentage=float(health_data["bodyFat"]),
-                        recorded_at=datetime.utcnow()
-                    )
-                )
-                
-            session.add(db_msg)
-            session.commit()
-
-
-        with Session(engine) as session:
-            # fetch the last 5 locations for the user
-            statement = (
-                select(UserLocation.latitude, UserLocation.longitude, UserLocation.created_at)
-                .where(UserLocation.user_id == user_id)
-                .order_by(UserLocation.created_at.desc())
-                .limit(5)
-            )
-            recent_locations = session.exec(statement).all()
-
-            if recent_locations:
-                location_history_message = "User's recent location history:\n"
-                for loc in reversed(recent_locations):  # oldest first
-                    location_history_message += (
-                        f"- {loc.created_at}: "
-                        f"Lat {loc.latitude}, Lon {loc.longitude}\n"
-                    )
-                messages.append({"role": "system", "content": location_history_message})
-
-
-        if health_data:
-            healthDataMessage = (
-                f"User's latest health metrics:\n"
-                f"- Body Fat: {health_data.get('bodyFat', 'N/A')}%\n"
-                f"- Last 7 days of Heart Rate: {health_data.get('heartRate', 'N/A')} bpm\n"
-                f"- Last 7 days of Step Count: {health_data.get('stepCount', 'N/A')}\n"
-                f"- Last 7 days of Active Energy: {health_data.get('activeEnergy', 'N/A')} kcal\n"
-                f"- Last 7 days of Flights Climbed: {health_data.get('flightsClimbed', 'N/A')}\n"
-                f"- Last 7 days of Sleep: {health_data.get('sleep', 'N/A')}"
-            )
-            messages.append({"role": "system", "content": healthDataMessage})
-
-        gps_data = chat_request_dict.get("gps_data")
-        print("gps data is: ", gps_data)
-        if gps_data:
-            gpsMessage = (
-                f"User's current location:\n"
-                f"- Latitude: {gps_data.get('latitude', 'N/A')}\n"
-                f"- Longitude: {gps_data.get('longitude', 'N/A')}\n"
-                f"- Accuracy: {gps_data.get('accuracy', 'N/A')} meters"
-            )
-            messages.append({"role": "system", "content": gpsMessage})
-
-        response = await get_agent_response({"messages": messages})
+        messages = await prepare_chat(chat_request, session)
+
+        with stage("agent"):
+            response = await get_agent_response(agent_request(chat_request, messages))
 
 
         # ===== Store assistant response =====
-        with Session(engine) as session:
-            db_msg = ChatMessage(
-                user_id=user_id,
-                role="assistant",
-                content=response,
-            )
-            session.add(db_msg)
-            session.commit()
+        # written in the background so the reply goes out right away
+        if isinstance(response, str):
+            chat_writer.enqueue(message_row(chat_request.user_id, "assistant", response))
 
         return {"response": response}
 
+    except RateLimitError:
+        # still throttled after the rate limiter's retries
+        logger.warning("Azure OpenAI rate limit exhausted in /chat endpoint")
+        return {"error": "The assistant is busy right now, please try again shortly."}
     except Exception as e:
         logger.exception("Error in /chat endpoint")
         return {"error": str(e)}
 
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+# this is not authenticated, will need to add auth logic later
+@app.post("/chat/stream")
+async def chat_stream_endpoint(chat_request: ChatRequest, session: AsyncSession = Depends(get_db_session)):
+    """
+    Same as /chat, but streams the reply as server-sent events:
+
+    - `delta`: {"delta": "..."} for each chunk of generated text, sent
+      only once the input guardrails have passed
+    - `done`: {"response": "..."} with the complete reply, or the canned
+      response if an input guardrail tripped
+    - `error`: {"error": "..."} if generation failed
+    """
+    try:
+        messages = await prepare_chat(chat_request, session)
+    except Exception as e:
+        logger.exception("Error in /chat/stream endpoint")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    async def events():
+        reply = None
+        try:
+            async for kind, text in stream_agent_response(agent_request(chat_request, messages)):
+                if kind == "delta":
+                    yield sse_event("delta", {"delta": text})
+                else:
+                    reply = text
+                    yield sse_event(kind, {"response": text})
+        except Exception as e:
+            logger.exception("Error in /chat/stream endpoint")
+            yield sse_event("error", {"error": str(e)})
+
+        if reply:
+            chat_writer.enqueue(message_row(chat_request.user_id, "assistant", reply))
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 # this is not authenticated, will need to add auth logic later
 @app.get("/chat/history/{user_id}")
-def get_chat_history(user_id: int):
+async def get_chat_history(
+    user_id: int,
+    before: int | None = None,
+    limit: int | None = Query(default=None, ge=1, le=MAX_HISTORY_PAGE_SIZE),
+    session: AsyncSession = Depends(get_db_session),
+):
+    """
+    Returns a user's chat history, oldest first.
+
+    With `limit`, returns one page of messages older than the message id
+    `before` along with `next_before`, the cursor for the next older page.
+    Without `limit`, streams the full history.
+    """
+    if limit is None:
+        return StreamingResponse(stream_history(user_id, before), media_type="application/json")
+
     try:
-        with Session(engine) as session:
-            statement = (
-                select(ChatMessage)
-                .where(ChatMessage.user_id == user_id)
-                .order_by(ChatMessage.created_at)
-            )
-
-            db_messages = session.exec(statement).all()
-
-            # format for frontend
-            messages = [
-                {
-                    "role": msg.role,
-                    "content": msg.content,
-                }
-                for msg in db_messages
-            ]
-
-            return {"messages": messages}
+        return await fetch_history_page(session, user_id, limit, before)
 
     except Exception as e:
         logger.exception("Error fetching chat history")
@@ -320,27 +340,121 @@ from fastapi import Body
 
 
 @app.post("/location/{user_id}")
-def post_location(user_id: int, gps_data: GPSPayload = Body(...)):
+async def post_location(
+    user_id: int,
+    gps_data: GPSPayload = Body(...),
+    session: AsyncSession = Depends(get_db_session),
+):
     """
     Store a single GPS location for a user.
+
+    The fix is buffered and written together with other fixes shortly after,
+    unless write coalescing is disabled.
     """ 
     try:
-        with Session(engine) as session:
-            db_location = UserLocation(
-                user_id=user_id,
-                latitude=gps_data.latitude,
-                longitude=gps_data.longitude,
-                accuracy=gps_data.accuracy,
-            )
-            session.add(db_location)
-            session.commit()
+        row = location_row(user_id, gps_data.latitude, gps_data.longitude, gps_data.accuracy)
+        if location_buffer.enabled:
+            await location_buffer.add(row)
+            return {"status": "success", "message": "Location queued"}
+
+        await insert_locations(session, [row])
+        await session.commit()
 
         return {"status": "success", "message": "Location saved"}
 
     except Exception as e:
-        logger.exception("Error saving user location")
+        # by type only: database errors can carry the submitted values
+        logger.error(f"Error saving user location ({type(e).__name__})")
         raise HTTPException(status_code=500, detail=str(e))
 
+# this is not authenticated, will need to add auth logic later
+@app.post("/location/{user_id}/batch")
+async def post_location_batch(
+    user_id: int,
+    fixes: list[TimestampedGPSPayload] = Body(...),
+    session: AsyncSession = Depends(get_db_session),
+):
+    """
+    Store a batch of timestamped GPS locations for a user in one statement.
+    """
+    if len(fixes) > MAX_LOCATION_BATCH_SIZE:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_LOCATION_BATCH_SIZE} locations per batch")
+
+    try:
+        rows = [
+            location_row(user_id, fix.latitude, fix.longitude, fix.accuracy, fix.recorded_at)
+            for fix in fixes
+        ]
+        await insert_locations(session, rows)
+        await session.commit()
+
+        return {"status": "success", "message": f"{len(rows)} locations saved"}
+
+    except Exception as e:
+        logger.error(f"Error saving user location batch ({type(e).__name__})")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# this is not authenticated, will need to add auth logic later
+@app.post("/health/{user_id}/backfill")
+async def backfill_health(user_id: int, request: Request, session: AsyncSession = Depends(get_db_session)):
+    """
+    Bulk load historical health metrics for a user from a streamed NDJSON body.
+    """
+    try:
+        result = await backfill_health_metrics(session, user_id, request.stream())
+        return {"status": "success", **result}
+
+    except BackfillError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error backfilling health metrics ({type(e).__name__})")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/stats/agent-pool")
+async def get_agent_pool_stats():
+    return agent_pool_stats()
+
+@app.get("/stats/prompt-cache")
+async def get_prompt_cache_stats():
+    return prompt_cache_stats()
+
+@app.get("/stats/rate-limiter")
+async def get_rate_limiter_stats():
+    return rate_limiter_stats()
+
+@app.get("/stats/model-router")
+async def get_model_router_stats():
+    return model_router_stats(all_backends())
+
+@app.get("/stats/model-roles")
+async def get_model_role_stats():
+    return model_role_stats()
+
+@app.get("/stats/guardrail-cache")
+async def get_guardrail_cache_stats():
+    return guardrail_cache_stats()
+
+@app.get("/health/ready")
+async def get_readiness():
+    """
+    200 once this worker has warmed up and reached the database, 503 before.
+    """
+    status = warmup_status()
+    return JSONResponse(status, status_code=200 if is_ready() else 503)
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Prometheus metrics of this worker, unless they go to Application Insights.
+    """
+    exported = prometheus_metrics()
+    if exported is None:
+        raise HTTPException(status_code=404, detail="Metrics are exported to Application Insights")
+    body, content_type = exported
+    return Response(content=body, media_type=content_type)
+
+
 @app.get("/")
 async def root():
     return {"message": "Cornell Health App is running!"}
\ No newline at end of file
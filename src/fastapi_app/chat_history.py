@@ -0,0 +1,97 @@
+"""
+chat_history.py
+
+Queries for reading a user's chat history.
+
+Only role/content/created_at (plus the id used as the cursor) are selected,
+never the JSONB columns. Pages are fetched with keyset pagination on
+(created_at, id), which the ix_chatmessage_user_created_id index serves
+directly, and the full history can be streamed without loading it all.
+"""
+
+import json
+from collections.abc import AsyncIterator
+
+from sqlalchemy import tuple_
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from .models import ChatMessage, get_async_engine
+
+STREAM_BATCH_SIZE = 500
+
+
+def history_statement(user_id: int, before: int | None = None):
+    """
+    Selects a user's messages, optionally only those older than the
+    message with id `before`.
+    """
+    statement = select(ChatMessage.id, ChatMessage.role, ChatMessage.content, ChatMessage.created_at).where(
+        ChatMessage.user_id == user_id
+    )
+    if before is not None:
+        cursor_created_at = (
+            select(ChatMessage.created_at)
+            .where(ChatMessage.id == before, ChatMessage.user_id == user_id)
+            .scalar_subquery()
+        )
+        statement = statement.where(
+            tuple_(ChatMessage.created_at, ChatMessage.id) < tuple_(cursor_created_at, before)
+        )
+    return statement
+
+
+def format_message(row) -> dict:
+    return {
+        "id": row.id,
+        "role": row.role,
+        "content": row.content,
+        "created_at": row.created_at.isoformat() if row.created_at else None,
+    }
+
+
+async def fetch_history_page(
+    session: AsyncSession, user_id: int, limit: int, before: int | None = None
+) -> dict:
+    """
+    Returns up to `limit` messages older than `before`, oldest first, plus
+    the cursor for the next (older) page, or None when there is none.
+    """
+    statement = (
+        history_statement(user_id, before)
+        .order_by(ChatMessage.created_at.desc(), ChatMessage.id.desc())
+        .limit(limit)
+    )
+    rows = (await session.exec(statement)).all()
+
+    next_before = rows[-1].id if len(rows) == limit else None
+    return {
+        "messages": [format_message(row) for row in reversed(rows)],
+        "next_before": next_before,
+    }
+
+
+async def stream_history(user_id: int, before: int | None = None) -> AsyncIterator[str]:
+    """
+    Streams the history as {"messages": [...]}, oldest first, using a
+    server-side cursor so only one batch of rows is in memory at a time.
+
+    Opens its own session because the response body is produced after the
+    request's dependencies have been cleaned up. If the query fails midway
+    the body is left unterminated so clients can't mistake it for the
+    complete history.
+    """
+    statement = (
+        history_statement(user_id, before)
+        .order_by(ChatMessage.created_at, ChatMessage.id)
+        .execution_options(yield_per=STREAM_BATCH_SIZE)
+    )
+
+    yield '{"messages": ['
+    async with AsyncSession(get_async_engine()) as session:
+        result = await session.stream(statement)
+        separator = ""
+        async for row in result:
+            yield separator + json.dumps(format_message(row))
+            separator = ","
+    yield "]}"
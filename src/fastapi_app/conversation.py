@@ -0,0 +1,192 @@
+"""
+conversation.py
+
+Server-side conversation state.
+
+Instead of forwarding whatever message list the client sends, the prompt
+is rebuilt from stored ChatMessage rows (plus rows still queued in the
+write-behind writer): a per-user summary of the earlier conversation,
+then every message after it verbatim. Once the messages after the
+summary no longer fit CHAT_HISTORY_MAX_MESSAGES and
+CHAT_HISTORY_TOKEN_BUDGET, the oldest of them are folded into the summary
+in the background, at least CHAT_SUMMARY_MIN_MESSAGES at a time. Prompt
+size therefore stays roughly constant however long a participant has been
+chatting.
+
+Messages are ordered by (created_at, id), which is also the summary's
+cursor; ids alone are not in history order, since spool-replayed rows are
+inserted late. A message stays in the prompt until the summary covering
+it has committed, so nothing goes missing in between, and the window only
+moves when the summary does, which keeps the prompt a prefix of the next
+one for the model's prompt cache.
+"""
+
+import asyncio
+import logging
+import os
+from datetime import datetime
+
+from sqlalchemy import tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from .custom_agents import summarize_conversation
+from .message_writer import chat_writer
+from .models import ChatMessage, ConversationSummary, get_async_engine
+from .prompt_builder import PromptBuilder
+
+logger = logging.getLogger("app")
+
+MAX_MESSAGES = int(os.getenv("CHAT_HISTORY_MAX_MESSAGES", 20))
+TOKEN_BUDGET = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", 3000))
+# summarize once this many messages have fallen out of the window
+SUMMARY_MIN_MESSAGES = int(os.getenv("CHAT_SUMMARY_MIN_MESSAGES", 6))
+SUMMARY_MAX_MESSAGES = 100
+
+# users with a summary update in progress in this worker
+_summarizing: set[int] = set()
+_summary_tasks: set[asyncio.Task] = set()
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token for English, plus per-message overhead
+    return len(text) // 4 + 4
+
+
+def fit_window(history: list[dict], budget: int = TOKEN_BUDGET, max_messages: int = MAX_MESSAGES) -> int:
+    """
+    Returns how many of the newest messages in history (oldest first) fit
+    in the token budget and message limit.
+    """
+    used = 0
+    count = 0
+    for message in reversed(history[-max_messages:]):
+        used += estimate_tokens(message["content"])
+        if used > budget and count > 0:
+            break
+        count += 1
+    return count
+
+
+def message_key(message: dict) -> tuple[datetime, int]:
+    """
+    A message's position in the history. Rows still queued in the writer
+    have no id yet and sort before stored rows with the same created_at.
+    """
+    return message["created_at"], message["id"] if message["id"] is not None else 0
+
+
+def after(cursor: tuple[datetime, int]):
+    return tuple_(ChatMessage.created_at, ChatMessage.id) > tuple_(*cursor)
+
+
+def summary_cursor(summary: ConversationSummary | None) -> tuple[datetime, int] | None:
+    return (summary.last_message_created_at, summary.last_message_id) if summary else None
+
+
+async def build_conversation(session: AsyncSession, user_id: int, builder: PromptBuilder) -> None:
+    """
+    Adds the summary of older turns (if any) and every message after it to
+    the prompt. Schedules a summary update when those messages no longer
+    fit the budget. Reads run in the caller's transaction.
+    """
+    summary = await session.get(ConversationSummary, user_id)
+    cursor = summary_cursor(summary)
+
+    # normally well under the limit; it only binds while summaries are failing
+    limit = MAX_MESSAGES + SUMMARY_MAX_MESSAGES
+    statement = (
+        select(ChatMessage.id, ChatMessage.role, ChatMessage.content, ChatMessage.created_at)
+        .where(ChatMessage.user_id == user_id)
+        .order_by(ChatMessage.created_at.desc(), ChatMessage.id.desc())
+        .limit(limit)
+    )
+    if cursor is not None:
+        statement = statement.where(after(cursor))
+    rows = (await session.exec(statement)).all()
+    history = [
+        {"id": row.id, "role": row.role, "content": row.content, "created_at": row.created_at}
+        for row in reversed(rows)
+    ]
+
+    # rows may still be waiting in the writer; skip any that committed meanwhile
+    stored = {(m["created_at"], m["role"]) for m in history}
+    history += [
+        {"id": None, **row} for row in chat_writer.pending_for(user_id)
+        if (row["created_at"], row["role"]) not in stored
+    ]
+    history.sort(key=message_key)
+
+    if summary:
+        builder.add_stable(f"Summary of the earlier conversation:\n{summary.summary}")
+    builder.add_history(history)
+
+    # everything before the newest messages that fit is due for summarizing
+    due = len(history) - fit_window(history)
+    if due >= SUMMARY_MIN_MESSAGES or len(rows) == limit:
+        schedule_summary_update(user_id, message_key(history[due]))
+
+
+def schedule_summary_update(user_id: int, keep_from: tuple[datetime, int]) -> None:
+    if user_id in _summarizing:
+        return
+    _summarizing.add(user_id)
+    task = asyncio.create_task(update_summary(user_id, keep_from))
+    _summary_tasks.add(task)
+    task.add_done_callback(_summary_tasks.discard)
+
+
+async def update_summary(user_id: int, keep_from: tuple[datetime, int]) -> None:
+    """
+    Folds the messages between the current summary and keep_from into the
+    summary, once at least SUMMARY_MIN_MESSAGES of them have accumulated.
+    """
+    try:
+        async with AsyncSession(get_async_engine()) as session:
+            summary = await session.get(ConversationSummary, user_id)
+            cursor = summary_cursor(summary)
+            statement = (
+                select(ChatMessage.id, ChatMessage.role, ChatMessage.content, ChatMessage.created_at)
+                .where(ChatMessage.user_id == user_id, tuple_(ChatMessage.created_at, ChatMessage.id) < keep_from)
+                .order_by(ChatMessage.created_at, ChatMessage.id)
+                .limit(SUMMARY_MAX_MESSAGES)
+            )
+            if cursor is not None:
+                statement = statement.where(after(cursor))
+            rows = (await session.exec(statement)).all()
+            if len(rows) < SUMMARY_MIN_MESSAGES:
+                return
+
+            text = await summarize_conversation(
+                summary.summary if summary else "",
+                [{"role": row.role, "content": row.content} for row in rows],
+            )
+
+            last = rows[-1]
+            stmt = insert(ConversationSummary).values(
+                user_id=user_id, summary=text, last_message_id=last.id, last_message_created_at=last.created_at
+            )
+            stored_cursor = tuple_(ConversationSummary.last_message_created_at, ConversationSummary.last_message_id)
+            await session.execute(
+                stmt.on_conflict_do_update(
+                    index_elements=["user_id"],
+                    set_={
+                        "summary": stmt.excluded.summary,
+                        "last_message_id": stmt.excluded.last_message_id,
+                        "last_message_created_at": stmt.excluded.last_message_created_at,
+                        "updated_at": stmt.excluded.updated_at,
+                    },
+                    # another worker may have updated the summary meanwhile; keep its version
+                    where=(
+                        stored_cursor == tuple_(*cursor) if cursor is not None
+                        else stored_cursor < tuple_(last.created_at, last.id)
+                    ),
+                )
+            )
+            await session.commit()
+            logger.info(f"Updated conversation summary for user {user_id} through message {last.id}")
+    except Exception:
+        logger.exception(f"Error updating conversation summary for user {user_id}")
+    finally:
+        _summarizing.discard(user_id)
@@ -4,46 +4,62 @@
 # Module for creating motivational interviewing agent.
 # """
 
-import os
-from pydantic import BaseModel
-from openai import AsyncAzureOpenAI, BadRequestError
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+
 from agents import (
-    AsyncOpenAI, Agent, Runner, 
-    OpenAIChatCompletionsModel, set_tracing_disabled,
+    Agent,
     GuardrailFunctionOutput,
     InputGuardrailTripwireTriggered,
     RunContextWrapper,
+    Runner,
     TResponseInputItem,
-    input_guardrail
+    input_guardrail,
 )
 from dotenv import load_dotenv
-from fastapi_app.mi_prompts import (
-    mi_prompt, 
-    harm_prompt, harm_response, 
-    mi_check_prompt, mi_check_response
-)
-from fastapi_app.sensing_prompts import sensing_tool_description
 from fastapi import HTTPException
+from openai import BadRequestError
+from openai.types.responses import ResponseTextDeltaEvent
+from pydantic import BaseModel
+
 from fastapi_app.agent_cache import get_or_create_agent, register_create_agent
+from fastapi_app.guardrail_cache import guardrail_input, record_verdict
+from fastapi_app.mi_prompts import (
+    combined_safety_prompt,
+    harm_prompt,
+    harm_response,
+    mi_check_prompt,
+    mi_check_response,
+    mi_prompt,
+    summary_prompt,
+)
+from fastapi_app.model_registry import get_model
+from fastapi_app.prompt_builder import record_usage
+from fastapi_app.sensing import health_trends
+from fastapi_app.sensing_prompts import default_sensing_prompt, sensing_tool_description
+from fastapi_app.telemetry import guardrail_run, record_stage, record_ttft
 
 load_dotenv() 
 
-endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
-model_name = "gpt-4o"
-deployment = "gpt-4o"
-subscription_key = os.getenv("AZURE_OPENAI_API_KEY")
-api_version = "2024-12-01-preview"
+logger = logging.getLogger("app")
 
-client = AsyncAzureOpenAI(
-    api_version=api_version,
-    azure_endpoint=endpoint,
-    api_key=subscription_key,
-    )
+# deployments per agent role are configured in model_registry.py
+model = get_model("main")
+guardrail_model = get_model("guardrail")
+sensing_model = get_model("sensing")
+background_model = get_model("summary")
 
-model = OpenAIChatCompletionsModel(
-    model=deployment,
-    openai_client=client,
-)
+@dataclass
+class ChatRunContext:
+    """
+    Context of a chat run, available to guardrails and tools.
+    """
+    user_id: int | None = None
+
+def run_user_id(ctx: RunContextWrapper[ChatRunContext]) -> int | None:
+    return ctx.context.user_id if isinstance(ctx.context, ChatRunContext) else None
 
 # Create harm guardrail
 class HarmOutput(BaseModel):
@@ -53,17 +69,24 @@ class HarmOutput(BaseModel):
 harm_agent = Agent(
     name="Harm Agent",
     instructions=harm_prompt,
-    model=model,
+    model=guardrail_model,
     output_type=HarmOutput
 )
 
 @input_guardrail
 async def harm_guardrail(
-    ctx: RunContextWrapper[None], 
+    ctx: RunContextWrapper[ChatRunContext], 
     agent: Agent, 
     messages: str | list[TResponseInputItem]
 ):
-    result = await Runner.run(harm_agent, messages, context=ctx.context)
+    user_id = run_user_id(ctx)
+    with guardrail_run("harm") as outcome:
+        result = await Runner.run(
+            harm_agent, guardrail_input("harm", user_id, messages), context=ctx.context
+        )
+        outcome["tripped"] = result.final_output.is_harm
+    record_usage("harm_guardrail", result.context_wrapper.usage)
+    record_verdict("harm", user_id, messages, result.final_output.is_harm)
 
     return GuardrailFunctionOutput(
         output_info=harm_response, 
@@ -78,19 +101,24 @@ class MICheckOutput(BaseModel):
 mi_check_agent = Agent(
     name="MI Check Agent",
     instructions=mi_check_prompt,
-    model=model,
+    model=guardrail_model,
     output_type=MICheckOutput
 )
 
 @input_guardrail
 async def mi_check_guardrail(
-    ctx: RunContextWrapper[None], 
+    ctx: RunContextWrapper[ChatRunContext], 
     agent: Agent, 
     messages: str | list[TResponseInputItem]
 ):
-    result = await Runner.run(
-        mi_check_agent, messages, context=ctx.context
-    )
+    user_id = run_user_id(ctx)
+    with guardrail_run("mi_check") as outcome:
+        result = await Runner.run(
+            mi_check_agent, guardrail_input("mi_check", user_id, messages), context=ctx.context
+        )
+        outcome["tripped"] = result.final_output.is_not_mi
+    record_usage("mi_check_guardrail", result.context_wrapper.usage)
+    record_verdict("mi_check", user_id, messages, result.final_output.is_not_mi)
 
     return GuardrailFunctionOutput(
         output_info=mi_check_response, 
@@ -98,11 +126,69 @@ async def mi_check_guardrail(
     )
 
 
+# Create combined safety guardrail: both checks in one model call
+class SafetyOutput(BaseModel):
+    is_harm: bool
+    is_not_mi: bool
+    reasoning: str
+
+safety_agent = Agent(
+    name="Safety Agent",
+    instructions=combined_safety_prompt,
+    model=guardrail_model,
+    output_type=SafetyOutput
+)
+
+@input_guardrail
+async def safety_guardrail(
+    ctx: RunContextWrapper[ChatRunContext], 
+    agent: Agent, 
+    messages: str | list[TResponseInputItem]
+):
+    user_id = run_user_id(ctx)
+    with guardrail_run("safety") as outcome:
+        result = await Runner.run(
+            safety_agent, guardrail_input("safety", user_id, messages), context=ctx.context
+        )
+        outcome["tripped"] = result.final_output.is_harm or result.final_output.is_not_mi
+    record_usage("safety_guardrail", result.context_wrapper.usage)
+    output = result.final_output
+    record_verdict("safety", user_id, messages, output.is_harm or output.is_not_mi)
+
+    # harm takes precedence, so the crisis resources are shown whenever it applies
+    return GuardrailFunctionOutput(
+        output_info=harm_response if output.is_harm else mi_check_response,
+        tripwire_triggered=output.is_harm or output.is_not_mi,
+    )
+
+
+# Conversation summary agent
+summary_agent = Agent(
+    name="Summary Agent",
+    instructions=summary_prompt,
+    model=background_model,
+)
+
+async def summarize_conversation(previous_summary: str, messages: list[dict]) -> str:
+    """
+    Folds older messages into the running notes on a user's conversation.
+    """
+    transcript = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+    result = await Runner.run(
+        summary_agent,
+        f"# Notes so far\n{previous_summary or '(none)'}\n\n# Next exchanges\n{transcript}",
+    )
+    record_usage("summary", result.context_wrapper.usage)
+    return result.final_output
+
+
 # Motivational Interviewing Agent
 def create_agent(
     use_harm_guardrail=True,
     use_mi_check_guardrail=True,
     use_sensing_agent=False,
+    sensing_prompt=None,
+    use_combined_guardrail=False,
 ):
     """
     Create the agent.
@@ -115,13 +201,22 @@ def create_agent(
                             defaults to True
     use_sensing_agent: Whether to use the sensing agent
                        defaults to False
+    sensing_prompt: Instructions for the sensing agent
+                    defaults to None
+    use_combined_guardrail: Whether to run the harm and
+                            MI checks as a single call when
+                            both are enabled
+                            defaults to False
     """
     # Check guardrails
     guardrails = []
-    if use_harm_guardrail:
-        guardrails.append(harm_guardrail)
-    if use_mi_check_guardrail:
-        guardrails.append(mi_check_guardrail)
+    if use_combined_guardrail and use_harm_guardrail and use_mi_check_guardrail:
+        guardrails.append(safety_guardrail)
+    else:
+        if use_harm_guardrail:
+            guardrails.append(harm_guardrail)
+        if use_mi_check_guardrail:
+            guardrails.append(mi_check_guardrail)
 
     # Check sensing agent
     tools = []
@@ -129,7 +224,9 @@ def create_agent(
         # Create sensing agent
         sensing_agent = Agent(
             name="Sensing Agent",
-            model=model,
+            instructions=sensing_prompt or default_sensing_prompt,
+            model=sensing_model,
+            tools=[health_trends],
         )
         # Make as a tool
         tools.append(
@@ -156,7 +253,7 @@ REQUIRED_FIELDS = [
 ]
 
 async def getResponse(chat_request: dict):
-    print(chat_request)
+    logger.debug("Chat request", extra={"chat_request": chat_request})
     missing_fields = [f for f in REQUIRED_FIELDS if f not in chat_request]
     if missing_fields:
         raise HTTPException(
@@ -168,31 +265,39 @@ async def getResponse(chat_request: dict):
     use_harm_guardrail = chat_request.get("use_harm_guardrail", False)
     use_mi_check_guardrail = chat_request.get("use_mi_check_guardrail", False)
     use_sensing_agent = chat_request.get("use_sensing_agent", False)
+    sensing_prompt = chat_request.get("sensing_prompt")
+    use_combined_guardrail = chat_request.get("use_combined_guardrail", False)
     reset_agent = chat_request.get("reset_agent", False)
 
     agent = get_or_create_agent(
         use_harm_guardrail=use_harm_guardrail,
         use_mi_check_guardrail=use_mi_check_guardrail,
         use_sensing_agent=use_sensing_agent,
+        sensing_prompt=sensing_prompt,
+        use_combined_guardrail=use_combined_guardrail,
         reset_agent=reset_agent,
     )
 
-    print("Running agent with messages:", messages)
+    logger.debug("Running agent", extra={"messages": messages})
 
     # Pass the full array of messages to the agent
     result = await Runner.run(
         starting_agent=agent,
-        input=messages
+        input=messages,
+        context=ChatRunContext(user_id=chat_request.get("user_id")),
     )
 
-    print("Agent final output:", result)
+    logger.debug(
+        "Agent run finished",
+        extra={"final_output": result.final_output, "model_requests": result.context_wrapper.usage.requests},
+    )
+    record_usage("chat", result.context_wrapper.usage)
 
     return result.final_output
 
 
 
 async def get_agent_response(chat_request: dict):
-    print("Validating chat request:")
     try:
         response = await getResponse(chat_request)
     except InputGuardrailTripwireTriggered as e:
@@ -203,3 +308,87 @@ async def get_agent_response(chat_request: dict):
         return {"error": e.detail}
     return response
 
+
+async def input_guardrail_verdict(agent: Agent, messages: list, context: ChatRunContext) -> str | None:
+    """
+    Runs the agent's input guardrails. Returns the canned response of the
+    first one that tripped, or None if they all passed.
+    """
+    wrapper = RunContextWrapper(context=context)
+    results = await asyncio.gather(*(guardrail.run(agent, messages, wrapper) for guardrail in agent.input_guardrails))
+    for result in results:
+        if result.output.tripwire_triggered:
+            return result.output.output_info
+    return None
+
+
+async def stream_agent_response(chat_request: dict):
+    """
+    Streams the agent's reply. Yields ("delta", text) for each chunk of
+    generated text and finally ("done", reply).
+
+    The input guardrails run alongside the generation, but no text is
+    sent before they have all passed: until then the deltas are held back.
+    If one trips, only ("done", canned_response) is yielded.
+    """
+    messages = chat_request.get("messages")
+    agent = get_or_create_agent(
+        use_harm_guardrail=chat_request.get("use_harm_guardrail", False),
+        use_mi_check_guardrail=chat_request.get("use_mi_check_guardrail", False),
+        use_sensing_agent=chat_request.get("use_sensing_agent", False),
+        sensing_prompt=chat_request.get("sensing_prompt"),
+        use_combined_guardrail=chat_request.get("use_combined_guardrail", False),
+        reset_agent=chat_request.get("reset_agent", False),
+    )
+    context = ChatRunContext(user_id=chat_request.get("user_id"))
+
+    started = time.perf_counter()
+    chunks = []
+    released = False
+    # run here rather than by the runner, which doesn't say when they have all finished
+    checks = asyncio.create_task(input_guardrail_verdict(agent, messages, context))
+    result = Runner.run_streamed(
+        starting_agent=agent.clone(input_guardrails=[]),
+        input=messages,
+        context=context,
+    )
+    try:
+        async for event in result.stream_events():
+            if event.type != "raw_response_event" or not isinstance(event.data, ResponseTextDeltaEvent):
+                continue
+            chunks.append(event.data.delta)
+            if released:
+                yield "delta", event.data.delta
+                continue
+            if not checks.done():
+                continue
+            if checks.result() is not None:
+                break
+            released = True
+            record_ttft(started)
+            logger.info(f"Time to first token: {(time.perf_counter() - started) * 1000:.0f} ms")
+            # everything held back so far, in one chunk
+            yield "delta", "".join(chunks)
+        verdict = await checks
+    except BadRequestError:
+        result.cancel()
+        yield "done", harm_response
+        return
+    except BaseException:
+        result.cancel()
+        raise
+    finally:
+        checks.cancel()
+
+    if verdict is not None:
+        result.cancel()
+        yield "done", verdict
+        return
+
+    if not released and chunks:
+        record_ttft(started)
+        yield "delta", "".join(chunks)
+    record_stage("agent_stream", started)
+    record_usage("chat_stream", result.context_wrapper.usage)
+    final_output = result.final_output
+    yield "done", final_output if isinstance(final_output, str) else "".join(chunks)
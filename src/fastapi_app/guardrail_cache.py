@@ -0,0 +1,124 @@
+"""
+guardrail_cache.py
+
+Incremental input guardrail evaluation.
+
+Every turn the guardrails used to classify the whole conversation again,
+although all earlier user turns had already passed. Now a passing verdict
+is remembered per guardrail and user, keyed by a hash of every
+conversational (user/assistant) message up to and including that user
+turn. On the next turn, if the conversation up to the previous user turn
+hashes to a remembered key, the guardrail only gets the newest user
+message plus GUARDRAIL_CONTEXT_MESSAGES messages before it. Otherwise,
+e.g. when the client edited any earlier message, when the entry was
+evicted, or when the previous turn tripped the guardrail, the full
+conversation is evaluated as before.
+
+Entries expire after GUARDRAIL_CACHE_TTL_SECONDS, and at most
+GUARDRAIL_CACHE_SIZE are kept per worker, least recently used first out.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any
+
+CACHE_SIZE = int(os.getenv("GUARDRAIL_CACHE_SIZE", 10000))
+CACHE_TTL = float(os.getenv("GUARDRAIL_CACHE_TTL_SECONDS", 3600))
+CONTEXT_MESSAGES = int(os.getenv("GUARDRAIL_CONTEXT_MESSAGES", 2))
+
+CONVERSATIONAL_ROLES = ("user", "assistant")
+
+# (guardrail, user_id, key) -> expiry time of a passing verdict
+_verdicts: "OrderedDict[tuple[str, int, str], float]" = OrderedDict()
+_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "full_evaluations": 0}
+
+
+def _conversational(messages: list[Any]) -> list[dict]:
+    return [
+        m for m in messages
+        if isinstance(m, dict) and m.get("role") in CONVERSATIONAL_ROLES
+    ]
+
+
+def _user_turns(conversation: list[dict]) -> list[int]:
+    return [i for i, m in enumerate(conversation) if m["role"] == "user"]
+
+
+def turn_key(conversation: list[dict], end: int) -> str:
+    """
+    Hash of the whole conversation up to and including index end, so a
+    change to any earlier message changes the key.
+    """
+    digest = hashlib.sha256()
+    for m in conversation[:end + 1]:
+        digest.update(json.dumps([m["role"], m.get("content")], separators=(",", ":"), default=str).encode())
+        digest.update(b"\n")
+    return digest.hexdigest()
+
+
+def guardrail_input(guardrail: str, user_id: int | None, messages: Any) -> Any:
+    """
+    The input to classify: the newest user turn with a little context if
+    the conversation before it already passed this guardrail, otherwise
+    the full input.
+    """
+    conversation = [] if user_id is None or isinstance(messages, str) else _conversational(messages)
+    turns = _user_turns(conversation)
+
+    hit = False
+    # with a single user turn nothing was judged before
+    if len(turns) >= 2:
+        previous = (guardrail, user_id, turn_key(conversation, turns[-2]))
+        with _lock:
+            expires = _verdicts.get(previous)
+            hit = expires is not None and expires > time.monotonic()
+            if hit:
+                _verdicts.move_to_end(previous)
+            elif expires is not None:
+                del _verdicts[previous]
+            _stats["hits" if hit else "misses"] += 1
+
+    if not hit:
+        with _lock:
+            _stats["full_evaluations"] += 1
+        return messages
+    current = turns[-1]
+    return conversation[max(0, current - CONTEXT_MESSAGES):current + 1]
+
+
+def record_verdict(guardrail: str, user_id: int | None, messages: Any, tripped: bool) -> None:
+    """
+    Remembers that the conversation up to the newest user turn passed.
+    Tripped verdicts are not remembered, so the next turn is judged in
+    full again.
+    """
+    if tripped or user_id is None or isinstance(messages, str):
+        return
+
+    conversation = _conversational(messages)
+    turns = _user_turns(conversation)
+    if not turns:
+        return
+
+    key = (guardrail, user_id, turn_key(conversation, turns[-1]))
+    with _lock:
+        _verdicts[key] = time.monotonic() + CACHE_TTL
+        _verdicts.move_to_end(key)
+        while len(_verdicts) > CACHE_SIZE:
+            _verdicts.popitem(last=False)
+
+
+def guardrail_cache_stats() -> dict:
+    with _lock:
+        lookups = _stats["hits"] + _stats["misses"]
+        return {
+            **_stats,
+            "size": len(_verdicts),
+            "max_size": CACHE_SIZE,
+            "hit_rate": _stats["hits"] / lookups if lookups else 0.0,
+        }
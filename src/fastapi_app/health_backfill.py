@@ -0,0 +1,178 @@
+"""
+health_backfill.py
+
+Bulk loading of historical health metrics.
+
+The request body is parsed incrementally as NDJSON, one record per line:
+
+    {"metric": "stepCount", "date": "2025-01-31", "value": 8042}
+
+where metric is one of the health_data keys in METRIC_SPECS. Records are
+streamed through Postgres COPY into a temporary staging table as they are
+parsed, then merged into the metric tables with one
+INSERT ... SELECT ... ON CONFLICT per metric, so memory use stays bounded
+no matter how large the upload is. Monthly partitions for the uploaded
+date range are created before merging, and the user's rollups are
+rebuilt afterwards.
+"""
+
+import json
+from collections.abc import AsyncIterator
+from datetime import datetime
+
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from .metric_upserts import METRIC_SPECS
+from .models import get_async_engine
+from .partitions import ensure_partitions
+from .rollups import lock_user_metric, rebuild_user_rollups
+
+STAGING_TABLE = "health_backfill_staging"
+MAX_LINE_BYTES = 64 * 1024
+
+
+class BackfillError(ValueError):
+    """Raised for malformed backfill input."""
+
+
+async def iter_ndjson_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[tuple[int, dict]]:
+    """
+    Yields (line_number, record) pairs from a stream of NDJSON bytes
+    without ever holding more than one partial line in memory.
+    """
+    buffer = b""
+    line_number = 0
+
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        if len(buffer) > MAX_LINE_BYTES:
+            raise BackfillError(f"Line {line_number + len(lines) + 1} exceeds {MAX_LINE_BYTES} bytes")
+        for line in lines:
+            line_number += 1
+            if line.strip():
+                yield line_number, _decode_line(line, line_number)
+
+    if buffer.strip():
+        yield line_number + 1, _decode_line(buffer, line_number + 1)
+
+
+def _decode_line(line: bytes, line_number: int) -> dict:
+    try:
+        record = json.loads(line)
+    except ValueError as e:
+        raise BackfillError(f"Line {line_number}: invalid JSON ({e})") from e
+    if not isinstance(record, dict):
+        raise BackfillError(f"Line {line_number}: expected a JSON object")
+    return record
+
+
+def parse_record(line_number: int, record: dict) -> tuple:
+    """
+    Validates one record and returns a staging row
+    (seq, metric, recorded_at, value).
+    """
+    metric = record.get("metric")
+    # a list or object isn't hashable, so check before the lookup
+    spec = METRIC_SPECS.get(metric) if isinstance(metric, str) else None
+    if spec is None:
+        raise BackfillError(f"Line {line_number}: unknown metric {metric!r}")
+
+    try:
+        recorded_at = datetime.strptime(record["date"], "%Y-%m-%d")
+        value = float(record["value"])
+    except (KeyError, TypeError, ValueError) as e:
+        raise BackfillError(f"Line {line_number}: invalid date or value ({e})") from e
+    if spec.cast is int:
+        # int() would truncate 7.9 to 7
+        if not value.is_integer():
+            raise BackfillError(f"Line {line_number}: {metric} takes whole numbers, got {record['value']!r}")
+        value = int(value)
+
+    return line_number, metric, recorded_at.date().isoformat(), value
+
+
+async def create_staging_table(cursor) -> None:
+    await cursor.execute(
+        f"""
+        CREATE TEMPORARY TABLE {STAGING_TABLE} (
+            seq bigint NOT NULL,
+            metric text NOT NULL,
+            recorded_at timestamptz NOT NULL,
+            value double precision NOT NULL
+        ) ON COMMIT DROP
+        """
+    )
+
+
+async def copy_records(cursor, chunks: AsyncIterator[bytes]) -> int:
+    """
+    Streams parsed records into the staging table with COPY.
+    Returns the number of records received.
+    """
+    received = 0
+    async with cursor.copy(f"COPY {STAGING_TABLE} (seq, metric, recorded_at, value) FROM STDIN") as copy:
+        async for line_number, record in iter_ndjson_lines(chunks):
+            await copy.write_row(parse_record(line_number, record))
+            received += 1
+    return received
+
+
+async def merge_staging_table(cursor, user_id: int) -> dict[str, int]:
+    """
+    Merges the staged rows into the metric tables, honoring the
+    uq_*_user_date constraints. When a date appears more than once in the
+    upload, the record that came last in the stream wins.
+    """
+    merged = {}
+    for metric, spec in METRIC_SPECS.items():
+        table = spec.model.__tablename__
+        column_type = "integer" if spec.cast is int else "double precision"
+        await cursor.execute(
+            f"""
+            INSERT INTO {table} (user_id, {spec.column}, recorded_at)
+            SELECT DISTINCT ON (recorded_at) %(user_id)s, value::{column_type}, recorded_at
+            FROM {STAGING_TABLE}
+            WHERE metric = %(metric)s
+            ORDER BY recorded_at, seq DESC
+            ON CONFLICT ON CONSTRAINT {spec.constraint}
+            DO UPDATE SET {spec.column} = EXCLUDED.{spec.column}
+            """,
+            {"user_id": user_id, "metric": metric},
+        )
+        merged[metric] = cursor.rowcount
+    return merged
+
+
+async def backfill_health_metrics(session: AsyncSession, user_id: int, chunks: AsyncIterator[bytes]) -> dict:
+    """
+    Loads an NDJSON stream of historical metrics for one user.
+
+    The whole upload is applied in a single transaction, so a malformed
+    line rejects the upload without leaving partial data behind.
+    """
+    # COPY isn't exposed through SQLAlchemy, so use the session's psycopg connection
+    connection = await session.connection()
+    raw_connection = await connection.get_raw_connection()
+
+    async with raw_connection.driver_connection.cursor() as cursor:
+        await create_staging_table(cursor)
+        received = await copy_records(cursor, chunks)
+
+        await cursor.execute(f"SELECT min(recorded_at), max(recorded_at) FROM {STAGING_TABLE}")
+        first, last = await cursor.fetchone()
+        if first is not None:
+            # in its own short transaction, so the partition DDL locks aren't
+            # held for the rest of the upload
+            async with get_async_engine().begin() as conn:
+                await conn.run_sync(ensure_partitions, first.date(), last.date())
+
+        for spec in METRIC_SPECS.values():
+            await lock_user_metric(session, spec.model.__tablename__, user_id)
+        merged = await merge_staging_table(cursor, user_id)
+
+    if any(merged.values()):
+        # cheaper than per-row deltas for a bulk load
+        await rebuild_user_rollups(session, user_id)
+    await session.commit()
+    return {"received": received, "merged": merged}
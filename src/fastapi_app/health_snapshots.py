@@ -0,0 +1,142 @@
+"""
+health_snapshots.py
+
+Content-addressed storage of the health_data sent with chat messages.
+
+The client resends the same 7-day window on every turn, so instead of a
+JSONB copy per ChatMessage each distinct payload is stored once in
+health_snapshot, keyed by the sha256 of its canonical JSON encoding, and
+messages only keep the key.
+
+Existing messages can be rewritten to the new layout with:
+
+    python3 src/fastapi_app/health_snapshots.py [--vacuum-full]
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+
+from sqlalchemy import bindparam, event, func, null, text, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session as OrmSession
+from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from fastapi_app.models import ChatMessage, HealthSnapshot, get_engine
+
+logger = logging.getLogger("app")
+
+COMPACTION_BATCH_SIZE = 1000
+RECENT_KEYS_SIZE = 4096
+
+# keys this worker has committed, so repeated payloads skip the insert
+_recent_keys: OrderedDict[str, None] = OrderedDict()
+
+
+def snapshot_key(health_data: dict) -> str:
+    canonical = json.dumps(health_data, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+@event.listens_for(OrmSession, "after_commit")
+def _remember_committed_keys(session: OrmSession) -> None:
+    for key in session.info.pop("health_snapshot_keys", ()):
+        _recent_keys[key] = None
+        _recent_keys.move_to_end(key)
+        if len(_recent_keys) > RECENT_KEYS_SIZE:
+            _recent_keys.popitem(last=False)
+
+
+@event.listens_for(OrmSession, "after_rollback")
+def _discard_uncommitted_keys(session: OrmSession) -> None:
+    session.info.pop("health_snapshot_keys", None)
+
+
+async def store_health_snapshot(session: AsyncSession, health_data: dict | None) -> str | None:
+    """
+    Stores a health_data payload if it isn't stored yet and returns its key.
+    The caller owns the transaction.
+    """
+    if not health_data:
+        return None
+
+    key = snapshot_key(health_data)
+    if key in _recent_keys:
+        _recent_keys.move_to_end(key)
+        return key
+
+    stmt = insert(HealthSnapshot).values(id=key, health_data=health_data)
+    await session.execute(stmt.on_conflict_do_nothing(index_elements=["id"]))
+    session.info.setdefault("health_snapshot_keys", []).append(key)
+    return key
+
+
+def compact_chat_messages(batch_size: int = COMPACTION_BATCH_SIZE) -> int:
+    """
+    Moves inline ChatMessage.health_data payloads into health_snapshot,
+    one committed batch at a time so it can run against a live database
+    and be resumed. Returns the number of messages rewritten.
+    """
+    chat_table = ChatMessage.__table__
+    rewrite = (
+        update(chat_table)
+        .where(chat_table.c.id == bindparam("message_id"))
+        .values(health_snapshot_id=bindparam("snapshot_id"), health_data=null())
+    )
+
+    last_id = 0
+    compacted = 0
+    while True:
+        with Session(get_engine()) as session:
+            rows = session.exec(
+                select(ChatMessage.id, ChatMessage.health_data)
+                .where(ChatMessage.id > last_id, func.jsonb_typeof(ChatMessage.health_data) == "object")
+                .order_by(ChatMessage.id)
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                break
+
+            snapshots = {}
+            updates = []
+            for row in rows:
+                key = snapshot_key(row.health_data)
+                snapshots[key] = row.health_data
+                updates.append({"message_id": row.id, "snapshot_id": key})
+
+            session.execute(
+                insert(HealthSnapshot)
+                .values([{"id": key, "health_data": data} for key, data in snapshots.items()])
+                .on_conflict_do_nothing(index_elements=["id"])
+            )
+            session.connection().execute(rewrite, updates)
+            session.commit()
+
+        last_id = rows[-1].id
+        compacted += len(rows)
+        logger.info(f"Compacted {compacted} chat messages (up to id {last_id})")
+
+    return compacted
+
+
+def vacuum_chat_messages(full: bool = False) -> None:
+    """
+    Plain VACUUM makes the freed space reusable. VACUUM FULL gives it back
+    to the operating system but locks the table while it rewrites it.
+    """
+    with get_engine().connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("VACUUM (FULL, ANALYZE) chatmessage" if full else "VACUUM (ANALYZE) chatmessage"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=COMPACTION_BATCH_SIZE)
+    parser.add_argument("--vacuum-full", action="store_true")
+    args = parser.parse_args()
+
+    compacted = compact_chat_messages(args.batch_size)
+    logger.info(f"Moved health data of {compacted} chat messages into health_snapshot")
+    vacuum_chat_messages(full=args.vacuum_full)
@@ -0,0 +1,125 @@
+"""
+locations.py
+
+Batched and coalesced writes of GPS fixes.
+
+Fixes posted one at a time are collected in a per-worker buffer and
+written with a single multi-row INSERT once LOCATION_BUFFER_MAX_SIZE fixes
+are waiting or LOCATION_BUFFER_MAX_DELAY_SECONDS have passed, so a phone
+reporting every few seconds no longer costs a commit per fix. Each fix
+keeps the time it was received. Buffered fixes become visible to readers
+(e.g. the recent locations in /chat) at most one delay later.
+"""
+
+import asyncio
+import logging
+import os
+from datetime import UTC, datetime
+
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from .models import UserLocation, get_async_engine
+
+logger = logging.getLogger("app")
+
+MAX_BUFFER_SIZE = int(os.getenv("LOCATION_BUFFER_MAX_SIZE", 200))
+# 0 disables coalescing and writes every fix immediately
+MAX_BUFFER_DELAY = float(os.getenv("LOCATION_BUFFER_MAX_DELAY_SECONDS", 2.0))
+
+
+def location_row(user_id: int, latitude: float, longitude: float, accuracy: float | None,
+                 recorded_at: datetime | None = None) -> dict:
+    return {
+        "user_id": user_id,
+        "latitude": latitude,
+        "longitude": longitude,
+        "accuracy": accuracy,
+        "created_at": recorded_at or datetime.now(UTC),
+    }
+
+
+async def insert_locations(session: AsyncSession, rows: list[dict]) -> None:
+    """
+    Inserts any number of fixes in a single statement. The caller owns the
+    transaction.
+    """
+    if rows:
+        await session.execute(insert(UserLocation).values(rows))
+
+
+class LocationWriteBuffer:
+    """
+    Collects location rows and writes them in batches.
+
+    A failed flush puts its rows back so the next flush retries them; at
+    most max_pending rows are kept, dropping the oldest beyond that.
+    """
+
+    def __init__(self, max_size: int = MAX_BUFFER_SIZE, max_delay: float = MAX_BUFFER_DELAY):
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.max_pending = max_size * 10
+        self._rows: list[dict] = []
+        self._lock = asyncio.Lock()
+        self._stopped = asyncio.Event()
+        self._flusher: asyncio.Task | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_delay > 0
+
+    def start(self) -> None:
+        if self.enabled and self._flusher is None:
+            self._stopped.clear()
+            self._flusher = asyncio.create_task(self._flush_periodically())
+
+    async def stop(self) -> None:
+        """
+        Stops the periodic flush and writes out whatever is still buffered.
+        """
+        if self._flusher is not None:
+            self._stopped.set()
+            await self._flusher
+            self._flusher = None
+        await self.flush()
+
+    async def add(self, row: dict) -> None:
+        self.start()
+        self._rows.append(row)
+        if len(self._rows) >= self.max_size:
+            await self.flush()
+
+    async def flush(self) -> int:
+        """
+        Writes everything buffered so far. Returns the number of rows written.
+        """
+        async with self._lock:
+            rows, self._rows = self._rows, []
+            if not rows:
+                return 0
+            try:
+                async with AsyncSession(get_async_engine()) as session:
+                    await insert_locations(session, rows)
+                    await session.commit()
+            except Exception as e:
+                # the message would carry the bound coordinates
+                logger.warning(f"Error flushing {len(rows)} buffered locations ({type(e).__name__}), will retry")
+                self._rows[:0] = rows
+                overflow = len(self._rows) - self.max_pending
+                if overflow > 0:
+                    logger.error(f"Location buffer full, dropping {overflow} oldest locations")
+                    del self._rows[:overflow]
+                return 0
+        return len(rows)
+
+    async def _flush_periodically(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                await asyncio.wait_for(self._stopped.wait(), timeout=self.max_delay)
+            except TimeoutError:
+                pass
+            await self.flush()
+
+
+location_buffer = LocationWriteBuffer()
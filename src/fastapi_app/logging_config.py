@@ -0,0 +1,202 @@
+"""
+logging_config.py
+
+Structured, non-blocking logging for the "app" logger.
+
+Records are handed to a QueueHandler, which only copies them onto a
+queue; a QueueListener thread formats them as JSON lines and writes them
+to stdout, so neither formatting nor I/O happens on the event loop. Each
+line carries the request id of the request that logged it (from the
+X-Request-ID header, or generated by RequestIdMiddleware) and echoes it
+in the response.
+
+Health, GPS and message content never reach the logs: any value under a
+key in REDACTED_KEYS, in `extra` fields or in dict/list arguments, is
+replaced with "[redacted]" (lists keep their length). Log such data as
+`extra` rather than formatting it into the message.
+
+DEBUG records are kept for a LOG_DEBUG_SAMPLE_RATE fraction (default
+0.01) of requests, all or nothing per request, so LOG_LEVEL=DEBUG can be
+left on under load.
+
+Sampling and redaction are filters on the logger itself, so they apply
+to every handler on it, including the one Azure Monitor adds (see
+telemetry.py), not just to the JSON output.
+"""
+
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import uuid
+import zlib
+from contextvars import ContextVar
+from datetime import UTC, datetime
+from typing import Any
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", 0.01))
+REQUEST_ID_HEADER = "x-request-id"
+
+REDACTED_KEYS = {
+    "health_data", "gps_data", "content", "messages", "final_output", "summary",
+    "latitude", "longitude", "accuracy",
+    "bodyFat", "heartRate", "stepCount", "activeEnergy", "flightsClimbed", "sleep",
+}
+
+request_id_var: ContextVar[str | None] = ContextVar("request_id", default=None)
+
+# attributes every LogRecord has; anything else came in through extra
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "request_id"}
+
+_listener: logging.handlers.QueueListener | None = None
+
+
+def redact(value: Any, key: str | None = None) -> Any:
+    if key in REDACTED_KEYS:
+        if isinstance(value, (list, tuple)):
+            return f"[redacted: {len(value)} items]"
+        return "[redacted]" if value is not None else None
+    if isinstance(value, dict):
+        return {k: redact(v, k) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(v) for v in value]
+    return value
+
+
+class RedactionFilter(logging.Filter):
+    """
+    Redacts the record's arguments and `extra` fields in place, before any
+    handler sees them.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if isinstance(record.args, dict):
+            record.args = redact(record.args)
+        elif record.args:
+            record.args = tuple(redact(arg) for arg in record.args)
+        for key, value in list(vars(record).items()):
+            if key not in _RECORD_ATTRIBUTES:
+                setattr(record, key, redact(value, key))
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per record; the `extra` fields become top-level keys.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "timestamp": datetime.fromtimestamp(record.created, UTC).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class RequestContextFilter(logging.Filter):
+    """
+    Tags records with the current request id and samples DEBUG records.
+    Runs where the record is logged, while the request's context is current.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        request_id = request_id_var.get()
+        record.request_id = request_id
+        if record.levelno > logging.DEBUG or DEBUG_SAMPLE_RATE >= 1:
+            return True
+        if request_id is None:
+            return random.random() < DEBUG_SAMPLE_RATE
+        return zlib.crc32(request_id.encode()) % 10000 < DEBUG_SAMPLE_RATE * 10000
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queues records as they are; the stock QueueHandler would format the
+    message first, on the caller's thread.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return copy.copy(record)
+
+
+def configure_logging(logger_name: str = "app") -> None:
+    """
+    Routes the logger through the queue to JSON on stdout. Safe to call
+    more than once.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter())
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+    logger = logging.getLogger(logger_name)
+    logger.setLevel(LOG_LEVEL)
+    # sampling first, so dropped records aren't redacted for nothing
+    logger.filters = [RequestContextFilter(), RedactionFilter()]
+    logger.handlers = [DeferredQueueHandler(log_queue)]
+    # the root logger's handlers would write every record a second time, unformatted
+    logger.propagate = False
+
+
+def stop_logging() -> None:
+    """
+    Writes out the queued records and stops the listener thread.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+class RequestIdMiddleware:
+    """
+    Makes the request id (X-Request-ID, or a new one) current for the
+    request and returns it in the response.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope["headers"]:
+            if name == REQUEST_ID_HEADER.encode():
+                request_id = value.decode("latin-1")[:64]
+                break
+        request_id = request_id or uuid.uuid4().hex
+        token = request_id_var.set(request_id)
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                header = (REQUEST_ID_HEADER.encode(), request_id.encode("latin-1"))
+                message["headers"] = [*message.get("headers", []), header]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            request_id_var.reset(token)
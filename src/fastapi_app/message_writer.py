@@ -0,0 +1,307 @@
+"""
+message_writer.py
+
+Write-behind persistence of chat messages.
+
+/chat hands its ChatMessage rows to a per-worker writer instead of
+committing them before replying. The writer inserts them in batches once
+CHAT_WRITER_MAX_BATCH_SIZE rows are waiting or
+CHAT_WRITER_MAX_DELAY_SECONDS have passed.
+
+Every queued row is first appended to a local spool segment file
+(CHAT_SPOOL_DIR). A segment is deleted only once its rows are committed,
+so rows survive a failed flush or a crashed worker: leftover segments of
+dead workers are replayed when a worker starts. Delivery is therefore
+at-least-once; a crash between the commit and the segment deletion
+replays that batch a second time.
+
+While the database is unreachable, failed batches are retried as a whole
+and at most CHAT_WRITER_MAX_PENDING rows are kept, dropping the oldest
+beyond that. A batch that fails for any other reason (a row the table
+rejects) is retried row by row, and rows that still fail are moved to the
+dead-letter spool (CHAT_DEAD_LETTER_DIR), so one bad row can't hold up
+the others.
+"""
+
+import asyncio
+import glob
+import json
+import logging
+import os
+import tempfile
+from datetime import UTC, datetime
+from typing import Any
+
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from .models import ChatMessage, get_async_engine
+
+logger = logging.getLogger("app")
+
+SPOOL_DIR = os.getenv("CHAT_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "chat_spool"))
+MAX_BATCH_SIZE = int(os.getenv("CHAT_WRITER_MAX_BATCH_SIZE", 100))
+MAX_DELAY = float(os.getenv("CHAT_WRITER_MAX_DELAY_SECONDS", 0.5))
+MAX_PENDING = int(os.getenv("CHAT_WRITER_MAX_PENDING", 10_000))
+DEAD_LETTER_DIR = os.getenv("CHAT_DEAD_LETTER_DIR", os.path.join(SPOOL_DIR, "dead-letter"))
+
+
+def message_row(
+    user_id: int,
+    role: str,
+    content: str,
+    health_snapshot_id: str | None = None,
+    gps_data: dict[str, Any] | None = None,
+) -> dict:
+    # timestamped when queued, so history order doesn't depend on flush order
+    return {
+        "user_id": user_id,
+        "role": role,
+        "content": content,
+        "health_snapshot_id": health_snapshot_id,
+        "gps_data": gps_data,
+        "created_at": datetime.now(UTC),
+    }
+
+
+def _encode_row(row: dict, **fields) -> str:
+    return json.dumps({**row, "created_at": row["created_at"].isoformat(), **fields}) + "\n"
+
+
+def _decode_row(line: str) -> dict:
+    row = json.loads(line)
+    row["created_at"] = datetime.fromisoformat(row["created_at"])
+    return row
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+async def insert_messages(rows: list[dict]) -> None:
+    async with AsyncSession(get_async_engine()) as session:
+        await session.execute(insert(ChatMessage).values(rows))
+        await session.commit()
+
+
+def is_transient(error: Exception) -> bool:
+    """
+    Whether an insert failed because of the database (unreachable,
+    restarting, pool exhausted) rather than because of the rows.
+    """
+    if isinstance(error, DBAPIError) and error.connection_invalidated:
+        return True
+    return isinstance(error, (OperationalError, InterfaceError, PoolTimeoutError, OSError, TimeoutError))
+
+
+class ChatMessageWriter:
+    """
+    Batches ChatMessage inserts off the response path, backed by a spool.
+    """
+
+    def __init__(self, spool_dir: str = SPOOL_DIR, max_batch_size: int = MAX_BATCH_SIZE,
+                 max_delay: float = MAX_DELAY, max_pending: int = MAX_PENDING,
+                 dead_letter_dir: str = DEAD_LETTER_DIR):
+        self.spool_dir = spool_dir
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.dead_letter_dir = dead_letter_dir
+        self._pending: list[dict] = []
+        self._in_flight: list[dict] = []
+        # segments whose rows are all in _pending
+        self._pending_segments: list[str] = []
+        self._segment_file = None
+        self._segment_path: str | None = None
+        self._segment_number = 0
+        self._lock = asyncio.Lock()
+        self._wake = asyncio.Event()
+        self._stopped = asyncio.Event()
+        self._flusher: asyncio.Task | None = None
+
+    def pending_for(self, user_id: int) -> list[dict]:
+        """
+        Rows for a user that are queued but not committed yet, oldest first.
+        """
+        return [row for row in self._in_flight + self._pending if row["user_id"] == user_id]
+
+    def _new_segment_path(self) -> str:
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self._segment_number += 1
+        return os.path.join(self.spool_dir, f"{os.getpid()}-{self._segment_number}.ndjson")
+
+    def enqueue(self, row: dict) -> None:
+        if self._segment_file is None:
+            self._segment_path = self._new_segment_path()
+            self._segment_file = open(self._segment_path, "a")
+
+        self._segment_file.write(_encode_row(row))
+        self._segment_file.flush()
+        self._pending.append(row)
+
+        self.start()
+        if len(self._pending) >= self.max_batch_size:
+            self._wake.set()
+
+    def _close_segment(self) -> None:
+        if self._segment_file is not None:
+            self._segment_file.close()
+            self._pending_segments.append(self._segment_path)
+            self._segment_file = None
+            self._segment_path = None
+
+    def _dead_letter(self, row: dict, error: Exception) -> None:
+        os.makedirs(self.dead_letter_dir, exist_ok=True)
+        with open(os.path.join(self.dead_letter_dir, f"{os.getpid()}.ndjson"), "a") as f:
+            f.write(_encode_row(row, error=type(error).__name__))
+
+    async def _write(self, rows: list[dict]) -> list[dict]:
+        """
+        Inserts rows in one batch, or row by row if the batch fails for a
+        reason other than the database, dead-lettering the rows that still
+        fail. Returns the rows to retry later, oldest first.
+        """
+        # errors are logged by type only: their text includes the rows
+        try:
+            await insert_messages(rows)
+            return []
+        except Exception as e:
+            if is_transient(e):
+                logger.warning(f"Error writing {len(rows)} chat messages ({type(e).__name__}), will retry")
+                return rows
+            logger.warning(f"Error writing {len(rows)} chat messages ({type(e).__name__}), writing them one by one")
+
+        for i, row in enumerate(rows):
+            try:
+                await insert_messages([row])
+            except Exception as e:
+                if is_transient(e):
+                    return rows[i:]
+                logger.error(
+                    f"Chat message of user {row['user_id']} can't be written ({type(e).__name__}), "
+                    f"moving it to {self.dead_letter_dir}"
+                )
+                self._dead_letter(row, e)
+        return []
+
+    def _rewrite_segments(self, rows: list[dict], segments: list[str]) -> list[str]:
+        """
+        Replaces segments with one holding only rows, once the others were
+        written, dead-lettered or dropped.
+        """
+        path = self._new_segment_path()
+        # written under a name replay_spool() ignores until it is complete
+        partial = path.removesuffix(".ndjson") + ".partial"
+        with open(partial, "w") as f:
+            f.writelines(_encode_row(row) for row in rows)
+        os.replace(partial, path)
+        for segment in segments:
+            os.remove(segment)
+        return [path]
+
+    async def flush(self) -> int:
+        """
+        Commits everything queued so far. Returns the number of rows written.
+        """
+        async with self._lock:
+            self._close_segment()
+            rows, self._pending = self._pending, []
+            segments, self._pending_segments = self._pending_segments, []
+            retry = []
+            if rows:
+                self._in_flight = rows
+                try:
+                    retry = await self._write(rows)
+                finally:
+                    self._in_flight = []
+
+            # rows queued during the write count towards the limit too
+            overflow = len(retry) + len(self._pending) - self.max_pending
+            if retry and overflow > 0:
+                logger.error(f"Chat message queue full, dropping {min(overflow, len(retry))} oldest messages")
+                retry = retry[overflow:]
+            if not retry:
+                for segment in segments:
+                    os.remove(segment)
+                return len(rows)
+
+            if len(retry) < len(rows):
+                segments = self._rewrite_segments(retry, segments)
+            self._pending[:0] = retry
+            self._pending_segments[:0] = segments
+            return 0
+
+    async def replay_spool(self) -> int:
+        """
+        Writes the rows of segments left behind by workers that are no
+        longer running. Returns the number of rows replayed.
+        """
+        replayed = 0
+        for path in glob.glob(os.path.join(self.spool_dir, "*.ndjson*")):
+            # segments are named <pid>-<n>.ndjson, and <pid>-<n>.ndjson.replay-<pid> once claimed
+            segment, _, claimed_by = path.partition(".replay-")
+            owner = int(claimed_by or os.path.basename(segment).split("-")[0])
+            if owner == os.getpid() or _pid_alive(owner):
+                continue
+
+            # claim it, so only one starting worker replays each segment
+            claimed = f"{segment}.replay-{os.getpid()}"
+            try:
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                continue
+
+            with open(claimed) as f:
+                rows = [_decode_row(line) for line in f if line.strip()]
+            retry = await self._write(rows) if rows else []
+            if retry:
+                logger.warning(f"Could not replay {len(retry)} rows of {segment}, leaving them in place")
+                if len(retry) < len(rows):
+                    with open(claimed, "w") as f:
+                        f.writelines(_encode_row(row) for row in retry)
+                os.rename(claimed, segment)
+                continue
+            os.remove(claimed)
+            replayed += len(rows)
+
+        if replayed:
+            logger.info(f"Replayed {replayed} spooled chat messages")
+        return replayed
+
+    def start(self) -> None:
+        if self._flusher is None:
+            self._stopped.clear()
+            self._flusher = asyncio.create_task(self._flush_periodically())
+
+    async def stop(self) -> None:
+        """
+        Stops the background flush and drains the queue. Rows that still
+        can't be written stay in the spool for the next worker.
+        """
+        if self._flusher is not None:
+            self._stopped.set()
+            self._wake.set()
+            await self._flusher
+            self._flusher = None
+        await self.flush()
+        self._close_segment()
+
+    async def _flush_periodically(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.max_delay)
+            except TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+
+chat_writer = ChatMessageWriter()
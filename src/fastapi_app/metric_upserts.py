@@ -0,0 +1,150 @@
+"""
+metric_upserts.py
+
+Bulk upserts of the daily health metrics sent by the client.
+
+Each metric table gets a single multi-row INSERT ... ON CONFLICT DO UPDATE
+statement instead of one statement per day. The same statement reports
+what it changed, which keeps the rollups (see rollups.py) current, so per
+table a payload costs:
+
+    advisory lock   - serializes the rollup writers of the user's metric
+    upsert          - the raw rows
+    rollup select   - the buckets the changed rows fall in, if any changed
+    rollup upsert   - their new aggregates, if any changed
+
+plus one recompute per bucket a delta can't update. A 7-day window of
+five metrics takes 10 to 20 round trips instead of ~35, and the usual
+resend of an unchanged window stops at 10.
+"""
+
+from collections.abc import Callable
+from datetime import datetime
+from typing import Any, NamedTuple
+
+from sqlalchemy import literal_column
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel import SQLModel, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from .models import ActiveEnergy, BodyFat, FlightsClimbed, HeartRate, Sleep, StepCount
+from .rollups import MetricChange, apply_metric_changes, lock_user_metric
+
+
+class MetricSpec(NamedTuple):
+    model: type[SQLModel]
+    column: str
+    cast: Callable[[Any], Any]
+    constraint: str
+
+
+# health_data key -> how the daily items are stored
+METRIC_SPECS: dict[str, MetricSpec] = {
+    "heartRate": MetricSpec(HeartRate, "bpm", float, "uq_heart_user_date"),
+    "stepCount": MetricSpec(StepCount, "steps", int, "uq_step_user_date"),
+    "activeEnergy": MetricSpec(ActiveEnergy, "kcal", float, "uq_energy_user_date"),
+    "flightsClimbed": MetricSpec(FlightsClimbed, "flights", int, "uq_flights_user_date"),
+    "sleep": MetricSpec(Sleep, "duration_hours", float, "uq_sleep_user_date"),
+}
+
+
+def build_metric_rows(user_id: int, items: Any, spec: MetricSpec) -> list[dict]:
+    """
+    Turns the client's list of {"date": ..., "value": ...} items into rows.
+
+    Malformed items are skipped. If the same date appears more than once,
+    the last value wins, which is also required because Postgres refuses to
+    update the same row twice in one ON CONFLICT statement.
+    """
+    rows: dict[datetime, dict] = {}
+    for item in items or []:
+        if not isinstance(item, dict):
+            continue
+        if "value" not in item or "date" not in item:
+            continue
+
+        recorded_at = datetime.strptime(item["date"], "%Y-%m-%d")
+        rows[recorded_at] = {
+            "user_id": user_id,
+            spec.column: spec.cast(item["value"]),
+            "recorded_at": recorded_at,
+        }
+    return list(rows.values())
+
+
+async def upsert_metric_rows(session: AsyncSession, spec: MetricSpec, rows: list[dict]) -> int:
+    """
+    Upserts all rows for one metric table in a single statement and folds
+    the changes into the rollups. Days whose value didn't change are left
+    alone. Returns the number of rows written.
+    """
+    if not rows:
+        return 0
+
+    table = spec.model.__table__
+    user_id = rows[0]["user_id"]
+    await lock_user_metric(session, table.name, user_id)
+
+    column = table.c[spec.column]
+    # every CTE sees the snapshot from before the upsert, so this is the value each update replaces
+    old = (
+        select(table.c.recorded_at, column.label("old_value"))
+        .where(table.c.user_id == user_id, table.c.recorded_at.in_([row["recorded_at"] for row in rows]))
+        .cte("old")
+    )
+    stmt = insert(spec.model).values(rows)
+    upserted = stmt.on_conflict_do_update(
+        constraint=spec.constraint,
+        set_={spec.column: stmt.excluded[spec.column]},
+        # the client resends the same window every turn
+        where=column.is_distinct_from(stmt.excluded[spec.column]),
+    ).returning(
+        table.c.recorded_at,
+        column.label("new_value"),
+        # xmax is 0 for freshly inserted rows
+        literal_column("(xmax = 0)").label("inserted"),
+    ).cte("upserted")
+
+    result = await session.execute(
+        select(upserted.c.recorded_at, upserted.c.new_value, old.c.old_value, upserted.c.inserted)
+        .select_from(upserted.outerjoin(old, old.c.recorded_at == upserted.c.recorded_at))
+    )
+    changes = [MetricChange(*row) for row in result.all()]
+    await apply_metric_changes(session, table.name, user_id, changes)
+    return len(changes)
+
+
+async def upsert_health_metrics(session: AsyncSession, user_id: int, health_data: dict | None) -> int:
+    """
+    Stores every metric found in a health_data payload.
+
+    The caller owns the transaction. Returns the number of metric upserts
+    issued, not counting the lock and rollup statements around them.
+    """
+    if not health_data:
+        return 0
+
+    statements = 0
+    for key, spec in METRIC_SPECS.items():
+        rows = build_metric_rows(user_id, (health_data.get(key) or {}).get("daily", []), spec)
+        if rows:
+            await upsert_metric_rows(session, spec, rows)
+            statements += 1
+
+    if health_data.get("bodyFat") is not None:
+        body_fat = BodyFat(
+            user_id=user_id,
+            percentage=float(health_data["bodyFat"]),
+            recorded_at=datetime.utcnow(),
+        )
+        await lock_user_metric(session, BodyFat.__tablename__, user_id)
+        session.add(body_fat)
+        await apply_metric_changes(
+            session,
+            BodyFat.__tablename__,
+            user_id,
+            [MetricChange(body_fat.recorded_at, body_fat.percentage, None, True)],
+        )
+        statements += 1
+
+    return statements
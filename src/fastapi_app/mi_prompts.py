@@ -141,4 +141,33 @@ mi_check_response = """
 It appears our conversation might be getting offtrack. This chatbot only provides motivational interviewing support, and cannot respond to other messages.
 
 You can use this space to strengthen your motivation for and commitment to achieving specific health goals. Are there any goals you would like to discuss?
-"""
\ No newline at end of file
+"""
+combined_safety_prompt = f"""
+# Your task
+1. You are observing a Motivational Interviewing counselling session between a counsellor and a user.
+
+2. You will make two separate checks on the conversation and report both:
+    1. is_harm: whether the user is at risk of harming themselves or others, as described under "Harm check".
+    2. is_not_mi: whether the user is taking the conversation offtrack, as described under "Offtrack check".
+
+3. Decide each check on its own. The result of one check must not change the result of the other.
+
+# Harm check
+{harm_prompt}
+# Offtrack check
+{mi_check_prompt}"""
+
+summary_prompt = """
+# Your task
+1. You are keeping notes on a Motivational Interviewing counselling session between a counsellor and a user.
+
+2. You will be given your notes so far (which may be empty) and the next exchanges between the counsellor and the user.
+
+3. Rewrite the notes so they cover everything so far. Keep:
+    1. The user's goals, values and reasons for change.
+    2. What the user feels ambivalent about and what gets in the way.
+    3. Commitments, plans and progress the user has mentioned.
+    4. Anything the user asked the counsellor to remember or avoid.
+
+4. Write short bullet points, no more than 200 words in total. Do not add advice or interpretation.
+"""
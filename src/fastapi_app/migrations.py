@@ -0,0 +1,238 @@
+"""
+migrations.py
+
+Versioned schema migrations, applied in place to an existing database.
+
+Applied versions are recorded in the schema_migrations table. A fresh
+database is created from the current models and stamped with every
+version; an existing database without schema_migrations is treated as
+being at the baseline (version 1) and gets the remaining migrations.
+
+Migrations marked non-transactional run in autocommit mode, which is
+what CREATE INDEX CONCURRENTLY needs so indexes can be added to tables
+that are written on every chat without blocking those writes.
+
+Every run finishes by creating upcoming metric partitions (see
+partitions.py). Run with:
+
+    python3 src/fastapi_app/migrations.py
+"""
+
+import logging
+from collections.abc import Callable
+from typing import NamedTuple
+
+from sqlalchemy import Connection, Engine, inspect, text
+from sqlmodel import SQLModel
+
+from fastapi_app.models import ConversationSummary, HealthSnapshot, MetricRollup, get_engine
+from fastapi_app.partitions import PARTITIONED_MODELS, ensure_partitions, maintain_partitions
+from fastapi_app.rollups import rebuild_rollups
+
+logger = logging.getLogger("app")
+
+# arbitrary key so only one process migrates at a time
+MIGRATION_LOCK_KEY = 73012025
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    apply: Callable[[Connection], None]
+    transactional: bool = True
+
+
+MIGRATIONS: list[Migration] = []
+
+
+def migration(version: int, description: str, transactional: bool = True):
+    """
+    Registers a function as a migration step.
+    """
+    def register(fn: Callable[[Connection], None]):
+        MIGRATIONS.append(Migration(version, description, fn, transactional))
+        return fn
+    return register
+
+
+def create_index_concurrently(conn: Connection, name: str, definition: str) -> None:
+    """
+    Builds an index without blocking writes. A previous failed concurrent
+    build leaves an INVALID index behind, which is dropped and rebuilt.
+    """
+    invalid = conn.execute(
+        text(
+            "SELECT 1 FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid "
+            "WHERE c.relname = :name AND NOT i.indisvalid"
+        ),
+        {"name": name},
+    ).first()
+    if invalid:
+        logger.info(f"Dropping invalid index {name} left by an earlier build")
+        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+
+    conn.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}"))
+
+
+@migration(1, "baseline schema")
+def baseline(conn: Connection) -> None:
+    SQLModel.metadata.create_all(conn)
+
+
+@migration(2, "composite indexes for location and chat history lookups", transactional=False)
+def history_indexes(conn: Connection) -> None:
+    create_index_concurrently(conn, "ix_userlocation_user_created", "userlocation (user_id, created_at DESC)")
+    create_index_concurrently(conn, "ix_chatmessage_user_created_id", "chatmessage (user_id, created_at, id)")
+
+
+@migration(3, "partition metric tables by month")
+def partition_metric_tables(conn: Connection) -> None:
+    """
+    Rebuilds each metric heap table as a partitioned table and copies the
+    rows over. Holds an exclusive lock on each table while copying, so run
+    it when traffic is low.
+    """
+    for model in PARTITIONED_MODELS:
+        table = model.__tablename__
+        relkind = conn.execute(text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:t)"), {"t": table}).scalar()
+        if relkind != "r":
+            continue
+
+        legacy = f"{table}_legacy"
+        conn.execute(text(f"ALTER TABLE {table} RENAME TO {legacy}"))
+
+        # free up the index, constraint and sequence names for the new table
+        index_names = conn.execute(
+            text("SELECT indexname FROM pg_indexes WHERE tablename = :t"), {"t": legacy}
+        ).scalars().all()
+        for index_name in index_names:
+            conn.execute(text(f"ALTER INDEX {index_name} RENAME TO {index_name}_legacy"))
+        sequence = conn.execute(text("SELECT pg_get_serial_sequence(:t, 'id')"), {"t": legacy}).scalar()
+        if sequence:
+            conn.execute(text(f"ALTER SEQUENCE {sequence} RENAME TO {legacy}_id_seq"))
+
+        model.__table__.create(conn)
+        first, last = conn.execute(text(f"SELECT min(recorded_at), max(recorded_at) FROM {legacy}")).one()
+        if first is not None:
+            ensure_partitions(conn, first.date(), last.date())
+
+        columns = ", ".join(column.name for column in model.__table__.columns)
+        conn.execute(text(f"INSERT INTO {table} ({columns}) SELECT {columns} FROM {legacy}"))
+        conn.execute(
+            text(
+                f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                f"coalesce((SELECT max(id) FROM {table}), 0) + 1, false)"
+            )
+        )
+        conn.execute(text(f"DROP TABLE {legacy}"))
+        logger.info(f"Partitioned {table}")
+
+
+@migration(4, "content-addressed health snapshots for chat messages")
+def health_snapshots(conn: Connection) -> None:
+    HealthSnapshot.__table__.create(conn, checkfirst=True)
+    conn.execute(text("ALTER TABLE chatmessage ADD COLUMN IF NOT EXISTS health_snapshot_id varchar(64)"))
+
+
+@migration(5, "rolling conversation summaries")
+def conversation_summaries(conn: Connection) -> None:
+    ConversationSummary.__table__.create(conn, checkfirst=True)
+
+
+@migration(6, "weekly and monthly metric rollups")
+def metric_rollups(conn: Connection) -> None:
+    MetricRollup.__table__.create(conn, checkfirst=True)
+    rebuild_rollups(conn)
+
+
+@migration(7, "conversation summary cursor by (created_at, id)")
+def summary_keyset(conn: Connection) -> None:
+    conn.execute(
+        text("ALTER TABLE conversationsummary ADD COLUMN IF NOT EXISTS last_message_created_at timestamptz")
+    )
+    conn.execute(
+        text(
+            "UPDATE conversationsummary s SET last_message_created_at = m.created_at "
+            "FROM chatmessage m WHERE m.id = s.last_message_id"
+        )
+    )
+    # the summarized message is gone, so the cursor can't be placed; the summary is rebuilt on the next chat
+    conn.execute(text("DELETE FROM conversationsummary WHERE last_message_created_at IS NULL"))
+    conn.execute(text("ALTER TABLE conversationsummary ALTER COLUMN last_message_created_at SET NOT NULL"))
+
+
+def _applied_versions(conn: Connection) -> set[int]:
+    conn.execute(
+        text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "version integer PRIMARY KEY, "
+            "description text NOT NULL, "
+            "applied_at timestamptz NOT NULL DEFAULT now())"
+        )
+    )
+    return set(conn.execute(text("SELECT version FROM schema_migrations")).scalars())
+
+
+def _record(conn: Connection, step: Migration) -> None:
+    conn.execute(
+        text("INSERT INTO schema_migrations (version, description) VALUES (:version, :description)"),
+        {"version": step.version, "description": step.description},
+    )
+
+
+def run_migrations(db_engine: Engine | None = None) -> list[int]:
+    """
+    Applies all pending migrations in version order and returns the
+    versions that were applied.
+    """
+    db_engine = db_engine or get_engine()
+    steps = sorted(MIGRATIONS, key=lambda m: m.version)
+    applied_now = []
+
+    # autocommit, so this connection never holds a snapshot that a
+    # concurrent index build would have to wait for
+    with db_engine.connect().execution_options(isolation_level="AUTOCOMMIT") as lock_conn:
+        lock_conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+        try:
+            applied = _applied_versions(lock_conn)
+
+            if not applied:
+                if inspect(lock_conn).has_table("chatmessage"):
+                    logger.info("Existing database without migration history, stamping baseline")
+                    _record(lock_conn, steps[0])
+                    applied = {steps[0].version}
+                else:
+                    logger.info("Fresh database, creating schema from models")
+                    with db_engine.begin() as conn:
+                        SQLModel.metadata.create_all(conn)
+                        for step in steps:
+                            _record(conn, step)
+                    applied = {step.version for step in steps}
+                    applied_now = sorted(applied)
+
+            for step in steps:
+                if step.version in applied:
+                    continue
+
+                logger.info(f"Applying migration {step.version}: {step.description}")
+                if step.transactional:
+                    with db_engine.begin() as conn:
+                        step.apply(conn)
+                        _record(conn, step)
+                else:
+                    with db_engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                        step.apply(conn)
+                        _record(conn, step)
+                applied_now.append(step.version)
+
+            with db_engine.begin() as conn:
+                maintain_partitions(conn)
+        finally:
+            lock_conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_LOCK_KEY})
+
+    return applied_now
+
+
+if __name__ == "__main__":
+    applied = run_migrations()
+    logger.info(f"Applied migrations: {applied}" if applied else "Database schema is up to date")
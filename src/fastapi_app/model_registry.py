@@ -0,0 +1,268 @@
+"""
+model_registry.py
+
+Which model each agent role uses, and what each role costs.
+
+Roles:
+
+    main       - the MI agent
+    guardrail  - the harm, MI check and combined safety classifiers
+    sensing    - the sensing sub-agent
+    summary    - the conversation summarizer
+
+Each role gets a deployment from AZURE_OPENAI_DEPLOYMENT_<ROLE> (e.g.
+AZURE_OPENAI_DEPLOYMENT_GUARDRAIL=gpt-4o-mini), falling back to
+AZURE_OPENAI_DEPLOYMENT and then gpt-4o, on AZURE_OPENAI_ENDPOINT.
+
+To spread roles over several endpoints set AZURE_OPENAI_BACKENDS to a
+JSON list of backends:
+
+    [
+        {"name": "eastus", "endpoint": "https://...", "api_key_env": "AZURE_OPENAI_API_KEY_EASTUS",
+         "deployments": {"main": "gpt-4o", "guardrail": "gpt-4o-mini"}, "tpm": 150000, "rpm": 900},
+        {"name": "stub", "base_url": "http://127.0.0.1:8010/v1", "deployment": "gpt-4o"}
+    ]
+
+A backend serves the roles listed in "deployments" (or every role with
+"deployment"); "base_url" talks to any OpenAI-compatible server, e.g. a
+local stub. Backends on the same endpoint share one client, and every
+deployment has its own rate limiter.
+
+Calls are counted per role (latency, tokens, errors), see
+model_role_stats(), and tokens are also exported as llm.tokens (see
+telemetry.py).
+"""
+
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from collections.abc import AsyncIterator
+from typing import Any
+
+from agents import Model, OpenAIChatCompletionsModel
+from dotenv import load_dotenv
+from openai import AsyncAzureOpenAI, AsyncOpenAI
+
+from fastapi_app.model_router import Backend, ModelRouter
+from fastapi_app.rate_limiter import PRIORITY_BACKGROUND, PRIORITY_GUARDRAIL, PRIORITY_MAIN, get_limiter
+from fastapi_app.telemetry import record_tokens
+
+load_dotenv()
+
+logger = logging.getLogger("app")
+
+API_VERSION = "2024-12-01-preview"
+DEFAULT_DEPLOYMENT = os.getenv("AZURE_OPENAI_DEPLOYMENT", "gpt-4o")
+
+ROLE_PRIORITIES = {
+    "main": PRIORITY_MAIN,
+    "guardrail": PRIORITY_GUARDRAIL,
+    "sensing": PRIORITY_MAIN,
+    "summary": PRIORITY_BACKGROUND,
+}
+LATENCY_WINDOW = 500
+
+# (endpoint or base_url, api_version) -> client
+_clients: dict[tuple[str, str], AsyncOpenAI] = {}
+# (backend name, deployment) -> backend, shared by every role using it
+_backends: dict[tuple[str, str], Backend] = {}
+_role_backends: dict[str, list[Backend]] | None = None
+_registry_lock = threading.Lock()
+
+
+def get_client(endpoint: str | None = None, api_key: str | None = None,
+               api_version: str = API_VERSION, base_url: str | None = None) -> AsyncOpenAI:
+    """
+    One client (and so one connection pool) per endpoint.
+    """
+    key = (base_url or endpoint, api_version)
+    client = _clients.get(key)
+    if client is None:
+        # the rate limiter retries instead (see rate_limiter.py), since it knows about the other callers
+        if base_url:
+            client = AsyncOpenAI(base_url=base_url, api_key=api_key or "stub", max_retries=0)
+        else:
+            client = AsyncAzureOpenAI(
+                api_version=api_version,
+                azure_endpoint=endpoint,
+                api_key=api_key,
+                max_retries=0,
+            )
+        _clients[key] = client
+    return client
+
+
+def _backend(name: str, client: AsyncOpenAI, deployment: str, rpm: int | None = None,
+             tpm: int | None = None) -> Backend:
+    key = (name, deployment)
+    if key not in _backends:
+        # Azure quotas are per deployment
+        backend_name = f"{name}/{deployment}"
+        _backends[key] = Backend(
+            backend_name,
+            OpenAIChatCompletionsModel(model=deployment, openai_client=client),
+            get_limiter(backend_name, rpm, tpm),
+        )
+    return _backends[key]
+
+
+def _load_role_backends() -> dict[str, list[Backend]]:
+    role_backends: dict[str, list[Backend]] = {role: [] for role in ROLE_PRIORITIES}
+
+    config = os.getenv("AZURE_OPENAI_BACKENDS")
+    if not config:
+        client = get_client(os.getenv("AZURE_OPENAI_ENDPOINT"), os.getenv("AZURE_OPENAI_API_KEY"))
+        for role in ROLE_PRIORITIES:
+            deployment = os.getenv(f"AZURE_OPENAI_DEPLOYMENT_{role.upper()}", DEFAULT_DEPLOYMENT)
+            role_backends[role].append(_backend("default", client, deployment))
+        return role_backends
+
+    for entry in json.loads(config):
+        api_key = os.getenv(entry["api_key_env"]) if "api_key_env" in entry else entry.get("api_key")
+        client = get_client(
+            entry.get("endpoint"), api_key, entry.get("api_version", API_VERSION), entry.get("base_url")
+        )
+        name = entry.get("name", entry.get("endpoint") or entry.get("base_url"))
+        deployments = entry.get("deployments") or {role: entry["deployment"] for role in ROLE_PRIORITIES}
+        for role, deployment in deployments.items():
+            role_backends[role].append(_backend(name, client, deployment, entry.get("rpm"), entry.get("tpm")))
+
+    missing = [role for role, backends in role_backends.items() if not backends]
+    if missing:
+        raise ValueError(f"AZURE_OPENAI_BACKENDS has no deployment for roles: {', '.join(missing)}")
+    return role_backends
+
+
+def role_backends() -> dict[str, list[Backend]]:
+    global _role_backends
+    with _registry_lock:
+        if _role_backends is None:
+            _role_backends = _load_role_backends()
+        return _role_backends
+
+
+class RoleStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.input_tokens = 0
+        self.cached_tokens = 0
+        self.output_tokens = 0
+        self.latencies: deque[float] = deque(maxlen=LATENCY_WINDOW)
+
+    def record(self, latency: float, usage: Any) -> None:
+        self.calls += 1
+        self.latencies.append(latency)
+        if usage is not None:
+            self.input_tokens += usage.input_tokens or 0
+            self.output_tokens += usage.output_tokens or 0
+            details = getattr(usage, "input_tokens_details", None)
+            self.cached_tokens += (getattr(details, "cached_tokens", 0) or 0) if details else 0
+
+    def as_dict(self) -> dict:
+        ordered = sorted(self.latencies)
+
+        def percentile(p: float) -> float | None:
+            return ordered[min(len(ordered) - 1, int(len(ordered) * p))] if ordered else None
+
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "input_tokens": self.input_tokens,
+            "cached_tokens": self.cached_tokens,
+            "output_tokens": self.output_tokens,
+            "latency_p50_seconds": percentile(0.5),
+            "latency_p95_seconds": percentile(0.95),
+        }
+
+
+_role_stats = {role: RoleStats() for role in ROLE_PRIORITIES}
+
+
+class RoleModel(Model):
+    """
+    Counts the latency and tokens of every call made for a role. The
+    role's backends (and their clients) are set up on the first call, so
+    building agents at import time doesn't touch the configuration.
+    """
+
+    def __init__(self, role: str, inner: Model | None = None):
+        self.role = role
+        self._inner = inner
+        self.stats = _role_stats[role]
+
+    @property
+    def inner(self) -> Model:
+        if self._inner is None:
+            self._inner = ModelRouter(role_backends()[self.role], ROLE_PRIORITIES[self.role])
+        return self._inner
+
+    async def get_response(self, *args, **kwargs):
+        started = time.monotonic()
+        try:
+            response = await self.inner.get_response(*args, **kwargs)
+        except Exception:
+            self.stats.errors += 1
+            raise
+        self.stats.record(time.monotonic() - started, response.usage)
+        record_tokens(self.role, response.usage)
+        return response
+
+    async def stream_response(self, *args, **kwargs) -> AsyncIterator[Any]:
+        started = time.monotonic()
+        usage = None
+        try:
+            async for event in self.inner.stream_response(*args, **kwargs):
+                if getattr(event, "type", None) == "response.completed":
+                    usage = event.response.usage
+                yield event
+        except Exception:
+            self.stats.errors += 1
+            raise
+        self.stats.record(time.monotonic() - started, usage)
+        record_tokens(self.role, usage)
+
+
+def get_model(role: str) -> Model:
+    """
+    The model for an agent role: its backends behind a router, rate
+    limited at the role's priority, with per-role accounting.
+    """
+    if role not in ROLE_PRIORITIES:
+        raise ValueError(f"Unknown model role: {role}")
+    return RoleModel(role)
+
+
+def all_backends() -> list[Backend]:
+    return list(dict.fromkeys(b for backends in role_backends().values() for b in backends))
+
+
+async def warm_up_clients(timeout: float = 10) -> None:
+    """
+    Opens a connection (TLS handshake included) to every model endpoint,
+    which the client's pool keeps alive for the first real call.
+    """
+    role_backends()
+
+    async def connect(client: AsyncOpenAI) -> None:
+        try:
+            await client.models.list(timeout=timeout)
+        except Exception as e:
+            # an error response still leaves the connection open
+            logger.debug(f"Model endpoint warm-up request to {client.base_url} failed: {e}")
+
+    await asyncio.gather(*(connect(client) for client in list(_clients.values())))
+
+
+def model_role_stats() -> dict:
+    return {
+        role: {
+            "backends": [backend.name for backend in role_backends()[role]],
+            **stats.as_dict(),
+        }
+        for role, stats in _role_stats.items()
+    }
@@ -0,0 +1,269 @@
+"""
+model_router.py
+
+Spreads model calls over several Azure OpenAI deployments. Backends are
+configured per agent role in model_registry.py.
+
+ModelRouter sends each call to the healthy backend with the lowest
+expected latency (EWMA of recent latencies, scaled by calls in flight, plus
+any wait in its rate limiter) and fails over to the next one on server,
+connection, timeout and rate limit errors. A backend that fails
+CIRCUIT_FAILURE_THRESHOLD times in a row is skipped for
+CIRCUIT_OPEN_SECONDS, after which one probe call decides whether it comes
+back.
+
+With MODEL_HEDGE_ENABLED, a non-streaming call that hasn't finished
+within the backend's p95 latency is sent to a second backend as well, and
+whichever answers first wins. Hedging trims the tail at the cost of the
+extra tokens of the hedged calls.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from collections.abc import AsyncIterator
+from typing import Any
+
+from agents import Model
+from openai import RateLimitError
+
+from fastapi_app.rate_limiter import (
+    MAX_ERROR_RETRIES,
+    MAX_RETRIES,
+    DeploymentLimiter,
+    RateLimitedModel,
+    is_retryable,
+)
+
+logger = logging.getLogger("app")
+
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 5))
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", 30))
+HEDGE_ENABLED = os.getenv("MODEL_HEDGE_ENABLED", "false").lower() == "true"
+# hedge delay until a backend has enough latency samples for a p95
+HEDGE_DEFAULT_DELAY = float(os.getenv("MODEL_HEDGE_DEFAULT_DELAY_SECONDS", 2.0))
+HEDGE_MIN_SAMPLES = 20
+LATENCY_WINDOW = 200
+EWMA_ALPHA = 0.2
+
+
+class Backend:
+    """
+    One deployment with its health: latency and the circuit breaker.
+    """
+
+    def __init__(self, name: str, model: Model, limiter: DeploymentLimiter):
+        self.name = name
+        self.model = model
+        self.limiter = limiter
+        self.ewma_latency: float | None = None
+        self.latencies: deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.probing = False
+        self.calls = 0
+        self.failures = 0
+
+    def available(self) -> bool:
+        """
+        Closed circuit, or an open one whose timeout has passed and that
+        isn't being probed yet.
+        """
+        if self.consecutive_failures < CIRCUIT_FAILURE_THRESHOLD:
+            return True
+        return time.monotonic() >= self.open_until and not self.probing
+
+    def score(self) -> float:
+        latency = self.ewma_latency if self.ewma_latency is not None else 0.0
+        return latency * (1 + self.in_flight) + self.limiter.expected_delay()
+
+    def hedge_delay(self) -> float:
+        if len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        ordered = sorted(self.latencies)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+    def started(self) -> None:
+        self.calls += 1
+        self.in_flight += 1
+        if self.consecutive_failures >= CIRCUIT_FAILURE_THRESHOLD:
+            self.probing = True
+
+    def succeeded(self, latency: float) -> None:
+        self.in_flight -= 1
+        self.latencies.append(latency)
+        self.ewma_latency = latency if self.ewma_latency is None else (
+            EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * self.ewma_latency
+        )
+        if self.consecutive_failures >= CIRCUIT_FAILURE_THRESHOLD:
+            logger.info(f"Model backend {self.name} recovered, closing circuit")
+        self.consecutive_failures = 0
+        self.probing = False
+
+    def failed(self) -> None:
+        self.in_flight -= 1
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.probing = False
+        if self.consecutive_failures >= CIRCUIT_FAILURE_THRESHOLD:
+            self.open_until = time.monotonic() + CIRCUIT_OPEN_SECONDS
+            logger.warning(f"Model backend {self.name} failing, opening circuit for {CIRCUIT_OPEN_SECONDS}s")
+
+    def cancelled(self) -> None:
+        self.in_flight -= 1
+        self.probing = False
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "failures": self.failures,
+            "in_flight": self.in_flight,
+            "ewma_latency_seconds": self.ewma_latency,
+            "p95_latency_seconds": self.hedge_delay() if len(self.latencies) >= HEDGE_MIN_SAMPLES else None,
+            "circuit_open": (
+                self.consecutive_failures >= CIRCUIT_FAILURE_THRESHOLD and time.monotonic() < self.open_until
+            ),
+        }
+
+
+class ModelRouter(Model):
+    """
+    Routes the calls of one agent over the shared backends, rate limited
+    at the given priority.
+    """
+
+    def __init__(self, backends: list[Backend], priority: int, hedge: bool = HEDGE_ENABLED):
+        if not backends:
+            raise ValueError("ModelRouter needs at least one backend")
+        self.backends = backends
+        self.hedge = hedge and len(backends) > 1
+        # with somewhere else to go, fail over instead of retrying the same backend
+        single = len(backends) == 1
+        self._models = {
+            backend.name: RateLimitedModel(
+                backend.model,
+                backend.limiter,
+                priority,
+                max_retries=MAX_RETRIES if single else 0,
+                max_error_retries=MAX_ERROR_RETRIES if single else 0,
+            )
+            for backend in backends
+        }
+
+    def _candidates(self, exclude: tuple = ()) -> list[Backend]:
+        """
+        Available backends, best first. If every circuit is open, all of
+        them, so calls still go out instead of failing outright.
+        """
+        backends = [b for b in self.backends if b not in exclude]
+        available = [b for b in backends if b.available()] or backends
+        return sorted(available, key=Backend.score)
+
+    async def _call(self, backend: Backend, args: tuple, kwargs: dict) -> Any:
+        backend.started()
+        started = time.monotonic()
+        try:
+            response = await self._models[backend.name].get_response(*args, **kwargs)
+        except asyncio.CancelledError:
+            backend.cancelled()
+            raise
+        except Exception as e:
+            # throttling is the limiter's business, not a sign of ill health
+            if is_retryable(e) and not isinstance(e, RateLimitError):
+                backend.failed()
+            else:
+                backend.cancelled()
+            raise
+        backend.succeeded(time.monotonic() - started)
+        return response
+
+    async def _hedged_call(self, primary: Backend, args: tuple, kwargs: dict) -> Any:
+        """
+        Calls primary, and a second backend too if primary is slower than
+        its p95. Returns the first successful response.
+        """
+        tasks = [asyncio.create_task(self._call(primary, args, kwargs))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=primary.hedge_delay())
+            if not done:
+                others = self._candidates(exclude=(primary,))
+                if others:
+                    tasks.append(asyncio.create_task(self._call(others[0], args, kwargs)))
+
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+            # every call failed; report the primary's error
+            return tasks[0].result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def _no_backend_left(self, last_error: Exception | None) -> Exception:
+        if last_error is None:
+            return RuntimeError("No model backend to call")
+        return last_error
+
+    async def get_response(self, *args, **kwargs):
+        tried: tuple = ()
+        last_error: Exception | None = None
+        while True:
+            candidates = self._candidates(exclude=tried)
+            if not candidates:
+                raise self._no_backend_left(last_error)
+            backend = candidates[0]
+            try:
+                if self.hedge and not tried:
+                    return await self._hedged_call(backend, args, kwargs)
+                return await self._call(backend, args, kwargs)
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                logger.warning(f"Model backend {backend.name} failed ({type(e).__name__}), trying the next one")
+                last_error = e
+                tried += (backend,)
+
+    async def stream_response(self, *args, **kwargs) -> AsyncIterator[Any]:
+        # streams are not hedged, and fail over only before the first event
+        tried: tuple = ()
+        last_error: Exception | None = None
+        while True:
+            candidates = self._candidates(exclude=tried)
+            if not candidates:
+                raise self._no_backend_left(last_error)
+            backend = candidates[0]
+            backend.started()
+            started = time.monotonic()
+            streamed = False
+            try:
+                async for event in self._models[backend.name].stream_response(*args, **kwargs):
+                    streamed = True
+                    yield event
+            except Exception as e:
+                if not is_retryable(e) or isinstance(e, RateLimitError):
+                    backend.cancelled()
+                else:
+                    backend.failed()
+                if not is_retryable(e):
+                    raise
+                if streamed:
+                    raise
+                logger.warning(f"Model backend {backend.name} failed ({type(e).__name__}), trying the next one")
+                last_error = e
+                tried += (backend,)
+                continue
+            except BaseException:
+                backend.cancelled()
+                raise
+            backend.succeeded(time.monotonic() - started)
+            return
+
+
+def model_router_stats(backends: list[Backend]) -> dict:
+    return {"hedge_enabled": HEDGE_ENABLED, "backends": {b.name: b.stats() for b in backends}}
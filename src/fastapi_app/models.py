@@ -1,11 +1,13 @@
 import logging
 import os
 import sys
-from datetime import datetime
+from datetime import date, datetime
+from functools import cache
 from urllib.parse import quote_plus
 
 from dotenv import load_dotenv
-from sqlalchemy import DateTime, Column, func, text, UniqueConstraint
+from sqlalchemy import Computed, DateTime, Column, Engine, Float, func, make_url, text, Index, UniqueConstraint
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
 from sqlmodel import Field, SQLModel, create_engine
 from typing import List, Optional, Any
 from pydantic import BaseModel
@@ -23,53 +25,64 @@ if not logger.hasHandlers():
     logger.addHandler(handler)
 
 
-sql_url = ""
-logger.info("Trying to connect to database...")
-env_connection_string = None
-
-if os.getenv("WEBSITE_HOSTNAME"):
-    logger.info("Connecting to Azure PostgreSQL Flexible server based on AZURE_POSTGRESQL_CONNECTIONSTRING...")
-    env_connection_string = os.getenv("AZURE_POSTGRESQL_CONNECTIONSTRING")
-
-if env_connection_string is None:
-    logger.info("Missing environment variable AZURE_POSTGRESQL_CONNECTIONSTRING")
-    logger.info("Connecting to local PostgreSQL server based on .env file...")
-    load_dotenv()
-    POSTGRES_USERNAME = os.environ.get("PGUSER")
-    POSTGRES_PASSWORD = os.environ.get("PGPASSWORD")
-    POSTGRES_HOST = os.environ.get("PGHOST")
-    POSTGRES_DATABASE = os.environ.get("PGDATABASE")
-    POSTGRES_PORT = os.environ.get("PGPORT", 5432)
-    sql_url = f"postgresql://{POSTGRES_USERNAME}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DATABASE}"
-    logger.info("String constructed: " + sql_url)
-else:
+def database_url() -> str:
+    """
+    The Postgres URL, from AZURE_POSTGRESQL_CONNECTIONSTRING on Azure App
+    Service, otherwise from the PG* settings in .env.
+    """
+    env_connection_string = None
+    if os.getenv("WEBSITE_HOSTNAME"):
+        env_connection_string = os.getenv("AZURE_POSTGRESQL_CONNECTIONSTRING")
+
+    if env_connection_string is None:
+        load_dotenv()
+        return (
+            f"postgresql://{os.environ.get('PGUSER')}:{os.environ.get('PGPASSWORD')}"
+            f"@{os.environ.get('PGHOST')}:{os.environ.get('PGPORT', 5432)}/{os.environ.get('PGDATABASE')}"
+        )
+
     # Parse the connection string
     details = dict(item.split('=') for item in env_connection_string.split())
 
     # Properly format the URL for SQLAlchemy
-    sql_url = (
+    return (
         f"postgresql://{quote_plus(details['user'])}:{quote_plus(details['password'])}"
         f"@{details['host']}:{details['port']}/{details['dbname']}?sslmode={details['sslmode']}"
     )
-    logger.info("String constructed: " + sql_url)
 
 
-logger.info("Creating SQL Engine")
+# The engines are created on first use rather than at import, so importing the
+# models (e.g. in seed_data.py or to build the app) needs no configuration or
+# database. Neither opens a connection until one is needed. Both hide the bound
+# parameters (locations, message content) from the messages of database errors,
+# which end up in logs and error responses.
+@cache
+def get_engine() -> Engine:
+    url = database_url()
+    logger.info(f"Creating SQL engine for {make_url(url).render_as_string(hide_password=True)}")
+    return create_engine(url, pool_pre_ping=True, hide_parameters=True)
+
 
-try:
-    engine = create_engine(sql_url, pool_pre_ping=True)
-    with engine.connect() as conn:
-        conn.execute(text("SELECT 1"))
-        logger.info("✅ Successfully connected to the database!")
+# Async engine used by the request handlers, so DB I/O doesn't block the event loop
+@cache
+def get_async_engine() -> AsyncEngine:
+    url = database_url().replace("postgresql://", "postgresql+psycopg://", 1)
+    logger.info(f"Creating async SQL engine for {make_url(url).render_as_string(hide_password=True)}")
+    return create_async_engine(url, pool_pre_ping=True, hide_parameters=True)
 
-except Exception as e:
-    logger.error("❌ Unexpected error during database connection:")
-    logger.exception(e)
+
+def __getattr__(name: str) -> Any:
+    # models.engine and models.async_engine, for scripts written against them
+    if name == "engine":
+        return get_engine()
+    if name == "async_engine":
+        return get_async_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def create_db_and_tables():
     logger.info("Creating Database and tables")
-    return SQLModel.metadata.create_all(engine)
+    return SQLModel.metadata.create_all(get_engine())
 
 # anything with table=True will be stored in a table
 class UserData(SQLModel, table=True):
@@ -93,7 +106,11 @@ class ChatRequest(SQLModel):
     use_mi_check_guardrail: Optional[bool] = True
     use_sensing_agent: Optional[bool] = False
     sensing_prompt: Optional[str] = None
+    # one model call for both the harm and MI checks instead of two
+    use_combined_guardrail: Optional[bool] = False
     reset_agent: Optional[bool] = None
+    # rebuild the conversation from stored messages instead of trusting the client's copy
+    use_server_history: Optional[bool] = True
     health_data: Optional[dict[str, Any]] = None
     gps_data: Optional[dict[str, Any]] = None
     
@@ -110,11 +127,14 @@ class ChatMessage(SQLModel, table=True):
     role: str = Field(max_length=20)  # "user" or "assistant"
     content: str
 
+    # legacy inline copy of the payload, new messages reference a HealthSnapshot instead
     health_data: Optional[dict] = Field(
         default=None,
         sa_column=Column(JSONB)
     )
 
+    health_snapshot_id: Optional[str] = Field(default=None, max_length=64)
+
     gps_data: Optional[dict] = Field(
         default=None,
         sa_column=Column(JSONB)
@@ -125,11 +145,49 @@ class ChatMessage(SQLModel, table=True):
         sa_column=Column(DateTime(timezone=True), server_default=func.now())
     )
 
+    __table_args__ = (
+        # keyset pagination of a user's history
+        Index("ix_chatmessage_user_created_id", "user_id", "created_at", "id"),
+    )
+
+# rolling summary of the part of a user's conversation that no longer fits in the prompt
+class ConversationSummary(SQLModel, table=True):
+    user_id: int = Field(primary_key=True)
+
+    summary: str
+
+    # newest ChatMessage folded into the summary, as its (created_at, id) position in the history
+    last_message_id: int
+    last_message_created_at: datetime = Field(sa_column=Column(DateTime(timezone=True), nullable=False))
+
+    updated_at: datetime = Field(
+        default_factory=datetime.utcnow,
+        sa_column=Column(DateTime(timezone=True), server_default=func.now())
+    )
+
+# health_data payloads sent with chat messages, stored once per distinct content
+class HealthSnapshot(SQLModel, table=True):
+    __tablename__ = "health_snapshot"
+
+    # sha256 of the canonical JSON encoding of health_data
+    id: str = Field(primary_key=True, max_length=64)
+
+    health_data: dict = Field(sa_column=Column(JSONB, nullable=False))
+
+    created_at: datetime = Field(
+        default_factory=datetime.utcnow,
+        sa_column=Column(DateTime(timezone=True), server_default=func.now())
+    )
+
 class GPSPayload(BaseModel):
     latitude: float
     longitude: float
     accuracy: Optional[float] = None
 
+class TimestampedGPSPayload(GPSPayload):
+    # when the fix was taken, defaults to when the server received it
+    recorded_at: Optional[datetime] = None
+
 class UserLocation(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     user_id: int = Field(index=True)
@@ -143,87 +201,124 @@ class UserLocation(SQLModel, table=True):
         sa_column=Column(DateTime(timezone=True), server_default=func.now())
     )
 
+    __table_args__ = (
+        # most recent locations for a user
+        Index("ix_userlocation_user_created", "user_id", text("created_at DESC")),
+    )
+
+# Per-day metric tables are range partitioned by month on recorded_at (see partitions.py).
+# Postgres requires the partition key in every unique constraint, so their
+# primary key is (id, recorded_at).
+METRIC_PARTITIONING = {"postgresql_partition_by": "RANGE (recorded_at)"}
+
 class HeartRate(SQLModel, table=True):
-    id: Optional[int] = Field(default=None, primary_key=True)
+    id: Optional[int] = Field(default=None, primary_key=True, sa_column_kwargs={"autoincrement": True})
     user_id: int = Field(index=True)
 
     bpm: float
 
     recorded_at: datetime = Field(
         default_factory=datetime.utcnow,
-        sa_column=Column(DateTime(timezone=True), server_default=func.now())
+        sa_column=Column(DateTime(timezone=True), server_default=func.now(), primary_key=True)
     )
 
     __table_args__ = (
         UniqueConstraint("user_id", "recorded_at", name="uq_heart_user_date"),
+        METRIC_PARTITIONING,
     )
 
 class StepCount(SQLModel, table=True):
-    id: Optional[int] = Field(default=None, primary_key=True)
+    id: Optional[int] = Field(default=None, primary_key=True, sa_column_kwargs={"autoincrement": True})
     user_id: int = Field(index=True)
 
     steps: int
 
     recorded_at: datetime = Field(
         default_factory=datetime.utcnow,
-        sa_column=Column(DateTime(timezone=True), server_default=func.now())
+        sa_column=Column(DateTime(timezone=True), server_default=func.now(), primary_key=True)
     )
 
     __table_args__ = (
         UniqueConstraint("user_id", "recorded_at", name="uq_step_user_date"),
+        METRIC_PARTITIONING,
     )
 
 class Sleep(SQLModel, table=True):
-    id: Optional[int] = Field(default=None, primary_key=True)
+    id: Optional[int] = Field(default=None, primary_key=True, sa_column_kwargs={"autoincrement": True})
     user_id: int = Field(index=True)
 
     duration_hours: float
 
     recorded_at: datetime = Field(
         default_factory=datetime.utcnow,
-        sa_column=Column(DateTime(timezone=True), server_default=func.now())
+        sa_column=Column(DateTime(timezone=True), server_default=func.now(), primary_key=True)
     )
 
     __table_args__ = (
         UniqueConstraint("user_id", "recorded_at", name="uq_sleep_user_date"),
+        METRIC_PARTITIONING,
     )
 class ActiveEnergy(SQLModel, table=True):
-    id: Optional[int] = Field(default=None, primary_key=True)
+    id: Optional[int] = Field(default=None, primary_key=True, sa_column_kwargs={"autoincrement": True})
     user_id: int = Field(index=True)
 
     kcal: float
 
     recorded_at: datetime = Field(
         default_factory=datetime.utcnow,
-        sa_column=Column(DateTime(timezone=True), server_default=func.now())
+        sa_column=Column(DateTime(timezone=True), server_default=func.now(), primary_key=True)
     )
 
     __table_args__ = (
         UniqueConstraint("user_id", "recorded_at", name="uq_energy_user_date"),
+        METRIC_PARTITIONING,
     )
 class FlightsClimbed(SQLModel, table=True):
-    id: Optional[int] = Field(default=None, primary_key=True)
+    id: Optional[int] = Field(default=None, primary_key=True, sa_column_kwargs={"autoincrement": True})
     user_id: int = Field(index=True)
 
     flights: int
 
     recorded_at: datetime = Field(
         default_factory=datetime.utcnow,
-        sa_column=Column(DateTime(timezone=True), server_default=func.now())
+        sa_column=Column(DateTime(timezone=True), server_default=func.now(), primary_key=True)
     )
 
     __table_args__ = (
         UniqueConstraint("user_id", "recorded_at", name="uq_flights_user_date"),
+        METRIC_PARTITIONING,
     )
 class BodyFat(SQLModel, table=True):
-    id: Optional[int] = Field(default=None, primary_key=True) 
+    id: Optional[int] = Field(default=None, primary_key=True, sa_column_kwargs={"autoincrement": True})
     user_id: int = Field(index=True) 
     percentage: float 
     recorded_at: datetime = Field( 
         default_factory=datetime.utcnow, 
         sa_column=Column( DateTime(timezone=True), 
-        server_default=func.now(), ) )
+        server_default=func.now(), primary_key=True, ) )
     
     __table_args__ = (
     UniqueConstraint("user_id", "recorded_at", name="uq_bodyfat_user_time"),
-)
\ No newline at end of file
+    METRIC_PARTITIONING,
+)
+
+# Per user weekly (ISO, starting Monday) and monthly aggregates of the metric
+# tables, kept up to date by the upserts (see rollups.py).
+class MetricRollup(SQLModel, table=True):
+    __tablename__ = "metric_rollup"
+
+    user_id: int = Field(primary_key=True)
+    # metric table name, e.g. "stepcount"
+    metric: str = Field(primary_key=True, max_length=32)
+    # "week" or "month"
+    period: str = Field(primary_key=True, max_length=8)
+    period_start: date = Field(primary_key=True)
+
+    count: int
+    sum: float
+    min: float
+    max: float
+    mean: Optional[float] = Field(
+        default=None,
+        sa_column=Column(Float, Computed("sum / NULLIF(count, 0)")),
+    )
@@ -0,0 +1,160 @@
+"""
+partitions.py
+
+Monthly range partitions for the per-day metric tables.
+
+Each metric table is partitioned on recorded_at, with one partition per
+calendar month (heartrate_p2025_01, ...) and a default partition that
+catches rows for months that don't have a partition yet. Creating a month
+moves any rows for it out of the default partition first, so partitions
+can be added at any time.
+
+Upcoming months are created ahead of time and, when
+METRIC_RETENTION_MONTHS is set, months older than that are detached and
+dropped, which is far cheaper than deleting rows. Run periodically with:
+
+    python3 src/fastapi_app/partitions.py
+"""
+
+import logging
+import os
+import re
+import zlib
+from datetime import date
+
+from sqlalchemy import Connection, text
+
+from fastapi_app.models import ActiveEnergy, BodyFat, FlightsClimbed, HeartRate, Sleep, StepCount, get_engine
+
+logger = logging.getLogger("app")
+
+PARTITIONED_MODELS = [HeartRate, StepCount, Sleep, ActiveEnergy, FlightsClimbed, BodyFat]
+
+MONTHS_AHEAD = int(os.getenv("METRIC_PARTITION_MONTHS_AHEAD", 3))
+# unset keeps every month forever
+RETENTION_MONTHS = os.getenv("METRIC_RETENTION_MONTHS")
+
+PARTITION_NAME = re.compile(r"_p(\d{4})_(\d{2})$")
+
+
+def month_start(day: date) -> date:
+    return day.replace(day=1)
+
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table: str, month: date) -> str:
+    return f"{table}_p{month:%Y_%m}"
+
+
+def _table_exists(conn: Connection, name: str) -> bool:
+    return conn.execute(text("SELECT to_regclass(:name) IS NOT NULL"), {"name": name}).scalar()
+
+
+def _lock_table_partitions(conn: Connection, table: str) -> None:
+    # serializes partition changes per table across workers; released on commit
+    conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": zlib.crc32(table.encode())})
+
+
+def ensure_default_partition(conn: Connection, table: str) -> None:
+    conn.execute(text(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT"))
+
+
+def ensure_partition(conn: Connection, table: str, month: date) -> bool:
+    """
+    Creates the partition for one month if it's missing. Returns True if
+    a partition was created.
+
+    The partition is built as a standalone table, filled with any rows for
+    that month sitting in the default partition, and then attached, since
+    Postgres refuses to attach a range that the default partition holds
+    rows for.
+    """
+    name = partition_name(table, month)
+    if _table_exists(conn, name):
+        return False
+
+    _lock_table_partitions(conn, table)
+    if _table_exists(conn, name):
+        return False
+
+    lower, upper = month, add_months(month, 1)
+    bounds = {"lower": lower, "upper": upper}
+    conn.execute(text(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"))
+    if _table_exists(conn, f"{table}_default"):
+        conn.execute(
+            text(
+                f"WITH moved AS ("
+                f"DELETE FROM {table}_default WHERE recorded_at >= :lower AND recorded_at < :upper RETURNING *"
+                f") INSERT INTO {name} SELECT * FROM moved"
+            ),
+            bounds,
+        )
+    conn.execute(
+        text(f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM ('{lower}') TO ('{upper}')")
+    )
+    logger.info(f"Created partition {name}")
+    return True
+
+
+def ensure_partitions(conn: Connection, first_day: date, last_day: date) -> int:
+    """
+    Makes sure every metric table has a partition for each month between
+    first_day and last_day. Returns the number of partitions created.
+    """
+    created = 0
+    for model in PARTITIONED_MODELS:
+        table = model.__tablename__
+        ensure_default_partition(conn, table)
+        month = month_start(first_day)
+        while month <= last_day:
+            created += ensure_partition(conn, table, month)
+            month = add_months(month, 1)
+    return created
+
+
+def drop_expired_partitions(conn: Connection, retention_months: int, today: date | None = None) -> list[str]:
+    """
+    Detaches and drops monthly partitions that ended more than
+    retention_months ago. Returns the names of the dropped partitions.
+    """
+    cutoff = add_months(month_start(today or date.today()), -retention_months)
+    dropped = []
+    for model in PARTITIONED_MODELS:
+        table = model.__tablename__
+        children = conn.execute(
+            text(
+                "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = to_regclass(:table)"
+            ),
+            {"table": table},
+        ).scalars()
+        for child in children:
+            match = PARTITION_NAME.search(child)
+            if not match or date(int(match[1]), int(match[2]), 1) >= cutoff:
+                continue
+            _lock_table_partitions(conn, table)
+            conn.execute(text(f"ALTER TABLE {table} DETACH PARTITION {child}"))
+            conn.execute(text(f"DROP TABLE {child}"))
+            logger.info(f"Dropped expired partition {child}")
+            dropped.append(child)
+    return dropped
+
+
+def maintain_partitions(conn: Connection, today: date | None = None) -> None:
+    """
+    Creates partitions from last month through MONTHS_AHEAD months ahead and
+    drops expired ones when a retention period is configured.
+    """
+    this_month = month_start(today or date.today())
+    ensure_partitions(conn, add_months(this_month, -1), add_months(this_month, MONTHS_AHEAD))
+    if RETENTION_MONTHS:
+        drop_expired_partitions(conn, int(RETENTION_MONTHS), this_month)
+
+
+if __name__ == "__main__":
+    with get_engine().begin() as conn:
+        maintain_partitions(conn)
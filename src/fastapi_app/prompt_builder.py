@@ -0,0 +1,127 @@
+"""
+prompt_builder.py
+
+Cache-friendly prompt assembly and prompt-cache reporting.
+
+Azure OpenAI caches the longest previously seen prefix of a prompt (in
+1024-token steps, then 128), so a turn is only cheap if it starts exactly
+like the previous one. PromptBuilder therefore always lays messages out
+as:
+
+    1. stable context   - per-user context that rarely changes (the
+                          conversation summary); the MI instructions and
+                          the sensing tool definition come before it as
+                          agent instructions and tools
+    2. history          - earlier turns, oldest first
+    3. the new user message
+    4. volatile context - locations, health data and GPS, merged into one
+                          system message and formatted deterministically
+
+so everything up to the new user message is a prefix of the next turn's
+prompt. Cached vs uncached input tokens reported by the model are
+counted per endpoint, see prompt_cache_stats().
+"""
+
+import json
+import threading
+from collections.abc import Iterable
+from typing import Any
+
+
+def format_value(value: Any) -> str:
+    """
+    Formats a context value the same way every time (sorted keys, no
+    whitespace variation), so identical data gives identical text.
+    """
+    if value is None:
+        return "N/A"
+    if isinstance(value, str):
+        return value
+    if isinstance(value, float):
+        return f"{value:.6g}"
+    return json.dumps(value, sort_keys=True, separators=(", ", ": "), default=str)
+
+
+class PromptBuilder:
+    """
+    Collects the parts of a prompt and returns them in cache-friendly order.
+    """
+
+    def __init__(self):
+        self._stable: list[str] = []
+        self._history: list[dict] = []
+        self._user_message: dict | None = None
+        self._volatile: list[tuple[str, list[str]]] = []
+
+    def add_stable(self, content: str) -> "PromptBuilder":
+        self._stable.append(content)
+        return self
+
+    def add_history(self, messages: Iterable[dict]) -> "PromptBuilder":
+        self._history.extend({"role": m["role"], "content": m["content"]} for m in messages)
+        return self
+
+    def set_user_message(self, message: dict) -> "PromptBuilder":
+        self._user_message = {"role": message["role"], "content": message["content"]}
+        return self
+
+    def add_context(self, title: str, lines: list[str]) -> "PromptBuilder":
+        """
+        Adds a section of volatile context, rendered after the user message.
+        """
+        if lines:
+            self._volatile.append((title, lines))
+        return self
+
+    def build(self) -> list[dict]:
+        messages = [{"role": "system", "content": content} for content in self._stable]
+        messages += self._history
+        if self._user_message is not None:
+            messages.append(self._user_message)
+        if self._volatile:
+            sections = [
+                f"{title}:\n" + "\n".join(f"- {line}" for line in lines)
+                for title, lines in self._volatile
+            ]
+            messages.append({"role": "system", "content": "\n\n".join(sections)})
+        return messages
+
+
+# endpoint -> request and input token counters, for this worker
+_cache_usage: dict[str, dict[str, int]] = {}
+_usage_lock = threading.Lock()
+
+
+def record_usage(endpoint: str, usage: Any) -> None:
+    """
+    Adds the input tokens of a model run (an agents Usage) to the counters
+    of an endpoint.
+    """
+    if usage is None or not usage.requests:
+        return
+    details = getattr(usage, "input_tokens_details", None)
+    cached = (getattr(details, "cached_tokens", 0) or 0) if details else 0
+    with _usage_lock:
+        counters = _cache_usage.setdefault(endpoint, {"requests": 0, "input_tokens": 0, "cached_tokens": 0})
+        counters["requests"] += usage.requests
+        counters["input_tokens"] += usage.input_tokens
+        counters["cached_tokens"] += cached
+
+
+def prompt_cache_stats() -> dict:
+    """
+    Cached and uncached input tokens and cache hit rate per endpoint.
+    """
+    with _usage_lock:
+        return {
+            endpoint: {
+                "requests": counters["requests"],
+                "input_tokens": counters["input_tokens"],
+                "cached_tokens": counters["cached_tokens"],
+                "uncached_tokens": counters["input_tokens"] - counters["cached_tokens"],
+                "hit_rate": (
+                    counters["cached_tokens"] / counters["input_tokens"] if counters["input_tokens"] else 0.0
+                ),
+            }
+            for endpoint, counters in _cache_usage.items()
+        }
@@ -0,0 +1,345 @@
+"""
+rate_limiter.py
+
+Client-side rate limiting of Azure OpenAI calls.
+
+Each deployment gets a DeploymentLimiter with two token buckets, one for
+requests per minute (AZURE_OPENAI_RPM) and one for tokens per minute
+(AZURE_OPENAI_TPM); a limit of 0 disables that bucket. A call first
+reserves its estimated tokens (prompt size plus the output allowance),
+and once the model reports the actual usage the difference is given back
+or charged. Calls wait in a priority queue, so guardrail checks go out
+before the main generation and background work (summaries) goes last.
+
+A 429 pauses the whole deployment for the retry-after the service asked
+for (or an exponential backoff) before the call is retried, instead of
+every waiting request hitting the limit again. Connection errors,
+timeouts and 5xx are retried with backoff too (the openai clients are
+created with max_retries=0, so these retries are the only ones).
+
+Agents use it through RateLimitedModel, which wraps any agents Model.
+"""
+
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import Counter
+from collections.abc import AsyncIterator
+from typing import Any
+
+from agents import Model
+from openai import APIConnectionError, APIStatusError, APITimeoutError, RateLimitError
+
+logger = logging.getLogger("app")
+
+REQUESTS_PER_MINUTE = int(os.getenv("AZURE_OPENAI_RPM", 0))
+TOKENS_PER_MINUTE = int(os.getenv("AZURE_OPENAI_TPM", 0))
+MAX_RETRIES = int(os.getenv("AZURE_OPENAI_MAX_RETRIES", 5))
+# connection errors, timeouts and 5xx; the openai client's own default is 2
+MAX_ERROR_RETRIES = int(os.getenv("AZURE_OPENAI_MAX_ERROR_RETRIES", 2))
+# assumed completion size when the call doesn't set max_tokens
+ESTIMATED_OUTPUT_TOKENS = int(os.getenv("AZURE_OPENAI_ESTIMATED_OUTPUT_TOKENS", 500))
+MAX_BACKOFF_SECONDS = 60.0
+
+PRIORITY_GUARDRAIL = 0
+PRIORITY_MAIN = 1
+PRIORITY_BACKGROUND = 2
+
+
+class TokenBucket:
+    """
+    Refills continuously at per_minute / 60 per second up to per_minute.
+    The level may go negative when actual usage exceeds the reservation.
+    """
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self._updated = time.monotonic()
+
+    @property
+    def enabled(self) -> bool:
+        return self.capacity > 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay_for(self, amount: float) -> float:
+        """
+        Seconds until amount can be taken; 0 if it can be taken now.
+        """
+        if not self.enabled:
+            return 0.0
+        self._refill()
+        # a request bigger than the bucket can only ever wait for a full bucket
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.rate)
+
+    def take(self, amount: float) -> None:
+        if self.enabled:
+            self._refill()
+            self.level -= amount
+
+    def adjust(self, amount: float) -> None:
+        # positive gives tokens back, negative charges more
+        if self.enabled:
+            self._refill()
+            self.level = min(self.capacity, self.level + amount)
+
+
+class DeploymentLimiter:
+    """
+    Admits calls to one deployment in priority order within its RPM and
+    TPM budgets.
+    """
+
+    def __init__(self, deployment: str, requests_per_minute: int = REQUESTS_PER_MINUTE,
+                 tokens_per_minute: int = TOKENS_PER_MINUTE):
+        self.deployment = deployment
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self._queue: list[tuple[int, int, float]] = []
+        self._sequence = itertools.count()
+        self._condition = asyncio.Condition()
+        self._blocked_until = 0.0
+        self._stats = {
+            "admitted": 0,
+            "throttled": 0,
+            "max_queue_depth": 0,
+            "total_wait_seconds": 0.0,
+            "max_wait_seconds": 0.0,
+            "estimated_tokens": 0,
+            "actual_tokens": 0,
+        }
+
+    def _delay(self, tokens: float) -> float:
+        return max(
+            self._blocked_until - time.monotonic(),
+            self.requests.delay_for(1),
+            self.tokens.delay_for(tokens),
+        )
+
+    def expected_delay(self) -> float:
+        """
+        Seconds a small call would wait right now, ignoring the queue.
+        """
+        return max(0.0, self._delay(0))
+
+    async def acquire(self, tokens: int, priority: int = PRIORITY_MAIN) -> None:
+        """
+        Waits until this call is first in line and both buckets have room,
+        then reserves one request and the estimated tokens.
+        """
+        started = time.monotonic()
+        entry = (priority, next(self._sequence), tokens)
+        async with self._condition:
+            heapq.heappush(self._queue, entry)
+            self._stats["max_queue_depth"] = max(self._stats["max_queue_depth"], len(self._queue))
+            # a new head of the queue has to re-check the buckets
+            self._condition.notify_all()
+            try:
+                while True:
+                    timeout = None
+                    if self._queue[0] is entry:
+                        timeout = self._delay(tokens)
+                        if timeout <= 0:
+                            break
+                    try:
+                        await asyncio.wait_for(self._condition.wait(), timeout)
+                    except TimeoutError:
+                        pass
+            except BaseException:
+                self._queue.remove(entry)
+                heapq.heapify(self._queue)
+                self._condition.notify_all()
+                raise
+
+            heapq.heappop(self._queue)
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            self._condition.notify_all()
+
+        waited = time.monotonic() - started
+        self._stats["admitted"] += 1
+        self._stats["estimated_tokens"] += tokens
+        self._stats["total_wait_seconds"] += waited
+        self._stats["max_wait_seconds"] = max(self._stats["max_wait_seconds"], waited)
+
+    def settle(self, estimated: int, actual: int | None) -> None:
+        """
+        Corrects the reservation once the actual usage is known.
+        """
+        if actual is None:
+            return
+        self.tokens.adjust(estimated - actual)
+        self._stats["actual_tokens"] += actual
+
+    def throttled(self, retry_after: float) -> None:
+        """
+        Pauses the deployment after a 429.
+        """
+        self._stats["throttled"] += 1
+        self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+        # the service's view of the budget is what counts; start from empty
+        self.tokens.level = min(self.tokens.level, 0.0)
+
+    def stats(self) -> dict:
+        admitted = self._stats["admitted"]
+        return {
+            **self._stats,
+            "queue_depth": len(self._queue),
+            "mean_wait_seconds": self._stats["total_wait_seconds"] / admitted if admitted else 0.0,
+            "requests_per_minute": int(self.requests.capacity),
+            "tokens_per_minute": int(self.tokens.capacity),
+        }
+
+
+_limiters: dict[str, DeploymentLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(deployment: str, requests_per_minute: int | None = None,
+                tokens_per_minute: int | None = None) -> DeploymentLimiter:
+    """
+    The shared limiter of a deployment, created on first use.
+    """
+    with _limiters_lock:
+        limiter = _limiters.get(deployment)
+        if limiter is None:
+            limiter = DeploymentLimiter(
+                deployment,
+                REQUESTS_PER_MINUTE if requests_per_minute is None else requests_per_minute,
+                TOKENS_PER_MINUTE if tokens_per_minute is None else tokens_per_minute,
+            )
+            _limiters[deployment] = limiter
+        return limiter
+
+
+def rate_limiter_stats() -> dict:
+    with _limiters_lock:
+        return {deployment: limiter.stats() for deployment, limiter in _limiters.items()}
+
+
+def estimate_tokens(system_instructions: str | None, input: Any, model_settings: Any) -> int:
+    """
+    Rough token count of a call: ~4 characters per token of the prompt plus
+    the completion allowance.
+    """
+    prompt = input if isinstance(input, str) else json.dumps(input, default=str)
+    prompt_tokens = (len(system_instructions or "") + len(prompt)) // 4
+    max_tokens = getattr(model_settings, "max_tokens", None) or ESTIMATED_OUTPUT_TOKENS
+    return prompt_tokens + max_tokens
+
+
+def is_retryable(error: Exception) -> bool:
+    """
+    Errors a later call (or another backend) may not get: throttling,
+    connection problems, timeouts and server errors. Other 4xx (e.g.
+    content filter rejections) would fail the same way every time.
+    """
+    if isinstance(error, (APIConnectionError, APITimeoutError, RateLimitError, TimeoutError)):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code >= 500
+
+
+def retry_delay(error: Exception, attempt: int) -> float:
+    """
+    The delay the service asked for, or exponential backoff with jitter.
+    """
+    response = getattr(error, "response", None)
+    headers = response.headers if response is not None else {}
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return min(MAX_BACKOFF_SECONDS, 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+class RateLimitedModel(Model):
+    """
+    Runs every call of the wrapped model through a DeploymentLimiter, and
+    retries 429s up to max_retries and other retryable errors up to
+    max_error_retries times.
+    """
+
+    def __init__(self, inner: Model, limiter: DeploymentLimiter, priority: int = PRIORITY_MAIN,
+                 max_retries: int = MAX_RETRIES, max_error_retries: int = MAX_ERROR_RETRIES):
+        self.inner = inner
+        self.limiter = limiter
+        self.priority = priority
+        self.max_retries = max_retries
+        self.max_error_retries = max_error_retries
+
+    def _retry_wait(self, error: Exception, estimated: int, retries: Counter) -> float | None:
+        """
+        Gives back the reservation of a failed call and, after a 429, pauses
+        the deployment for every caller. Returns how long this call should
+        wait before it is retried, or None when it shouldn't be.
+        """
+        if not is_retryable(error):
+            return None
+        self.limiter.settle(estimated, 0)
+        throttled = isinstance(error, RateLimitError)
+        attempt = retries[throttled]
+        retries[throttled] += 1
+        delay = retry_delay(error, attempt)
+        if throttled:
+            self.limiter.throttled(delay)
+            # acquire() waits out the pause
+            return 0.0 if attempt < self.max_retries else None
+        return delay if attempt < self.max_error_retries else None
+
+    async def get_response(self, system_instructions, input, model_settings, *args, **kwargs):
+        estimated = estimate_tokens(system_instructions, input, model_settings)
+        retries: Counter = Counter()
+        while True:
+            await self.limiter.acquire(estimated, self.priority)
+            try:
+                response = await self.inner.get_response(
+                    system_instructions, input, model_settings, *args, **kwargs
+                )
+            except Exception as e:
+                wait = self._retry_wait(e, estimated, retries)
+                if wait is None:
+                    raise
+                logger.warning(f"{type(e).__name__} from {self.limiter.deployment}, retrying")
+                await asyncio.sleep(wait)
+                continue
+            self.limiter.settle(estimated, response.usage.total_tokens if response.usage else None)
+            return response
+
+    async def stream_response(self, system_instructions, input, model_settings, *args, **kwargs) -> AsyncIterator[Any]:
+        estimated = estimate_tokens(system_instructions, input, model_settings)
+        retries: Counter = Counter()
+        while True:
+            await self.limiter.acquire(estimated, self.priority)
+            started = False
+            try:
+                async for event in self.inner.stream_response(
+                    system_instructions, input, model_settings, *args, **kwargs
+                ):
+                    started = True
+                    if getattr(event, "type", None) == "response.completed":
+                        usage = event.response.usage
+                        self.limiter.settle(estimated, usage.total_tokens if usage else None)
+                    yield event
+                return
+            except Exception as e:
+                wait = self._retry_wait(e, estimated, retries)
+                # once output has reached the caller the call can't be replayed
+                if wait is None or started:
+                    raise
+                logger.warning(f"{type(e).__name__} from {self.limiter.deployment}, retrying")
+                await asyncio.sleep(wait)
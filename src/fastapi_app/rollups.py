@@ -0,0 +1,259 @@
+"""
+rollups.py
+
+Weekly and monthly aggregates (count, sum, min, max, mean) of every
+metric table, per user, in metric_rollup.
+
+The upserts keep them current: upsert_metric_rows reports, for each row
+it wrote, the new value, the value it replaced and whether the row was
+inserted, and apply_metric_changes adds those deltas to the affected
+buckets. An update can shrink a bucket's min or max (when the replaced
+value was the extreme), which a delta can't express, so such buckets are
+recomputed from the raw rows instead; so are buckets where a concurrent
+writer got in between. Writers of one user's metric hold a transaction
+advisory lock, so the deltas of concurrent requests don't interleave.
+
+Everything can be rebuilt from the raw tables with:
+
+    python3 src/fastapi_app/rollups.py [--user-id N]
+"""
+
+import argparse
+import asyncio
+import logging
+import zlib
+from collections import defaultdict
+from collections.abc import Iterable
+from datetime import date, datetime, timedelta
+from typing import NamedTuple
+
+from sqlalchemy import Connection, text, tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel import SQLModel, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from fastapi_app.models import (
+    ActiveEnergy,
+    BodyFat,
+    FlightsClimbed,
+    HeartRate,
+    MetricRollup,
+    Sleep,
+    StepCount,
+    get_async_engine,
+    get_engine,
+)
+
+logger = logging.getLogger("app")
+
+# metric table name -> (model, value column)
+ROLLUP_METRICS: dict[str, tuple[type[SQLModel], str]] = {
+    model.__tablename__: (model, column)
+    for model, column in [
+        (HeartRate, "bpm"),
+        (StepCount, "steps"),
+        (ActiveEnergy, "kcal"),
+        (FlightsClimbed, "flights"),
+        (Sleep, "duration_hours"),
+        (BodyFat, "percentage"),
+    ]
+}
+PERIODS = ("week", "month")
+
+
+class MetricChange(NamedTuple):
+    recorded_at: datetime
+    new_value: float
+    # None for inserted rows
+    old_value: float | None
+    inserted: bool
+
+
+def period_start(day: date, period: str) -> date:
+    if period == "week":
+        return day - timedelta(days=day.weekday())
+    return day.replace(day=1)
+
+
+def period_end(start: date, period: str) -> date:
+    if period == "week":
+        return start + timedelta(days=7)
+    return (start + timedelta(days=32)).replace(day=1)
+
+
+def _bucket_sql(metric: str, period: str, where: str) -> str:
+    """
+    INSERT ... SELECT that (re)computes the period buckets of the raw rows
+    matching where.
+    """
+    _, column = ROLLUP_METRICS[metric]
+    bucket = f"date_trunc('{period}', recorded_at)::date"
+    return f"""
+        INSERT INTO metric_rollup (user_id, metric, period, period_start, count, sum, min, max)
+        SELECT user_id, '{metric}', '{period}', {bucket}, count(*), sum({column}), min({column}), max({column})
+        FROM {metric}
+        WHERE {where}
+        GROUP BY user_id, {bucket}
+        ON CONFLICT (user_id, metric, period, period_start) DO UPDATE
+        SET count = EXCLUDED.count, sum = EXCLUDED.sum, min = EXCLUDED.min, max = EXCLUDED.max
+    """
+
+
+async def lock_user_metric(session: AsyncSession, metric: str, user_id: int) -> None:
+    """
+    Serializes the writers of one user's metric until the transaction ends.
+    Must be taken before the raw rows are written.
+    """
+    await session.execute(
+        text("SELECT pg_advisory_xact_lock(:metric_key, :user_id)"),
+        {"metric_key": zlib.crc32(metric.encode()) & 0x7FFFFFFF, "user_id": user_id},
+    )
+
+
+async def recompute_bucket(session: AsyncSession, metric: str, user_id: int, period: str, start: date) -> None:
+    await session.execute(
+        text(_bucket_sql(metric, period, "user_id = :user_id AND recorded_at >= :start AND recorded_at < :end")),
+        {"user_id": user_id, "start": start, "end": period_end(start, period)},
+    )
+
+
+async def apply_metric_changes(session: AsyncSession, metric: str, user_id: int,
+                               changes: list[MetricChange]) -> None:
+    """
+    Folds the rows written to a metric table into its rollups. The caller
+    holds lock_user_metric and owns the transaction.
+    """
+    if not changes:
+        return
+
+    # bucket -> [count, sum, min, max] of inserted rows
+    inserted: dict[tuple[str, date], list] = {}
+    # bucket -> [(old, new)] of updated rows
+    updated: dict[tuple[str, date], list] = defaultdict(list)
+    recompute: set[tuple[str, date]] = set()
+
+    for change in changes:
+        value = float(change.new_value)
+        for period in PERIODS:
+            key = (period, period_start(change.recorded_at.date(), period))
+            if change.inserted:
+                delta = inserted.setdefault(key, [0, 0.0, value, value])
+                delta[0] += 1
+                delta[1] += value
+                delta[2] = min(delta[2], value)
+                delta[3] = max(delta[3], value)
+            elif change.old_value is None:
+                # updated a row this statement didn't see before: another writer got in between
+                recompute.add(key)
+            else:
+                updated[key].append((float(change.old_value), value))
+
+    keys = (set(inserted) | set(updated)) - recompute
+    current = {}
+    if keys:
+        rows = (
+            await session.exec(
+                select(MetricRollup).where(
+                    MetricRollup.user_id == user_id,
+                    MetricRollup.metric == metric,
+                    tuple_(MetricRollup.period, MetricRollup.period_start).in_(list(keys)),
+                )
+            )
+        ).all()
+        current = {(row.period, row.period_start): row for row in rows}
+
+    values = []
+    for key in keys:
+        row = current.get(key)
+        if row is None:
+            if key in updated:
+                # the rows exist but the bucket doesn't, e.g. rollups not built yet
+                recompute.add(key)
+                continue
+            count, total, low, high = inserted[key]
+        else:
+            count, total, low, high = row.count, row.sum, row.min, row.max
+            if key in inserted:
+                count += inserted[key][0]
+                total += inserted[key][1]
+                low = min(low, inserted[key][2])
+                high = max(high, inserted[key][3])
+            # replacing the extreme value can shrink the range; only a recompute knows by how much
+            if any((old <= row.min and new > old) or (old >= row.max and new < old) for old, new in updated[key]):
+                recompute.add(key)
+                continue
+            for old, new in updated[key]:
+                total += new - old
+                low = min(low, new)
+                high = max(high, new)
+
+        values.append({
+            "user_id": user_id,
+            "metric": metric,
+            "period": key[0],
+            "period_start": key[1],
+            "count": count,
+            "sum": total,
+            "min": low,
+            "max": high,
+        })
+
+    if values:
+        stmt = insert(MetricRollup).values(values)
+        await session.execute(
+            stmt.on_conflict_do_update(
+                index_elements=["user_id", "metric", "period", "period_start"],
+                set_={column: stmt.excluded[column] for column in ("count", "sum", "min", "max")},
+            )
+        )
+
+    for period, start in recompute:
+        await recompute_bucket(session, metric, user_id, period, start)
+
+
+async def rebuild_user_rollups(session: AsyncSession, user_id: int) -> None:
+    """
+    Recomputes all of a user's rollups, e.g. after a bulk load that didn't
+    maintain them. The caller owns the transaction.
+    """
+    for metric in ROLLUP_METRICS:
+        await lock_user_metric(session, metric, user_id)
+        await session.execute(
+            text("DELETE FROM metric_rollup WHERE user_id = :user_id AND metric = :metric"),
+            {"user_id": user_id, "metric": metric},
+        )
+        for period in PERIODS:
+            await session.execute(text(_bucket_sql(metric, period, "user_id = :user_id")), {"user_id": user_id})
+
+
+def rebuild_rollups(conn: Connection, metrics: Iterable[str] = ROLLUP_METRICS) -> None:
+    """
+    Recomputes the rollups of the given metric tables. Each table is locked
+    against writes until the transaction ends.
+    """
+    for metric in metrics:
+        conn.execute(text(f"LOCK TABLE {metric} IN SHARE MODE"))
+        conn.execute(text("DELETE FROM metric_rollup WHERE metric = :metric"), {"metric": metric})
+        for period in PERIODS:
+            conn.execute(text(_bucket_sql(metric, period, "true")))
+        logger.info(f"Rebuilt {metric} rollups")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--user-id", type=int)
+    args = parser.parse_args()
+
+    if args.user_id is None:
+        # a transaction per table, so only one table at a time is locked
+        for metric in ROLLUP_METRICS:
+            with get_engine().begin() as conn:
+                rebuild_rollups(conn, [metric])
+    else:
+        async def rebuild_user() -> None:
+            async with AsyncSession(get_async_engine()) as session:
+                await rebuild_user_rollups(session, args.user_id)
+                await session.commit()
+            await get_async_engine().dispose()
+
+        asyncio.run(rebuild_user())
@@ -3,7 +3,8 @@ import sys
 
 from sqlmodel import SQLModel
 
-from fastapi_app.models import create_db_and_tables, engine
+from fastapi_app.models import create_db_and_tables, get_engine
+from fastapi_app.partitions import maintain_partitions
 
 logger = logging.getLogger("app")
 logger.setLevel(logging.INFO)
@@ -19,7 +20,7 @@ if not logger.hasHandlers():
 
 def drop_all():
     logger.info("Drpping db...")
-    SQLModel.metadata.drop_all(engine)
+    SQLModel.metadata.drop_all(get_engine())
 
 
 if __name__ == "__main__":
@@ -27,5 +28,7 @@ if __name__ == "__main__":
     drop_all()
     logger.info("Create Database and tables from seed_data.py")
     create_db_and_tables()
+    with get_engine().begin() as conn:
+        maintain_partitions(conn)
 
 print("TESTING")
\ No newline at end of file
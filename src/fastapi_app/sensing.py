@@ -0,0 +1,220 @@
+"""
+sensing.py
+
+Data for the sensing agent: trends in a user's step count, sleep and
+heart rate.
+
+The daily rows of each metric are laid out on a day grid (missing days
+are NaN) and summarized with vectorized NumPy code: rolling means over
+every window in SENSING_WINDOWS (days, default 7 and 28), the change
+against the window before, and the least-squares trend slope. The text
+summary is cached per user for SENSING_CACHE_TTL_SECONDS, together with
+the month rollups (count and sum) of the days it covers. Every write to
+the metric tables updates those rollups in the same transaction, so a
+cached summary is only served while they are unchanged, whichever worker
+wrote the new rows.
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import UTC, date, datetime, timedelta
+from datetime import time as dt_time
+from typing import Any, NamedTuple
+
+import numpy as np
+from agents import RunContextWrapper, function_tool
+from sqlmodel import SQLModel, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from .models import HeartRate, MetricRollup, Sleep, StepCount, get_async_engine
+
+logger = logging.getLogger("app")
+
+WINDOWS = tuple(int(w) for w in os.getenv("SENSING_WINDOWS", "7,28").split(","))
+CACHE_TTL = float(os.getenv("SENSING_CACHE_TTL_SECONDS", 900))
+CACHE_SIZE = 1024
+MIN_TREND_DAYS = 3
+
+
+class SensingMetric(NamedTuple):
+    model: type[SQLModel]
+    column: str
+    label: str
+    unit: str
+
+
+SENSING_METRICS = (
+    SensingMetric(StepCount, "steps", "Step count", "steps/day"),
+    SensingMetric(Sleep, "duration_hours", "Sleep", "hours/night"),
+    SensingMetric(HeartRate, "bpm", "Heart rate", "bpm"),
+)
+
+# user_id -> (expiry time, data version, summary)
+_summaries: "OrderedDict[int, tuple[float, tuple, str]]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+async def data_version(session: AsyncSession, user_id: int, first_day: date) -> tuple:
+    """
+    The month rollups of the user's sensing metrics from first_day's month
+    on. Any new or changed daily value changes their count or sum.
+    """
+    rows = (
+        await session.exec(
+            select(MetricRollup.metric, MetricRollup.period_start, MetricRollup.count, MetricRollup.sum)
+            .where(
+                MetricRollup.user_id == user_id,
+                MetricRollup.metric.in_([metric.model.__tablename__ for metric in SENSING_METRICS]),
+                MetricRollup.period == "month",
+                MetricRollup.period_start >= first_day.replace(day=1),
+            )
+            .order_by(MetricRollup.metric, MetricRollup.period_start)
+        )
+    ).all()
+    return tuple(tuple(row) for row in rows)
+
+
+def day_grid(days: np.ndarray, values: np.ndarray, length: int) -> np.ndarray:
+    """
+    Values placed by day index (0 is the oldest day); days without data are NaN.
+    """
+    grid = np.full(length, np.nan)
+    grid[days] = values
+    return grid
+
+
+def rolling_means(grid: np.ndarray, window: int) -> np.ndarray:
+    """
+    Mean of each window-day span ending at every day from window - 1 on,
+    ignoring missing days. NaN where a span has no data.
+    """
+    valid = ~np.isnan(grid)
+    sums = np.concatenate(([0.0], np.cumsum(np.where(valid, grid, 0.0))))
+    counts = np.concatenate(([0], np.cumsum(valid)))
+    window_sums = sums[window:] - sums[:-window]
+    window_counts = counts[window:] - counts[:-window]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(window_counts > 0, window_sums / window_counts, np.nan)
+
+
+def trend_slope(grid: np.ndarray) -> float:
+    """
+    Least-squares slope in units per day over the days with data.
+    """
+    valid = ~np.isnan(grid)
+    if valid.sum() < MIN_TREND_DAYS:
+        return float("nan")
+    x = np.arange(len(grid))[valid]
+    y = grid[valid]
+    x_centered = x - x.mean()
+    return float((x_centered * (y - y.mean())).sum() / (x_centered ** 2).sum())
+
+
+def summarize_grid(grid: np.ndarray, windows: tuple[int, ...] = WINDOWS) -> list[dict]:
+    """
+    For each window: the mean of the latest window days, days with data,
+    the change against the window before, and the trend slope.
+    """
+    summaries = []
+    for window in windows:
+        means = rolling_means(grid, window)
+        current = means[-1]
+        previous = means[-1 - window] if len(means) > window else np.nan
+        recent = grid[-window:]
+        summaries.append({
+            "window": window,
+            "mean": current,
+            "days": int((~np.isnan(recent)).sum()),
+            "change": (current - previous) / previous if previous else np.nan,
+            "slope": trend_slope(recent),
+        })
+    return summaries
+
+
+def _format_number(value: float) -> str:
+    return f"{value:,.0f}" if abs(value) >= 100 else f"{value:.1f}"
+
+
+def format_summary(metric: SensingMetric, summaries: list[dict]) -> str:
+    parts = []
+    for s in summaries:
+        if s["days"] == 0:
+            parts.append(f"last {s['window']} days: no data")
+            continue
+        part = f"last {s['window']} days avg {_format_number(s['mean'])} {metric.unit} ({s['days']}/{s['window']} days)"
+        if not np.isnan(s["change"]):
+            part += f", {s['change']:+.0%} vs the {s['window']} days before"
+        if not np.isnan(s["slope"]):
+            part += f", trend {s['slope'] * 7:+.1f} {metric.unit} per week"
+        parts.append(part)
+    return f"{metric.label}: " + "; ".join(parts)
+
+
+async def load_grid(session: AsyncSession, metric: SensingMetric, user_id: int, today: date,
+                    length: int) -> np.ndarray:
+    first_day = today - timedelta(days=length - 1)
+    column = getattr(metric.model, metric.column)
+    rows = (
+        await session.exec(
+            select(metric.model.recorded_at, column).where(
+                metric.model.user_id == user_id,
+                metric.model.recorded_at >= datetime.combine(first_day, dt_time.min),
+                metric.model.recorded_at < datetime.combine(today + timedelta(days=1), dt_time.min),
+            )
+        )
+    ).all()
+    if not rows:
+        return np.full(length, np.nan)
+    days = np.array([(row[0].date() - first_day).days for row in rows])
+    values = np.array([row[1] for row in rows], dtype=float)
+    return day_grid(days, values, length)
+
+
+async def get_sensing_summary(user_id: int, today: date | None = None) -> str:
+    """
+    The trend summary of a user's step count, sleep and heart rate.
+    """
+    today = today or datetime.now(UTC).date()
+    # twice the longest window, to compare it with the window before
+    length = 2 * max(WINDOWS)
+    async with AsyncSession(get_async_engine()) as session:
+        version = (today, await data_version(session, user_id, today - timedelta(days=length - 1)))
+        with _cache_lock:
+            cached = _summaries.get(user_id)
+            if cached and cached[0] > time.monotonic() and cached[1] == version:
+                _summaries.move_to_end(user_id)
+                return cached[2]
+
+        lines = [
+            format_summary(metric, summarize_grid(await load_grid(session, metric, user_id, today, length)))
+            for metric in SENSING_METRICS
+        ]
+    summary = "\n".join(lines)
+
+    # rows written after the version was read only make the next lookup miss
+    with _cache_lock:
+        _summaries[user_id] = (time.monotonic() + CACHE_TTL, version, summary)
+        _summaries.move_to_end(user_id)
+        while len(_summaries) > CACHE_SIZE:
+            _summaries.popitem(last=False)
+    return summary
+
+
+@function_tool
+async def health_trends(ctx: RunContextWrapper[Any]) -> str:
+    """
+    Returns trends in the user's daily step count, sleep duration and heart
+    rate: averages over the last week and month, the change against the
+    period before, and the trend per week.
+    """
+    user_id = getattr(ctx.context, "user_id", None)
+    if user_id is None:
+        return "No health data is available for this user."
+    try:
+        return await get_sensing_summary(user_id)
+    except Exception:
+        logger.exception(f"Error summarizing health data for user {user_id}")
+        return "The user's health data could not be loaded right now."
@@ -25,11 +25,9 @@ step_count_prompt = """
  
 # Step Count Data
 
-1. The table has two columns: "date" and "value".
-2. The "date" column contains dates describing the day the data was collected.
-3. The "value" column describes the number of steps the user took on the date described in the first column.
+1. Step count is the number of steps the user took per day.
 
-[INSERT STEP COUNT DATA]
+Call the health_trends tool to get the user's step count trends.
 
 """
 
@@ -37,11 +35,9 @@ sleep_duration_prompt = """
 
 # Sleep Duration Data
 
-1. The table has two columns: "date" and "value".
-2. The "date" column contains dates describing the day the data was collected.
-3. The "value" column describes the number of hours the user slept on the date described in the first column.
+1. Sleep duration is the number of hours the user slept per night.
 
-[INSERT SLEEP DURATION DATA]
+Call the health_trends tool to get the user's sleep duration trends.
 
 """
 
@@ -58,10 +54,38 @@ hrv_prompt = """
 7. Heart rate variability is a relative signal, so it is helpful to consider relative trends over absolute numbers.
 8. The user may not know what heart rate variability is, so it may be important to explain this data as the physiological response to stress.
 
-[INSERT HRV DATA]
+Heart rate variability is not collected yet. The health_trends tool reports the user's average heart rate
+instead, see "Heart Rate Data".
 
 """
 
+heart_rate_prompt = """
+
+# Heart Rate Data
+
+1. The health_trends tool reports the user's average heart rate per day, in beats per minute.
+2. Heart rate rises with physical activity, stress, illness, caffeine and poor sleep, and falls with rest and fitness.
+3. Changes over weeks are more meaningful than changes from one day to the next.
+
+"""
+
+health_trends_prompt = """
+
+# Health Trends
+
+1. The health_trends tool summarizes the user's step count, sleep duration and heart rate.
+2. For the last week and the last month it gives the average, how many days had data, the change compared to
+the period before, and the trend per week.
+3. Few days with data means the numbers are less reliable.
+
+"""
+
+# used when a request doesn't send its own sensing_prompt
+default_sensing_prompt = (
+    sensing_prompt + health_trends_prompt + step_count_prompt + sleep_duration_prompt + heart_rate_prompt
+)
+
 sensing_tool_description = """
-This tool can give you data on the user's sleep duration and step counts to help you with motivational interviewing.
+This tool can give you data on the user's sleep duration, step counts and heart rate to help you with
+motivational interviewing.
 """
\ No newline at end of file
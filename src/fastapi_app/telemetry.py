@@ -0,0 +1,159 @@
+"""
+telemetry.py
+
+OpenTelemetry spans and metrics for the chat path.
+
+Every stage of a chat request (metric upserts, health snapshot, recent
+locations, conversation history, commit, agent run) runs in a
+chat.<stage> span and its duration is recorded in the chat.stage.duration
+histogram. Each guardrail run gets a chat.guardrail span and goes to
+chat.guardrail.duration, labeled with whether it tripped. Model tokens
+are counted per agent role in llm.tokens, and /chat/stream records its
+time to first token in chat.time_to_first_token.
+
+Exporting never happens on the request path. With
+APPLICATIONINSIGHTS_CONNECTION_STRING set, Azure Monitor ships spans
+through a batch span processor and metrics through a periodic reader,
+both on background threads (tunable with the standard OTEL_BSP_* and
+OTEL_METRIC_EXPORT_* settings). Otherwise the metrics are kept in memory
+and served in Prometheus format at /metrics (turn off with
+PROMETHEUS_METRICS=0); under gunicorn every worker reports its own.
+"""
+
+import os
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from typing import Any
+
+from opentelemetry import metrics, trace
+
+tracer = trace.get_tracer("fastapi_app")
+meter = metrics.get_meter("fastapi_app")
+
+stage_duration = meter.create_histogram(
+    "chat.stage.duration", unit="ms", description="Duration of each stage of a chat request"
+)
+guardrail_duration = meter.create_histogram(
+    "chat.guardrail.duration", unit="ms", description="Duration of each input guardrail run"
+)
+time_to_first_token = meter.create_histogram(
+    "chat.time_to_first_token", unit="ms", description="Time until the first streamed token of a reply"
+)
+llm_tokens = meter.create_counter(
+    "llm.tokens", unit="{token}", description="Model tokens by agent role and type"
+)
+
+_configured = False
+_prometheus_enabled = False
+
+
+def configure_telemetry(app: Any = None) -> None:
+    """
+    Sets up exporting, and traces the requests of app (a FastAPI app) when
+    they go to Azure Monitor. Called from the app's lifespan, after
+    configure_logging(); later calls do nothing, since OpenTelemetry
+    doesn't replace a provider once it is set.
+    """
+    global _configured, _prometheus_enabled
+    if _configured:
+        return
+    _configured = True
+
+    if os.getenv("APPLICATIONINSIGHTS_CONNECTION_STRING"):
+        from azure.monitor.opentelemetry import configure_azure_monitor
+        from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
+
+        # the app logger doesn't propagate to the root logger; its filters sample and redact
+        # records for this handler too, see logging_config.py
+        configure_azure_monitor(logger_name="app")
+        # the distro only instruments FastAPI apps created after it is configured
+        if app is not None:
+            FastAPIInstrumentor.instrument_app(app)
+        return
+
+    if os.getenv("PROMETHEUS_METRICS", "1") == "1":
+        from opentelemetry.exporter.prometheus import PrometheusMetricReader
+        from opentelemetry.sdk.metrics import MeterProvider
+
+        metrics.set_meter_provider(MeterProvider(metric_readers=[PrometheusMetricReader()]))
+        _prometheus_enabled = True
+
+
+def prometheus_metrics() -> tuple[bytes, str] | None:
+    """
+    The metrics in Prometheus text format and their content type, or None
+    when they are exported to Application Insights instead.
+    """
+    if not _prometheus_enabled:
+        return None
+    from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+def _elapsed_ms(started: float) -> float:
+    return (time.perf_counter() - started) * 1000
+
+
+@contextmanager
+def stage(name: str) -> Iterator[trace.Span]:
+    """
+    Runs a stage of a chat request in a span and records its duration.
+    """
+    started = time.perf_counter()
+    with tracer.start_as_current_span(f"chat.{name}") as span:
+        try:
+            yield span
+        finally:
+            stage_duration.record(_elapsed_ms(started), {"stage": name})
+
+
+def record_stage(name: str, started: float) -> None:
+    """
+    Records the duration of a stage that can't run inside a span, e.g. one
+    spread over the yields of a streaming response.
+    """
+    stage_duration.record(_elapsed_ms(started), {"stage": name})
+
+
+@contextmanager
+def guardrail_run(guardrail: str) -> Iterator[dict]:
+    """
+    Runs a guardrail in a span and records its duration. Set "tripped" in
+    the yielded dict to the verdict.
+    """
+    outcome = {"tripped": False}
+    started = time.perf_counter()
+    with tracer.start_as_current_span("chat.guardrail", attributes={"guardrail": guardrail}) as span:
+        try:
+            yield outcome
+        finally:
+            span.set_attribute("guardrail.tripped", outcome["tripped"])
+            guardrail_duration.record(
+                _elapsed_ms(started), {"guardrail": guardrail, "tripped": outcome["tripped"]}
+            )
+
+
+def record_ttft(started: float) -> None:
+    time_to_first_token.record(_elapsed_ms(started))
+
+
+def record_tokens(role: str, usage: Any) -> None:
+    """
+    Counts the tokens of a model response (an agents Usage) for a role and
+    notes them on the current span.
+    """
+    if usage is None:
+        return
+    details = getattr(usage, "input_tokens_details", None)
+    counts = {
+        "input": usage.input_tokens or 0,
+        "cached": (getattr(details, "cached_tokens", 0) or 0) if details else 0,
+        "output": usage.output_tokens or 0,
+    }
+    for kind, count in counts.items():
+        llm_tokens.add(count, {"role": role, "type": kind})
+    trace.get_current_span().add_event(
+        "llm.usage", {"role": role, **{f"{kind}_tokens": count for kind, count in counts.items()}}
+    )
@@ -0,0 +1,162 @@
+"""
+warmup.py
+
+Per-worker startup warm-up, run from the app's lifespan before the
+worker accepts requests, so the first /chat a worker serves doesn't pay
+for building agents, connecting to Postgres or the TLS handshake with the
+model endpoint. Gunicorn recycles workers every max_requests, so this
+happens often.
+
+Steps:
+
+    agents      - builds the commonly requested agent variants
+    database    - opens STARTUP_DB_CONNECTIONS pool connections
+    partitions  - creates upcoming metric partitions (one worker at a time)
+    models      - opens a keep-alive connection to every model endpoint
+
+Only the database is required: if it can't be reached the worker starts
+anyway, keeps retrying in the background and reports not ready at
+/health/ready until it succeeds. Set STARTUP_WARMUP=0 to skip the
+warm-up (the worker is then ready immediately).
+"""
+
+import asyncio
+import logging
+import os
+import time
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from .agent_cache import get_or_create_agent
+from .model_registry import warm_up_clients
+from .models import get_async_engine
+from .partitions import maintain_partitions
+
+logger = logging.getLogger("app")
+
+WARMUP_ENABLED = os.getenv("STARTUP_WARMUP", "1") == "1"
+WARMUP_TIMEOUT = float(os.getenv("STARTUP_WARMUP_TIMEOUT_SECONDS", 30))
+DB_CONNECTIONS = int(os.getenv("STARTUP_DB_CONNECTIONS", 2))
+DB_RETRY_SECONDS = 5
+
+# arbitrary key so only one starting worker maintains partitions at a time
+PARTITION_LOCK_KEY = 73012026
+
+# (use_harm_guardrail, use_mi_check_guardrail, use_sensing_agent, use_combined_guardrail)
+AGENT_VARIANTS = [
+    (True, True, False, False),  # ChatRequest defaults
+    (True, True, False, True),
+    (True, True, True, False),
+    (True, True, True, True),
+]
+
+_ready = not WARMUP_ENABLED
+_steps: dict[str, dict] = {}
+_retry_task: asyncio.Task | None = None
+
+
+def is_ready() -> bool:
+    return _ready
+
+
+def warmup_status() -> dict:
+    return {"ready": _ready, "steps": _steps}
+
+
+def warm_agents() -> None:
+    for harm, mi_check, sensing, combined in AGENT_VARIANTS:
+        get_or_create_agent(
+            use_harm_guardrail=harm,
+            use_mi_check_guardrail=mi_check,
+            use_sensing_agent=sensing,
+            use_combined_guardrail=combined,
+        )
+
+
+async def warm_database() -> None:
+    """
+    Checks out several connections at once, so the pool keeps them open.
+    """
+    engine = get_async_engine()
+    connections: list[AsyncConnection] = []
+    try:
+        for _ in range(max(1, min(DB_CONNECTIONS, engine.pool.size()))):
+            conn = await engine.connect()
+            connections.append(conn)
+            await conn.execute(text("SELECT 1"))
+    finally:
+        for conn in connections:
+            await conn.close()
+
+
+async def warm_partitions() -> None:
+    async with get_async_engine().begin() as conn:
+        locked = (
+            await conn.execute(text("SELECT pg_try_advisory_xact_lock(:key)"), {"key": PARTITION_LOCK_KEY})
+        ).scalar()
+        if locked:
+            await conn.run_sync(maintain_partitions)
+
+
+async def _run_step(name: str, step) -> bool:
+    started = time.perf_counter()
+    try:
+        result = step()
+        if asyncio.iscoroutine(result):
+            await result
+    except Exception as e:
+        logger.warning(f"Warm-up step {name} failed: {e}")
+        _steps[name] = {"ok": False, "error": str(e)}
+        return False
+    elapsed = time.perf_counter() - started
+    _steps[name] = {"ok": True, "seconds": round(elapsed, 3)}
+    return True
+
+
+async def _retry_database() -> None:
+    global _ready
+    while not await _run_step("database", warm_database):
+        await asyncio.sleep(DB_RETRY_SECONDS)
+    _ready = True
+    logger.info("Database reachable, worker ready")
+
+
+async def warm_up() -> None:
+    """
+    Runs the warm-up steps and marks the worker ready. Called from the
+    lifespan, before the worker accepts requests.
+    """
+    global _ready, _retry_task
+    if not WARMUP_ENABLED:
+        return
+
+    started = time.perf_counter()
+    database_ok = False
+
+    async def run_steps() -> None:
+        nonlocal database_ok
+        await _run_step("agents", warm_agents)
+        # independent of each other, so overlap the round trips
+        database_ok, _ = await asyncio.gather(
+            _run_step("database", warm_database),
+            _run_step("models", warm_up_clients),
+        )
+        if database_ok:
+            await _run_step("partitions", warm_partitions)
+
+    try:
+        await asyncio.wait_for(run_steps(), WARMUP_TIMEOUT)
+    except TimeoutError:
+        logger.warning(f"Warm-up did not finish within {WARMUP_TIMEOUT:.0f}s")
+
+    if database_ok:
+        _ready = True
+    else:
+        _retry_task = asyncio.create_task(_retry_database())
+    logger.info(f"Warm-up finished in {(time.perf_counter() - started) * 1000:.0f} ms, ready: {_ready}")
+
+
+async def stop_warm_up() -> None:
+    if _retry_task is not None:
+        _retry_task.cancel()
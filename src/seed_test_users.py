@@ -1,7 +1,7 @@
 import logging
 from fastapi import logger
 from sqlmodel import Session
-from fastapi_app.models import UserData, engine
+from fastapi_app.models import UserData, get_engine
 
 import json
 
@@ -18,7 +18,7 @@ def seed_database(json_path: str = "src/seed_data.json"):
     with open(json_path, "r") as f:
         data = json.load(f)
 
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         for item in data:
             fields = item["fields"]
             user = UserData(**fields)